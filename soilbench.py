@@ -0,0 +1,282 @@
+import argparse, itertools, json, os, random, shutil, sqlite3, subprocess, sys, tempfile, time
+import soilgenFire as sg
+'''
+soilbench
+Benchmarks for soilgenFire against synthetic STATSGO2/SSURGO style data, so throughput can be measured
+without a live .mdb and compared across versions.
+
+---------------------------------------------------------------------------
+
+input:
+    comand line:
+        >soilbench.py --sizes 1000,10000,100000 --output bench.json
+        >soilbench.py --sizes 1000 --compare bench_old.json
+        -s/--sizes [N,N,...] numbers of mukeys to benchmark (default 1000,10000,100000)
+        -o/--output [bench.json] machine readable results (default bench.json)
+        -c/--compare [bench_old.json] prints the speed of each stage relative to an earlier result file
+        -k/--keep [dir] keeps the synthetic databases (synthetic_[N].sqlite) in dir; existing ones are reused
+        -r/--seed [N] random seed of the synthetic data (default 1)
+        -d/--database [soils.sqlite] only writes a synthetic database of the first size and exits
+
+output: a json file with one record per size and stage: seconds, items, items per second
+'''
+
+'''Global Vars'''
+#per-key stages (one query per key, one soil at a time) run on at most this many keys
+per_key_sample = 1000
+
+#component names used for the synthetic data
+synthetic_names = ('Rock outcrop', 'Lithic Torriorthents', 'Pinaleno', 'Tubac', 'Gila', 'Mohave', 'Cellar',
+                   'Anthony', 'Latene', 'Continental', 'Whitlock', 'Graham', 'House Mountain', 'Chiricahua')
+
+#share of NULLs per chorizon column, which is what drives the defaults in sort_values
+null_rates = dict(dbthirdbar_r=.08, ksat_r=.05, sandtotal_r=.03, claytotal_r=.03, om_r=.1, ecec_r=.15,
+                  fraggt10_r=.3, frag3to10_r=.3, sieveno10_r=.1, wthirdbar_r=.1, wfifteenbar_r=.1)
+
+def synthetic_horizons(cokey, rnd):
+    '''Returns the chorizon rows of one synthetic component'''
+    rows = []
+    depth = 0
+    for h in range(rnd.randint(1, 7)):
+        depth += rnd.choice((3, 5, 8, 10, 13, 18, 25, 30, 41, 51))
+        sand = round(rnd.uniform(5, 95), 1)
+        clay = round(rnd.uniform(2, min(60, 100 - sand)), 1)
+        wfifteenbar = round(rnd.uniform(2, 30), 1)
+        row = dict(cokey=str(cokey), chkey=str(cokey * 10 + h), hzname='H%d' % (h + 1), hzdepb_r=depth,
+                   dbthirdbar_r=round(rnd.uniform(1.0, 1.8), 2), ksat_r=round(rnd.lognormvariate(1.5, 1.3), 2),
+                   sandtotal_r=sand, claytotal_r=clay, om_r=round(rnd.uniform(0, 10 if h == 0 else 2), 2),
+                   ecec_r=round(rnd.uniform(0.5, 50), 1), awc_l=round(rnd.uniform(0.01, 0.25), 2),
+                   fraggt10_r=rnd.choice((0, 0, 2, 5, 10, 25)), frag3to10_r=rnd.choice((0, 0, 3, 5, 15, 30)),
+                   desgnmaster=rnd.choice(('O',) if h == 0 and rnd.random() < .05 else ('A', 'B', 'B', 'C', 'R')),
+                   sieveno10_r=round(rnd.uniform(50, 100), 1), wthirdbar_r=round(wfifteenbar + rnd.uniform(2, 20), 1),
+                   wfifteenbar_r=wfifteenbar, sandvf_r=round(rnd.uniform(0, min(sand, 25)), 1))
+        for column, rate in null_rates.items():
+            if rnd.random() < rate:
+                row[column] = None
+        rows.append(row)
+    return rows
+
+def make_database(path, mukeys, seed=1):
+    '''Writes a synthetic SQLite soils database (the layout made by --import-sqlite) with mukeys map units
+    and returns the list of mukeys'''
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    for table, columns in ((sg.component_table, sg.component_columns), (sg.chorizon_table, sg.chorizon_columns)):
+        con.execute("CREATE TABLE %s (%s)" % (table, ', '.join(['%s %s' % c for c in columns])))
+    cokey = 10000000
+    mukey_list = [str(100000 + m) for m in range(mukeys)]
+    for mukey in mukey_list:
+        components = []
+        left = 100
+        for c in range(rnd.randint(1, 6)):
+            pct = left if c == 5 else rnd.choice((5, 10, 15, 20, 25, 30, 40, 50, 60, 85))
+            pct = min(pct, left)
+            if pct <= 0:
+                break
+            left -= pct
+            cokey += 1
+            components.append((mukey, str(cokey), rnd.choice(synthetic_names), pct))
+        con.executemany("INSERT INTO %s VALUES (?,?,?,?)" % sg.component_table, components)
+        for component in components:
+            #rock outcrop and a few others have no horizons at all
+            if component[2] == 'Rock outcrop' and rnd.random() < .5:
+                continue
+            rows = synthetic_horizons(int(component[1]), rnd)
+            con.executemany("INSERT INTO %s VALUES (%s)" % (sg.chorizon_table, ','.join('?' * len(sg.chorizon_columns))),
+                            [tuple([row[c[0]] for c in sg.chorizon_columns]) for row in rows])
+    con.execute("CREATE INDEX %s_mukey ON %s (mukey)" % (sg.component_table, sg.component_table))
+    con.execute("CREATE INDEX %s_cokey ON %s (cokey)" % (sg.component_table, sg.component_table))
+    con.execute("CREATE INDEX %s_cokey ON %s (cokey)" % (sg.chorizon_table, sg.chorizon_table))
+    con.commit()
+    con.close()
+    return mukey_list
+
+def timed(results, size, stage, items, func, *args):
+    '''Runs func(*args) with stdout silenced, records the timing and returns what func returned. items is
+    the number of items func handles, or a function giving it from what func returned'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        value = func(*args)
+    finally:
+        seconds = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+    if callable(items):
+        items = items(value)
+    results.append(dict(size=size, stage=stage, items=items, seconds=round(seconds, 4),
+                        per_second=round(items / seconds, 1) if seconds > 0 else None))
+    print '  {:<28} {:>9} items {:>9.3f} s {:>12} /s'.format(stage, items, seconds, results[-1]['per_second'])
+    return value
+
+def render_all(derived_dic, create):
+    '''Writes the soil files of every derived soil with create (create_file or create_957), as a colist run does.
+    Returns the number of soils written'''
+    written = 0
+    for cokey, derived in derived_dic.items():
+        try:
+            create(cokey, derived=derived)
+            written += 1
+        except Exception:
+            #soils without a usable horizon fail here in a real run too
+            pass
+    return written
+
+def ensemble(multipliers=(.5, 1, 2)):
+    '''A calibration ensemble of every combination of multipliers on ki, kr, keff and om, as --variants reads it'''
+    return [sg.severity_entry(dict(name='v%d' % i, ki=ki, kr=kr, keff=keff, om=om))
+            for i, (ki, kr, keff, om) in enumerate(itertools.product(multipliers, repeat=4))]
+
+def render_ensemble(derived_dic, variants):
+    '''Returns the number of soil files rendered'''
+    rendered = 0
+    for cokey, derived in derived_dic.items():
+        try:
+            rendered += len(sg.render_soil(cokey, derived, '95.7', severities=variants)[1])
+        except Exception:
+            pass
+    return rendered
+
+def derive_all(horizon_dic):
+    derived_dic = {}
+    for cokey, values_list in horizon_dic.items():
+        try:
+            derived_dic[cokey] = sg.sort_values(values_list)
+        except Exception:
+            #no horizons, or NULLs sort_values has no default for, as in a real run
+            pass
+    return derived_dic
+
+def textures(derived_dic):
+    for horizon, compname, bl_cl_dic in derived_dic.values():
+        for layer in horizon:
+            sand, clay = int(layer['sand']), int(layer['clay'])
+            sg.get_texture(sand, 100 - (sand + clay), clay)
+
+def texture_layers(derived_dic):
+    return [layer for horizon, compname, bl_cl_dic in derived_dic.values() for layer in horizon]
+
+def check_textures(layers, codes):
+    '''Checks classify_textures codes against get_texture'''
+    for layer, code in zip(layers, codes):
+        sand, clay = int(layer['sand']), int(layer['clay'])
+        if sg.texture_classes[code] != sg.get_texture(sand, 100 - (sand + clay), clay):
+            raise ValueError('classify_textures disagrees with get_texture at sand {}, clay {}'.format(sand, clay))
+
+def pipeline(mukeys, workers, prefetch=0):
+    with open(os.devnull, 'w') as soildic:
+        sg.run_pipeline('mukey', iter(mukeys), soildic, workers, prefetch=prefetch)
+
+def benchmark(size, database, out_dir, results):
+    '''Benchmarks each stage separately and end to end on a synthetic database of size mukeys'''
+    print 'Benchmarking {} mukeys ({})'.format(size, database)
+    sg.database_dir = database
+    sg.write_path = out_dir + os.sep
+    source = sg.open_source()
+    mukeys = [str(r[0]) for r in source.query("SELECT DISTINCT mukey FROM %s" % sg.component_table)]
+    sample = mukeys[:per_key_sample]
+
+    #one connection per mukey, as the per-key mulist loop opens them
+    timed(results, size, 'find_dominant_soil', len(sample), lambda: [sg.find_dominant_soil(mu) for mu in sample])
+    dominant_dic = timed(results, size, 'find_dominant_soils', len(mukeys), sg.find_dominant_soils, mukeys, source)
+    timed(results, size, 'select_components (top 3)', len(mukeys), sg.select_components, mukeys, source, None, 3)
+    timed(results, size, 'validate_keys', len(mukeys), sg.validate_keys, 'mukey', mukeys, source)
+    cokeys = [c for mu in mukeys for c in dominant_dic[mu]]
+    timed(results, size, 'fetch_data', len(sample), lambda: [sg.fetch_data(c, source) for c in cokeys[:per_key_sample]])
+    horizon_dic = timed(results, size, 'fetch_data_bulk', len(cokeys), sg.fetch_data_bulk, cokeys, source)
+    if sg.np is not None:
+        store_path = os.path.join(out_dir, 'synthetic' + sg.column_extension)
+        timed(results, size, 'import_columns', len(cokeys), sg.import_columns, store_path, source)
+        store = sg.open_source(store_path)
+        timed(results, size, 'fetch_data_bulk (columns)', len(cokeys), sg.fetch_data_bulk, cokeys, store)
+        store.close()
+        shutil.rmtree(store_path)
+    horizons = sum([len(v) for v in horizon_dic.values()])
+    derived_dic = timed(results, size, 'sort_values', horizons, derive_all, horizon_dic)
+    if sg.np is not None:
+        timed(results, size, 'sort_values_batch', horizons, sg.sort_values_batch, horizon_dic)
+    timed(results, size, 'get_texture', horizons, textures, derived_dic)
+    if sg.np is not None:
+        layers = texture_layers(derived_dic)
+        sand, clay = [layer['sand'] for layer in layers], [layer['clay'] for layer in layers]
+        check_textures(layers, timed(results, size, 'classify_textures', horizons, sg.classify_textures, sand, clay))
+    #soils that fail are not counted
+    written = lambda count: count
+    timed(results, size, 'create_file (7778)', written, render_all, derived_dic, sg.create_file)
+    timed(results, size, 'create_957 (95.7)', written, render_all, derived_dic, sg.create_957)
+    variants = ensemble()
+    timed(results, size, 'render ({} variants)'.format(len(variants)), written, render_ensemble, derived_dic, variants)
+    source.close()
+
+    for engine in ('scalar', 'numpy') if sg.np is not None else ('scalar',):
+        sg.engine = engine
+        timed(results, size, 'end to end ({})'.format(engine), len(mukeys), pipeline, mukeys, 1)
+        timed(results, size, 'end to end ({}, prefetch)'.format(engine), len(mukeys), pipeline, mukeys, 1, 2)
+        workers = min(sg.multiprocessing.cpu_count(), 8)
+        if workers > 1:
+            timed(results, size, 'end to end ({}, {} workers)'.format(engine, workers), len(mukeys), pipeline, mukeys, workers)
+    sg.engine = 'scalar'
+
+def git_version():
+    '''Returns the git commit of the benchmarked tree, if there is one'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, old_path):
+    '''Prints the speed of each stage relative to an earlier result file'''
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    old_results = dict([((r['size'], r['stage']), r) for r in old['results']])
+    print 'Compared with {} ({})'.format(old_path, old.get('version'))
+    for r in results:
+        o = old_results.get((r['size'], r['stage']))
+        if o and o['per_second'] and r['per_second']:
+            print '  {:>7} {:<28} {:>6.2f}x'.format(r['size'], r['stage'], r['per_second'] / o['per_second'])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', default='1000,10000,100000', help='Comma separated numbers of mukeys to benchmark')
+    parser.add_argument('-o', '--output', default='bench.json', help='Machine readable results (.json)')
+    parser.add_argument('-c', '--compare', help='An earlier result file to compare with')
+    parser.add_argument('-k', '--keep', help='Keep (and reuse) the synthetic databases in this directory')
+    parser.add_argument('-r', '--seed', type=int, default=1, help='Random seed of the synthetic data')
+    parser.add_argument('-d', '--database', help='Only write a synthetic database of the first size to this file')
+
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(',')]
+
+    if args.database:
+        make_database(args.database, sizes[0], args.seed)
+        print 'Wrote {} mukeys to {}'.format(sizes[0], args.database)
+        sys.exit()
+
+    work_dir = tempfile.mkdtemp(prefix='soilbench')
+    results = []
+    try:
+        for size in sizes:
+            database = os.path.join(args.keep or work_dir, 'synthetic_{}.sqlite'.format(size))
+            if not (args.keep and os.path.exists(database)):
+                start = time.time()
+                make_database(database, size, args.seed)
+                print 'Made synthetic database of {} mukeys in {:.1f} s'.format(size, time.time() - start)
+            out_dir = os.path.join(work_dir, 'sol_{}'.format(size))
+            os.mkdir(out_dir)
+            benchmark(size, database, out_dir, results)
+            shutil.rmtree(out_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = dict(version=git_version(), python=sys.version.split()[0], numpy=sg.np.__version__ if sg.np else None,
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'), seed=args.seed, results=results)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=1)
+    print 'Wrote ' + args.output
+    if args.compare:
+        compare(results, args.compare)
@@ -1,6 +1,16 @@
-import csv, pyodbc, time, argparse
-import math, sys, operator
-from collections import defaultdict
+import csv, json, time, argparse, sqlite3, multiprocessing, hashlib, threading, Queue
+import math, os, sys, operator, shutil, StringIO
+from collections import defaultdict, deque, namedtuple
+try:
+    import pyodbc
+except ImportError:
+    #only needed for the Access (.mdb) backend
+    pyodbc = None
+try:
+    import numpy as np
+except ImportError:
+    #only needed for the numpy engine (--engine numpy)
+    np = None
 '''
 soilgenFire
 v3.0F
@@ -27,6 +37,47 @@ input:
         (use only one cokey or colist options)
         colist [cokey_list] is a comma seperated list (.csv) of individual cokeys
         mulist [mukey_list] is a comma seperated list (.csv) of individual mukeys (dominant soil type will be chosen based upon percent composition)
+        -b/--bulk streams a colist or mulist through a batched pipeline (read keys -> batch -> fetch -> derive -> render -> write)
+            over one connection with chunked queries instead of one query per key; -n/--batch-size [N] keys per batch
+        -u/--dedup names soil files [soil_name]_[content hash] so different soils with the same name no longer overwrite
+            each other, renders identical soils once, and maps every mukey/cokey to its file in soildic.txt
+        -a/--archive [soils.pack] packs every soil file into one append-only archive plus an offset index (soils.pack.idx);
+            read single soils back with SoilArchive('soils.pack').get(mukey=..., severity='high')
+        -f/--manifest [manifest.jsonl] records each key generated (source row fingerprint, settings, files) as the run goes;
+            running again with the same manifest only regenerates keys whose source data or settings changed
+        -u, -a, -f, -r and -V run a colist or mulist through the --bulk pipeline (they do not apply to -c/-m); -a names files
+            by content as -u does, so every mukey/cokey in the index points at its own soil
+        -s/--severities [severities.json] adds or replaces burn severities, e.g. {"95.7": [{"name": "extreme", "soil": [1, 0.4, 3, 3, 1, 0.3], "layer": [1, 1, 0.3, 0.8, 1]}]}
+        -v/--variants [ensemble.csv] writes an ensemble of multiplier sets for every soil in place of the severities, one
+            [soil_name]_[name].sol per set: a .csv with a name column and columns named albedo, init_sat, ki, kr, tauc, keff,
+            sand, clay, om, cec, rocks (blank or missing = 1), or a .json list of severity entries; batches shrink to match
+        -p/--profile [profile.json] times each stage (connect, find_dominant_soils, fetch_data, sort_values, get_texture, render, write)
+            and counts connections, rows, horizons, defaults used and files/bytes written; prints a summary and writes it as json
+        -g/--grid [mukeys.asc or mukeys.npy] reads a mukey raster in chunks, generates each distinct mukey once through the
+            --bulk pipeline and writes -G/--grid-map [gridmap.csv] (mukey, pixels, percent, soil) and coverage statistics
+            (gridmap.json); -z/--nodata [value] overrides the grid's NODATA value
+        -x/--min-pct [PCT] and -y/--top [N] generate every component of a mukey with comppct_r >= PCT and/or its N largest
+            instead of only the dominant one; soildic.txt lines then read [soil_name],[mukey],[comppct_r]
+        -r/--prefetch [N] overlaps a --bulk run's stages: a thread reads the database up to N batches ahead (default 2)
+            while the main thread derives and renders, and a writer thread drains the rendered files
+        -w/--workers [N] spreads a colist or mulist over N processes, each with its own database connection
+        -V/--validate [validation.csv] checks each batch of a colist, mulist or grid as the --bulk pipeline reads it: the rows
+            read for the batch are scanned for what would make a key fail (no horizons, NULL depth or baseline fields, no
+            horizon with ksat >= 11, ...) and the rest of the batch is generated from them; the keys that would fail are
+            left out of the run and written to the .csv with their problems (summary in validation.json)
+        -S/--shard [i/N] generates only the keys of a colist or mulist that a stable hash puts in shard i of N, so N
+            nodes (each with its own --database if need be) split one list; output goes to -O/--output-dir
+            [shard_i_of_N]: sol/ (or the -a archive), soildic.txt, errors.txt and shard.json
+        -M/--merge [shard dirs] combines shard outputs into -O/--output-dir [merged]: one sol/, soildic.txt and
+            errors.txt, with soil names that shards generated differently renamed [soil_name]_[content hash],
+            and merge.json (shards missing, keys, errors, renamed soils)
+        -e/--engine numpy derives all horizons of a --bulk run at once with numpy (sort_values_batch); scalar (default) uses sort_values
+        -i/--import-sqlite [soils.sqlite] makes a local indexed copy of the tables; pass it as --database to run without ODBC
+        -j/--import-columns [soils.cols] builds a memory-mapped column store of the horizons (needs numpy); pass it as --database
+            and every --workers process maps the same files instead of querying
+    library:
+        SoilGenerator('soils.sqlite').mukey_soil(mukey, '95.7') returns the soil file text of every severity in memory,
+        without writing files or reading the module settings (see SoilGenerator)
         
 output: a WEPP soil file ([soil_name].sol)
 '''
@@ -40,7 +91,7 @@ assumed_albedo = 0.23
 assumed_initalsat = 0.753
 #path to output .sol (none if in current directory)
 write_path = 'sol/'
-#directory of the soils database if not in current directory (.mdb)
+#directory of the soils database if not in current directory (.mdb, or .sqlite made with --import-sqlite)
 database_dir = 'STATSGO2_AZ.mdb'
 
 chorizon_table = 'chorizon'
@@ -50,359 +101,1781 @@ component_table = 'component'
 #construct the cokey_dic using defaultdict()
 cokey_dic = defaultdict(list)
 
-def find_dominant_soil(mukey):
+#per-stage timers and counters of a --profile run (a Profile), None when profiling is off
+profile = None
+
+#horizon derivation engine: 'scalar' (sort_values, one horizon at a time) or 'numpy' (sort_values_batch)
+engine = 'scalar'
+
+class Profile(object):
+    '''Per-stage timers and counters for --profile. Instrumented code checks "profile is not None" first,
+    so the hooks cost next to nothing when profiling is off'''
+    def __init__(self):
+        self.start = time.time()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def add(self, stage, start):
+        '''Adds the time since start (a time.time()) to a stage'''
+        self.seconds[stage] += time.time() - start
+        self.calls[stage] += 1
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def take(self):
+        '''Returns the timers and counters gathered so far and starts over (how workers hand them back)'''
+        taken = (dict(self.seconds), dict(self.calls), dict(self.counts))
+        self.seconds.clear(); self.calls.clear(); self.counts.clear()
+        return taken
+
+    def merge(self, taken):
+        seconds, calls, counts = taken
+        for stage in seconds:
+            self.seconds[stage] += seconds[stage]
+            self.calls[stage] += calls[stage]
+        for name in counts:
+            self.counts[name] += counts[name]
+
+    def report(self, path):
+        '''Prints a summary and writes it to path as json. Stage times add up over worker processes,
+        and get_texture is also part of render'''
+        wall = time.time() - self.start
+        print 'Profile ({:.2f} s wall clock)'.format(wall)
+        for stage in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            print '  {:<22} {:>10.3f} s {:>9} calls {:>6.1f}%'.format(stage, self.seconds[stage], self.calls[stage], 100 * self.seconds[stage] / max(wall, 1e-6))
+        for name in sorted(self.counts):
+            print '  {:<22} {:>10}'.format(name, self.counts[name])
+        with open(path, 'w') as report:
+            json.dump(dict(wall_seconds=wall, stages=dict([(stage, dict(seconds=self.seconds[stage], calls=self.calls[stage])) for stage in self.seconds]),
+                           counts=self.counts), report, indent=1, sort_keys=True)
+        print 'Wrote profile to ' + path
+
+#number of keys bound into each IN (...) list when fetching a whole key list at once
+bulk_chunk = 250
+
+#query to retrieve horizon data from the database
+#             cokey  chkey  depth     smr_db        ksat    sand         clay         om    ec      d      rocks10     rocks3-10    designatio   s            fc           wp             bl_cl_ki  name
+#             0      1      2         3             4       5            6            7     8       9      10          11           12           13           14           15             16        17        
+#
+#SQL = "SELECT cokey, chkey, hzdepb_r, dbthirdbar_r, ksat_r, sandtotal_r, claytotal_r, om_r, ecec_r, awc_l, fraggt10_r, frag3to10_r, desgnmaster, sieveno10_r, wthirdbar_r, wfifteenbar_r, sandvf_r, compname FROM " + cokey_table + " WHERE cokey = '" + cokey + "'"
+horizon_select = "SELECT co.mukey, ch.cokey, ch.chkey, ch.hzname, co.compname, co.comppct_r, ch.hzdepb_r, ch.dbthirdbar_r, ch.ksat_r, ch.sandtotal_r, ch.claytotal_r, ch.om_r, ch.ecec_r, ch.awc_l, ch.fraggt10_r, ch.frag3to10_r, ch.desgnmaster, ch.sieveno10_r, ch.wthirdbar_r, ch.wfifteenbar_r, ch.sandvf_r FROM %s AS ch %s %s AS co ON ch.cokey = co.cokey WHERE ch.cokey "
+
+#columns (and SQLite types) copied by import_sqlite
+component_columns = (('mukey', 'TEXT'), ('cokey', 'TEXT'), ('compname', 'TEXT'), ('comppct_r', 'INTEGER'))
+chorizon_columns = (('cokey', 'TEXT'), ('chkey', 'TEXT'), ('hzname', 'TEXT'), ('hzdepb_r', 'REAL'), ('dbthirdbar_r', 'REAL'),
+                    ('ksat_r', 'REAL'), ('sandtotal_r', 'REAL'), ('claytotal_r', 'REAL'), ('om_r', 'REAL'), ('ecec_r', 'REAL'),
+                    ('awc_l', 'REAL'), ('fraggt10_r', 'REAL'), ('frag3to10_r', 'REAL'), ('desgnmaster', 'TEXT'),
+                    ('sieveno10_r', 'REAL'), ('wthirdbar_r', 'REAL'), ('wfifteenbar_r', 'REAL'), ('sandvf_r', 'REAL'))
+
+#file extensions opened with the SQLite backend, anything else goes through ODBC
+sqlite_extensions = ('.sqlite', '.sqlite3', '.db')
+
+#extension of the memory-mapped column store directories made by import_columns
+column_extension = '.cols'
+
+class SoilSource(object):
+    '''A soils database holding the component and chorizon tables over one open connection.
+    Subclasses open the connection; queries use qmark (?) parameters and rows allow attribute access'''
+    #join between the chorizon and component tables used by fetch_data_bulk
+    join = 'RIGHT JOIN'
+
+    def __init__(self, path, tables=None):
+        self.path = path
+        #component and chorizon table names, the module settings unless given
+        self.component_table, self.chorizon_table = tables or (component_table, chorizon_table)
+        start = time.time() if profile is not None else None
+        self.con = self.connect()
+        if start is not None:
+            profile.add('connect', start)
+            profile.count('connections opened')
+
+    def connect(self):
+        raise NotImplementedError
+
+    def query(self, SQL, params=()):
+        cur = self.con.cursor()
+        rows = cur.execute(SQL, params).fetchall()
+        cur.close()
+        if profile is not None:
+            profile.count('queries')
+            profile.count('rows fetched', len(rows))
+        return rows
+
+    def close(self):
+        self.con.close()
+
+class OdbcSource(SoilSource):
+    '''Microsoft Access (.mdb) database read through pyodbc'''
+    def connect(self):
+        if pyodbc is None:
+            raise ImportError('pyodbc is required to read %s' % self.path)
+        MDB = self.path; DRV = '{Microsoft Access Driver (*.mdb)}'; PWD = 'pw'
+        return pyodbc.connect('DRIVER={};DBQ={};PWD={}'.format(DRV,MDB,PWD))
+
+class SqliteSource(SoilSource):
+    '''Local SQLite copy of the component and chorizon tables made by import_sqlite'''
+    #the WHERE on ch.cokey makes the RIGHT JOIN an inner join anyway, and older SQLite lacks RIGHT JOIN
+    join = 'JOIN'
+
+    def connect(self):
+        if not os.path.exists(self.path):
+            raise IOError('No such soils database: %s' % self.path)
+        con = sqlite3.connect(self.path)
+        con.text_factory = str
+        con.row_factory = sqlite_row
+        return con
+
+_row_types = {}
+def sqlite_row(cur, row):
+    '''sqlite3 row factory returning namedtuples, so rows read like pyodbc rows'''
+    names = tuple([d[0] for d in cur.description])
+    if names not in _row_types:
+        _row_types[names] = namedtuple('Row', names)
+    return _row_types[names](*row)
+
+def open_source(path=None, tables=None):
+    '''Returns the data source for path (database_dir by default), chosen by file extension.
+    tables is a (component table, chorizon table) pair, component_table and chorizon_table by default'''
+    path = database_dir if path is None else path
+    if os.path.splitext(path.rstrip('/\\'))[1].lower() == column_extension:
+        return ColumnStore(path, tables)
+    if os.path.splitext(path)[1].lower() in sqlite_extensions:
+        return SqliteSource(path, tables)
+    return OdbcSource(path, tables)
+
+def import_sqlite(sqlite_path, source=None):
+    '''One-time copy of the component and chorizon columns used by soilgen into a SQLite file,
+    indexed on mukey and cokey'''
+    own_source = source is None
+    if own_source:
+        source = open_source()
+    if isinstance(source, ColumnStore):
+        if own_source:
+            source.close()
+        raise ValueError('%s is a column store; import the SQLite copy from the database it was made from' % source.path)
+    if os.path.exists(sqlite_path):
+        os.remove(sqlite_path)
+    out = sqlite3.connect(sqlite_path)
+    for table, columns in ((component_table, component_columns), (chorizon_table, chorizon_columns)):
+        out.execute("CREATE TABLE %s (%s)" % (table, ', '.join(['%s %s' % c for c in columns])))
+        cur = source.con.cursor()
+        cur.execute("SELECT %s FROM %s" % (', '.join([c[0] for c in columns]), table))
+        keys = [i for i, c in enumerate(columns) if c[0] in ('mukey', 'cokey', 'chkey')]
+        rows = (tuple([str(v) if i in keys and v is not None else v for i, v in enumerate(row)]) for row in cur)
+        out.executemany("INSERT INTO %s VALUES (%s)" % (table, ','.join('?' * len(columns))), rows)
+        cur.close()
+        print 'Copied %s rows from %s' % (out.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0], table)
+    out.execute("CREATE INDEX %s_mukey ON %s (mukey)" % (component_table, component_table))
+    out.execute("CREATE INDEX %s_cokey ON %s (cokey)" % (component_table, component_table))
+    out.execute("CREATE INDEX %s_cokey ON %s (cokey)" % (chorizon_table, chorizon_table))
+    out.commit()
+    out.close()
+    if own_source:
+        source.close()
+
+#numeric chorizon columns of a column store, in the bit order of its NULL masks
+store_columns = ('hzdepb_r', 'dbthirdbar_r', 'ksat_r', 'sandtotal_r', 'claytotal_r', 'om_r', 'ecec_r', 'awc_l',
+                 'fraggt10_r', 'frag3to10_r', 'sieveno10_r', 'wthirdbar_r', 'wfifteenbar_r', 'sandvf_r')
+
+def import_columns(store_path, source=None):
+    '''One-time copy of the horizons fetch_data reads into a column store directory (see ColumnStore).
+    Horizons are read through fetch_data_bulk, so each cokey keeps the row order the database gives it'''
+    if np is None:
+        raise ImportError('numpy is required for a column store')
+    own_source = source is None
+    if own_source:
+        source = open_source()
+    components = sorted([(str(c.mukey), str(c.cokey), c.comppct_r, str(c.compname)) for c in
+                         source.query("SELECT mukey, cokey, comppct_r, compname FROM %s" % source.component_table)])
+    cokeys = sorted(set([c[1] for c in components]))
+    names = dict([(c[1], c[3]) for c in components])
+    rows = []
+    starts = [0]
+    for chunk in chunks(cokeys, bulk_chunk):
+        horizon_dic = fetch_data_bulk(chunk, source)
+        for cokey in chunk:
+            rows.extend(horizon_dic[cokey])
+            starts.append(len(rows))
+    if own_source:
+        source.close()
+
+    arrays = dict(cokeys=np.array(cokeys, dtype=str), starts=np.array(starts, dtype=np.int64),
+                  chkey=np.array([h.chkey for h in rows], dtype=str), desgnmaster=np.array([h.desgnmaster for h in rows], dtype=str),
+                  comp_mukey=np.array([c[0] for c in components], dtype=str), comp_cokey=np.array([c[1] for c in components], dtype=str),
+                  comp_pct=np.array([np.nan if c[2] is None else c[2] for c in components], dtype=float),
+                  comp_name=np.array([c[3] for c in components], dtype=str), names=np.array([names[c] for c in cokeys], dtype=str))
+    nulls = np.zeros(len(rows), dtype=np.uint16)
+    for bit, field in enumerate(store_columns):
+        values = [getattr(h, field) for h in rows]
+        nulls |= np.array([v is None for v in values], dtype=np.uint16) << bit
+        arrays[field] = np.array([np.nan if v is None else v for v in values], dtype=float)
+    arrays['nulls'] = nulls
+    #mukey index: the first component row of each mukey (components are sorted by mukey, then cokey)
+    mukeys, first = np.unique(arrays['comp_mukey'], return_index=True)
+    arrays['mukeys'] = mukeys
+    arrays['mu_starts'] = np.append(first, len(components)).astype(np.int64)
+
+    #built beside the target and renamed into place, so a store is either complete or absent
+    building = store_path.rstrip('/\\') + '.building'
+    if os.path.exists(building):
+        shutil.rmtree(building)
+    os.mkdir(building)
+    for name, array in arrays.items():
+        np.save(os.path.join(building, name + '.npy'), array)
+    with open(os.path.join(building, 'meta.json'), 'w') as meta:
+        json.dump(dict(horizons=len(rows), components=len(components), columns=store_columns,
+                       tables=[source.component_table, source.chorizon_table]), meta, indent=1)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(building, store_path)
+    print 'Wrote {} horizons of {} components to {}'.format(len(rows), len(components), store_path)
+
+class ColumnStore(SoilSource):
+    '''Read-only column store made by import_columns: one .npy file per chorizon column (NaN and a bit in
+    the nulls mask for NULL), the horizons of each cokey in one row range (cokeys sorted, with row starts
+    and compname), and the components sorted by mukey with a mukey index. Files are memory-mapped, so every worker
+    process opening the store shares the same pages and a cokey's horizons are a slice. It has no SQL:
+    fetch_data_bulk and select_components read it directly'''
+    def connect(self):
+        if np is None:
+            raise ImportError('numpy is required to read %s' % self.path)
+        if not os.path.exists(os.path.join(self.path, 'meta.json')):
+            raise IOError('No such column store: %s' % self.path)
+        self.arrays = {}
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                self.arrays[name[:-4]] = np.load(os.path.join(self.path, name), mmap_mode='r')
+        return None
+
+    def query(self, SQL, params=()):
+        raise NotImplementedError('A column store has no SQL; make a .sqlite copy with --import-sqlite instead')
+
+    def close(self):
+        self.arrays = {}
+
+    def row_ranges(self, keys, index, starts):
+        '''Returns the (start, stop) row range of each key in a sorted index, (0, 0) when missing'''
+        keys = np.array(keys, dtype=str)
+        found = np.searchsorted(index, keys)
+        inside = found < len(index)
+        found = np.where(inside, found, 0)
+        hit = inside & (np.asarray(index)[found] == keys) if len(index) else inside
+        begin = np.where(hit, np.asarray(starts)[found], 0)
+        end = np.where(hit, np.asarray(starts)[found + 1], 0)
+        return zip(begin.tolist(), end.tolist())
+
+    def fetch_horizons(self, cokeys):
+        '''Returns a dictionary of cokey -> Horizon list, as fetch_data_bulk'''
+        a = self.arrays
+        cokeys = sorted(set([str(c) for c in cokeys]))
+        horizon_dic = defaultdict(list)
+        if not cokeys:
+            return horizon_dic
+        ranges = self.row_ranges(cokeys, a['cokeys'], a['starts'])
+        rows = np.concatenate([np.arange(begin, end) for begin, end in ranges] + [np.zeros(0, dtype=np.int64)])
+        nulls = a['nulls'][rows]
+        columns = []
+        for bit, field in enumerate(store_columns):
+            values = a[field][rows].tolist()
+            missing = ((nulls >> bit) & 1).tolist()
+            columns.append([None if m else v for v, m in zip(values, missing)])
+        chkeys = a['chkey'][rows].tolist()
+        designations = a['desgnmaster'][rows].tolist()
+        #compname by the place of each cokey in the cokey index (only read for cokeys with horizons)
+        places = np.minimum(np.searchsorted(a['cokeys'], np.array(cokeys, dtype=str)), len(a['cokeys']) - 1)
+        names = a['names'][places].tolist() if len(a['cokeys']) else [''] * len(cokeys)
+        i = 0
+        for cokey, name, (begin, end) in zip(cokeys, names, ranges):
+            for r in range(i, i + end - begin):
+                horizon_dic[cokey].append(Horizon(cokey, chkeys[r], columns[0][r], columns[1][r], columns[2][r],
+                                                  columns[3][r], columns[4][r], columns[5][r], columns[6][r], columns[7][r],
+                                                  columns[8][r], columns[9][r], designations[r], columns[10][r],
+                                                  columns[11][r], columns[12][r], columns[13][r], name))
+            i += end - begin
+        return horizon_dic
+
+    def select_components(self, mukeys, min_pct=None, top=None):
+        '''Returns a dictionary of mukey -> [(cokey, comppct_r), ...], as select_components does over SQL'''
+        a = self.arrays
+        mukeys = sorted(set([str(mu) for mu in mukeys]))
+        components = {}
+        if not mukeys:
+            return components
+        for mukey, (begin, end) in zip(mukeys, self.row_ranges(mukeys, a['mukeys'], a['mu_starts'])):
+            pcts = [None if p != p else int(p) if p == int(p) else p for p in a['comp_pct'][begin:end].tolist()]
+            soils = [(c, p) for c, p in zip(a['comp_cokey'][begin:end].tolist(), pcts) if p is not None]
+            if min_pct is None and top is None:
+                max_pct = max([p for c, p in soils]) if soils else None
+                soils = [(c, p) for c, p in soils if p == max_pct]
+            else:
+                if min_pct is not None:
+                    soils = [(c, p) for c, p in soils if p >= min_pct]
+                else:
+                    #NULL percents sort last, as in ORDER BY comppct_r DESC
+                    soils += [(c, p) for c, p in zip(a['comp_cokey'][begin:end].tolist(), pcts) if p is None]
+                soils.sort(key=lambda soil: (soil[1] is None, -(soil[1] or 0), soil[0]))
+                if top is not None:
+                    soils = soils[:top]
+            components[mukey] = soils
+        return components
+
+def chunks(keys, size):
+    '''Yields successive slices of at most size keys'''
+    for i in range(0, len(keys), size):
+        yield keys[i:i + size]
+
+def find_dominant_soil(mukey, source=None):
     '''Returns the cokey(s) of the dominant soil(s) in the mukey as a list'''
-    MDB = database_dir; DRV = '{Microsoft Access Driver (*.mdb)}'; PWD = 'pw'
-    con = pyodbc.connect('DRIVER={};DBQ={};PWD={}'.format(DRV,MDB,PWD))
-    cur = con.cursor()
-    SQL = "SELECT mukey, cokey, comppct_r FROM %s WHERE mukey = '%s' ORDER BY cokey" %(component_table,str(mukey))
-    soils = cur.execute(SQL).fetchall()
-    soils_list = []
-    pct_list = []
-    for s in soils:
-        pct_list.append(s.comppct_r)
-        soils_list.append(dict([('mukey', str(s.mukey)),('cokey', str(s.cokey)),('pct', str(s.comppct_r)),]))
-    cokey_list = []
-    for s in soils_list:
-        if int(s['pct']) == int(max(pct_list)):
-            cokey_list.append(s['cokey'])
-    return cokey_list
-        
-def fetch_data(cokey):
-    '''Returns a dictionary of dictionaries, with the lower dictionaries representing one horizon layer'''    
-    #open ODBC connections
-    MDB = database_dir; DRV = '{Microsoft Access Driver (*.mdb)}'; PWD = 'pw'
-    con = pyodbc.connect('DRIVER={};DBQ={};PWD={}'.format(DRV,MDB,PWD))
-    cur = con.cursor()
-    
-    
-    
-    #query to retrieve data from the database
-    #             cokey  chkey  depth     smr_db        ksat    sand         clay         om    ec      d      rocks10     rocks3-10    designatio   s            fc           wp             bl_cl_ki  name
-    #             0      1      2         3             4       5            6            7     8       9      10          11           12           13           14           15             16        17        
-    #
-    #SQL = "SELECT cokey, chkey, hzdepb_r, dbthirdbar_r, ksat_r, sandtotal_r, claytotal_r, om_r, ecec_r, awc_l, fraggt10_r, frag3to10_r, desgnmaster, sieveno10_r, wthirdbar_r, wfifteenbar_r, sandvf_r, compname FROM " + cokey_table + " WHERE cokey = '" + cokey + "'"
-    SQL = "SELECT co.mukey, ch.cokey, ch.chkey, ch.hzname, co.compname, co.comppct_r, ch.hzdepb_r, ch.dbthirdbar_r, ch.ksat_r, ch.sandtotal_r, ch.claytotal_r, ch.om_r, ch.ecec_r, ch.awc_l, ch.fraggt10_r, ch.frag3to10_r, ch.desgnmaster, ch.sieveno10_r, ch.wthirdbar_r, ch.wfifteenbar_r, ch.sandvf_r FROM " + chorizon_table + " AS ch RIGHT JOIN " + component_table + " AS co ON ch.cokey = co.cokey WHERE ch.cokey = '" + cokey + "'"
-
-    horizons = cur.execute(SQL).fetchall()
-    horizon_list = []
-    for horizon in horizons:
-        #populate the  dictionary of dictionaries by setting chkey as the main dictictionary key
-        horizon_list.append(dict([('cokey', str(horizon.cokey)),
-                                           ('chkey', str(horizon.chkey)),
-                                           ('hzdepb_r', (horizon.hzdepb_r)),
-                                           ('dbthirdbar_r', (horizon.dbthirdbar_r)),
-                                           ('ksat_r', (horizon.ksat_r)),
-                                           ('sandtotal_r', (horizon.sandtotal_r)),
-                                           ('claytotal_r', (horizon.claytotal_r)),
-                                           ('om_r', (horizon.om_r)),
-                                           ('ecec_r', (horizon.ecec_r)),
-                                           ('awc_l', (horizon.awc_l)),
-                                           ('fraggt10_r', (horizon.fraggt10_r)),    
-                                           ('frag3to10_r', (horizon.frag3to10_r)),
-                                           ('desgnmaster', str(horizon.desgnmaster)),
-                                           ('sieveno10_r', (horizon.sieveno10_r)),
-                                           ('wthirdbar_r', (horizon.wthirdbar_r)),
-                                           ('wfifteenbar_r', (horizon.wfifteenbar_r)),
-                                           ('sandvf_r', (horizon.sandvf_r)),
-                                           ('compname', str(horizon.compname))]))
-    
-    #close ODBC connections
-    cur.close()
-    con.close()
-    
-    
-    return horizon_list
+    return find_dominant_soils([mukey], source)[str(mukey)]
+
+def find_dominant_soils(mukeys, source=None):
+    '''Returns a dictionary of mukey -> list of dominant cokeys for a whole mukey list,
+    reusing one data source and querying bulk_chunk mukeys at a time'''
+    components = select_components(mukeys, source)
+    return dict([(mukey, [cokey for cokey, pct in components[mukey]]) for mukey in components])
+
+def select_components(mukeys, source=None, min_pct=None, top=None):
+    '''Returns a dictionary of mukey -> [(cokey, comppct_r), ...] for a whole mukey list, resolved in the
+    database with one set-based query per bulk_chunk mukeys. By default each mukey gets its dominant
+    component(s): the largest comppct_r (grouped max), every component sharing it on a tie. With min_pct it
+    gets every component with comppct_r >= min_pct, and with top its top components by comppct_r (ties
+    broken by cokey); both may be given. Lists run from the largest comppct_r down, then by cokey, and
+    mukeys without components map to an empty list'''
+    own_source = source is None
+    if own_source:
+        source = open_source()
+    start = time.time() if profile is not None else None
+    mukeys = [str(mu) for mu in mukeys]
+    components = dict([(mukey, []) for mukey in mukeys])
+    if isinstance(source, ColumnStore):
+        components.update(source.select_components(mukeys, min_pct, top))
+    else:
+        for chunk in chunks(sorted(set(mukeys)), bulk_chunk):
+            marks = ','.join('?' * len(chunk))
+            if min_pct is None and top is None:
+                SQL = ("SELECT co.mukey, co.cokey, co.comppct_r FROM %s AS co INNER JOIN "
+                       "(SELECT mukey, MAX(comppct_r) AS max_pct FROM %s WHERE mukey IN (%s) GROUP BY mukey) AS m "
+                       "ON (co.mukey = m.mukey AND co.comppct_r = m.max_pct) ORDER BY co.mukey, co.cokey"
+                       % (source.component_table, source.component_table, marks))
+                params = chunk
+            else:
+                SQL = "SELECT mukey, cokey, comppct_r FROM %s WHERE mukey IN (%s)" % (source.component_table, marks)
+                params = list(chunk)
+                if min_pct is not None:
+                    SQL += " AND comppct_r >= ?"
+                    params.append(min_pct)
+                SQL += " ORDER BY mukey, comppct_r DESC, cokey"
+            for s in source.query(SQL, params):
+                soils = components[str(s.mukey)]
+                if top is None or len(soils) < top:
+                    soils.append((str(s.cokey), s.comppct_r))
+    if own_source:
+        source.close()
+    if start is not None:
+        profile.add('find_dominant_soils', start)
+    return components
+
+class Record(object):
+    '''Base of the compact (__slots__, no per-record dictionary) horizon records. Fields are set in
+    __slots__ order and also read like the dictionaries the records replace: record['field'], keys()
+    and dict(record)'''
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(['%s=%r' % (f, getattr(self, f)) for f in self.__slots__]))
+
+#chorizon (and compname) values of a horizon as read by fetch_data
+horizon_fields = ('cokey', 'chkey', 'hzdepb_r', 'dbthirdbar_r', 'ksat_r', 'sandtotal_r', 'claytotal_r', 'om_r', 'ecec_r',
+                  'awc_l', 'fraggt10_r', 'frag3to10_r', 'desgnmaster', 'sieveno10_r', 'wthirdbar_r', 'wfifteenbar_r',
+                  'sandvf_r', 'compname')
+
+class Horizon(Record):
+    '''One horizon row as used by sort_values'''
+    __slots__ = horizon_fields
+
+def horizon_record(horizon):
+    '''Returns one horizon row of the database as a Horizon'''
+    record = Horizon()
+    record.cokey = str(horizon.cokey)
+    record.chkey = str(horizon.chkey)
+    record.hzdepb_r = horizon.hzdepb_r
+    record.dbthirdbar_r = horizon.dbthirdbar_r
+    record.ksat_r = horizon.ksat_r
+    record.sandtotal_r = horizon.sandtotal_r
+    record.claytotal_r = horizon.claytotal_r
+    record.om_r = horizon.om_r
+    record.ecec_r = horizon.ecec_r
+    record.awc_l = horizon.awc_l
+    record.fraggt10_r = horizon.fraggt10_r
+    record.frag3to10_r = horizon.frag3to10_r
+    record.desgnmaster = str(horizon.desgnmaster)
+    record.sieveno10_r = horizon.sieveno10_r
+    record.wthirdbar_r = horizon.wthirdbar_r
+    record.wfifteenbar_r = horizon.wfifteenbar_r
+    record.sandvf_r = horizon.sandvf_r
+    record.compname = str(horizon.compname)
+    return record
+
+def fetch_data(cokey, source=None):
+    '''Returns a list of Horizon records, one per horizon layer'''    
+    return fetch_data_bulk([cokey], source)[str(cokey)]
+
+def fetch_data_bulk(cokeys, source=None):
+    '''Returns a dictionary of cokey -> horizon list (as returned by fetch_data) for a whole
+    cokey list, reusing one data source and querying bulk_chunk cokeys at a time'''
+    own_source = source is None
+    if own_source:
+        source = open_source()
+    start = time.time() if profile is not None else None
+    horizon_dic = defaultdict(list)
+    if isinstance(source, ColumnStore):
+        horizon_dic.update(source.fetch_horizons(cokeys))
+    else:
+        for chunk in chunks(sorted(set([str(c) for c in cokeys])), bulk_chunk):
+            SQL = horizon_select % (source.chorizon_table, source.join, source.component_table) + "IN (%s)" % ','.join('?' * len(chunk))
+            #rows keep the order the database returns them in, grouped by cokey
+            for horizon in source.query(SQL, chunk):
+                horizon_dic[str(horizon.cokey)].append(horizon_record(horizon))
+    if start is not None:
+        profile.add('fetch_data', start)
+    if own_source:
+        source.close()
+    return horizon_dic
        
-def sort_values(values_list): 
+#WEPP layer values of a horizon derived by sort_values
+layer_fields = ('depth', 'smr_bd', 'sand', 'clay', 'om', 'cec', 'rocks', 'ksat', 'anisotropy', 'fc', 'wp')
+
+class Layer(Record):
+    '''The WEPP layer values of one horizon'''
+    __slots__ = layer_fields
+
+    def __init__(self, depth, smr_bd, sand, clay, om, cec, rocks, ksat, anisotropy, fc, wp):
+        self.depth = depth; self.smr_bd = smr_bd; self.sand = sand; self.clay = clay; self.om = om; self.cec = cec
+        self.rocks = rocks; self.ksat = ksat; self.anisotropy = anisotropy; self.fc = fc; self.wp = wp
+
+def sort_values(values_list, verbose=True): 
     '''Retrieves horizon data (h1, h2, h3, ...) from the cokey_dic under the defined cokey as well as associated
     composition name and albedo values
-    returns an array of dictionaries and a dictionary'''
+    returns an array of Layer records (by depth) and a dictionary. verbose=False keeps the soil name and
+    default value warnings off stdout'''
+    start = time.time() if profile is not None else None
     horizon_arr = []
     layers_array = []
     compname = ''
     for horizon in values_list:
         
         #corrected variables
-        rocks_soil = ( 0.0 if horizon['fraggt10_r'] is None else horizon['fraggt10_r']) + (0.0 if horizon['frag3to10_r'] is None else horizon['frag3to10_r'])
-        smr_pct_rocks = 0.0 if horizon['desgnmaster'] is 'O' else (100-rocks_soil)/100*(100-(0.0 if horizon['sieveno10_r'] is None else horizon['sieveno10_r']))+rocks_soil
+        rocks_soil = ( 0.0 if horizon.fraggt10_r is None else horizon.fraggt10_r) + (0.0 if horizon.frag3to10_r is None else horizon.frag3to10_r)
+        smr_pct_rocks = 0.0 if horizon.desgnmaster is 'O' else (100-rocks_soil)/100*(100-(0.0 if horizon.sieveno10_r is None else horizon.sieveno10_r))+rocks_soil
         #corrected field capacity
-        fc_no_rocks = 0.0 if horizon['wthirdbar_r'] is None or rocks_soil is None else horizon['wthirdbar_r']/(100-rocks_soil)*100
+        fc_no_rocks = 0.0 if horizon.wthirdbar_r is None or rocks_soil is None else horizon.wthirdbar_r/(100-rocks_soil)*100
         #corrected wilting point
-        wp_no_rocks = 0.0 if horizon['wfifteenbar_r'] is None or rocks_soil is None else horizon['wfifteenbar_r']/(100-rocks_soil)*100
+        wp_no_rocks = 0.0 if horizon.wfifteenbar_r is None or rocks_soil is None else horizon.wfifteenbar_r/(100-rocks_soil)*100
 
-        depth = round(horizon['hzdepb_r']*10, 1)
-        try: smr_bd = round(horizon['dbthirdbar_r'],2) 
+        depth = round(horizon.hzdepb_r*10, 1)
+        try: smr_bd = round(horizon.dbthirdbar_r,2) 
         except: 
             smr_bd = 0.0 #defaut
-            print '    Warning! Using default smr_bd value'
-        try: sand = round(horizon['sandtotal_r'], 1)
+            if verbose: print '    Warning! Using default smr_bd value'
+            if profile is not None: profile.count('default smr_bd')
+        try: sand = round(horizon.sandtotal_r, 1)
         except: 
             sand = 55.0 #defaut
-            print '    Warning! Using default sand value'
-        try: clay = round(horizon['claytotal_r'],1)
+            if verbose: print '    Warning! Using default sand value'
+            if profile is not None: profile.count('default sand')
+        try: clay = round(horizon.claytotal_r,1)
         except: 
             clay = 10.0 #defaut
-            print '    Warning! Using default clay value'
-        try: om = round(horizon['om_r'],1)
+            if verbose: print '    Warning! Using default clay value'
+            if profile is not None: profile.count('default clay')
+        try: om = round(horizon.om_r,1)
         except: 
             om = 5.0 #defaut
-            print '    Warning! Using default om value'
-        try: cec = round(horizon['ecec_r'],1)
+            if verbose: print '    Warning! Using default om value'
+            if profile is not None: profile.count('default om')
+        try: cec = round(horizon.ecec_r,1)
         except: 
             cec = 15.0 #defaut
-            print '    Warning! Using default cec value'
+            if verbose: print '    Warning! Using default cec value'
+            if profile is not None: profile.count('default cec')
         try: rocks = round(smr_pct_rocks, 1)
         except: 
             rocks = 25.0
-            print '    Warning! Using default smr_pct_rocks value'
+            if verbose: print '    Warning! Using default smr_pct_rocks value'
+            if profile is not None: profile.count('default rocks')
         
         #
         
-        ksat = round(horizon['ksat_r']*3.6, 2) if horizon['ksat_r'] is not None else 0
-        anisotropy = 1 if horizon['hzdepb_r']>50 else 10
-        fc = round(((horizon['wfifteenbar_r'] if horizon['wfifteenbar_r'] is not None else 0) + horizon['awc_l']*100)/100, 3) if fc_no_rocks is None else round(fc_no_rocks/100, 3)
+        ksat = round(horizon.ksat_r*3.6, 2) if horizon.ksat_r is not None else 0
+        anisotropy = 1 if horizon.hzdepb_r>50 else 10
+        fc = round(((horizon.wfifteenbar_r if horizon.wfifteenbar_r is not None else 0) + horizon.awc_l*100)/100, 3) if fc_no_rocks is None else round(fc_no_rocks/100, 3)
         wp =  0 if wp_no_rocks is None else round(wp_no_rocks/100, 3)
         
         #baseline cropland variables        
-        bl_cl_keff = ('' if horizon['sandtotal_r'] is None else (-0.265+0.0086 * pow(horizon['sandtotal_r'],1.8)+11.46*pow(4 if horizon['ecec_r'] is None else horizon['ecec_r'],(-0.75)) if horizon['claytotal_r'] <= 40 else 0.0066*math.exp(244/horizon['claytotal_r'])))
+        bl_cl_keff = ('' if horizon.sandtotal_r is None else (-0.265+0.0086 * pow(horizon.sandtotal_r,1.8)+11.46*pow(4 if horizon.ecec_r is None else horizon.ecec_r,(-0.75)) if horizon.claytotal_r <= 40 else 0.0066*math.exp(244/horizon.claytotal_r)))
 #        IF(AI33="","na",IF(BJ33<=40,-0.265+0.0086*AI33^1.8+11.46*IF(EA33="",4,EA33)^(-0.75),0.0066*EXP(244/BJ33)))
-        bl_cl_ki = ('' if horizon['sandtotal_r'] is None else round((2728000 + 192100 * min(40,horizon['sandvf_r'])), 0) if horizon['sandtotal_r'] > 30 else round(6054000-55130*max(10,horizon['claytotal_r']), 0))
-        bl_cl_kr = ('' if horizon['sandtotal_r'] is None else (0.00197 + 0.0003 * min(40,horizon['sandvf_r']) + 0.3863 * math.exp(-1.84 * max(0.35,horizon['om_r'])) if horizon['sandtotal_r'] > 30 else 0.0069 + 0.134 * math.exp(-0.2 * max(10,horizon['claytotal_r']))))
-        bl_cl_tauc = ('' if horizon['sandtotal_r'] is None else ((2.67 + 0.065 * min(40,horizon['claytotal_r']) - 0.058 * min(40,horizon['sandvf_r'])) if horizon['sandtotal_r'] > 30 else 3.5))
+        bl_cl_ki = ('' if horizon.sandtotal_r is None else round((2728000 + 192100 * min(40,horizon.sandvf_r)), 0) if horizon.sandtotal_r > 30 else round(6054000-55130*max(10,horizon.claytotal_r), 0))
+        bl_cl_kr = ('' if horizon.sandtotal_r is None else (0.00197 + 0.0003 * min(40,horizon.sandvf_r) + 0.3863 * math.exp(-1.84 * max(0.35,horizon.om_r)) if horizon.sandtotal_r > 30 else 0.0069 + 0.134 * math.exp(-0.2 * max(10,horizon.claytotal_r))))
+        bl_cl_tauc = ('' if horizon.sandtotal_r is None else ((2.67 + 0.065 * min(40,horizon.claytotal_r) - 0.058 * min(40,horizon.sandvf_r)) if horizon.sandtotal_r > 30 else 3.5))
         
-        compname = str(horizon['compname']).replace (" ", "_")
+        compname = str(horizon.compname).replace (" ", "_")
         
 
-        horizon_arr.append(dict([('depth', depth),
-                                 ('smr_bd', smr_bd),
-                                 ('sand', sand),
-                                 ('clay', clay),
-                                 ('om', om),
-                                 ('cec', cec),
-                                 ('rocks', rocks),
-                                 ('ksat', ksat),
-                                 ('anisotropy', anisotropy),
-                                 ('fc', fc),
-                                 ('wp', wp)
-                                 ]))
+        horizon_arr.append(Layer(depth, smr_bd, sand, clay, om, cec, rocks, ksat, anisotropy, fc, wp))
          
         baseline_cropland = (dict([('keff',bl_cl_keff),('ki',bl_cl_ki),('kr',bl_cl_kr),('tauc',bl_cl_tauc)]))
         
-    print 'Soil Name: ' + compname      
-    return  sorted(horizon_arr,key=operator.itemgetter('depth')), compname, baseline_cropland
+    if verbose: print 'Soil Name: ' + compname      
+    if start is not None:
+        profile.add('sort_values', start)
+        profile.count('horizons derived', len(values_list))
+    return  sorted(horizon_arr,key=operator.attrgetter('depth')), compname, baseline_cropland
 
-def create_file(cokey, mukey=99999,file_version='7778'):
-    '''Populates 'horizon_data' with values from the database'''
-    try:
-        cokey = cokey[0]
-    except:
-        pass
-    
-    horizon, compname, bl_cl_dic = sort_values(fetch_data(str(cokey)))
-    
+#chorizon columns read by derive_horizons
+derive_columns = ('hzdepb_r', 'dbthirdbar_r', 'ksat_r', 'sandtotal_r', 'claytotal_r', 'om_r', 'ecec_r', 'awc_l',
+                  'fraggt10_r', 'frag3to10_r', 'sieveno10_r', 'wthirdbar_r', 'wfifteenbar_r', 'sandvf_r')
 
-    
+#fields of the structured array returned by derive_horizons; NaN marks a value sort_values leaves blank ('') or fails on
+derived_fields = layer_fields + ('keff', 'ki', 'kr', 'tauc')
+
+#fields sort_values falls back to a default value for, in the bit order of the 'defaults' field
+default_fields = ('smr_bd', 'sand', 'clay', 'om', 'cec', 'ksat')
+
+def round_half_away(x, ndigits):
+    '''Rounds an array exactly like the builtin round() (correctly rounded, ties away from zero).
+    Values whose scaled fraction sits next to .5 are redone with round() itself'''
+    scale = 10.0 ** ndigits
+    y = x * scale
+    out = np.copysign(np.floor(np.abs(y) + 0.5), y) / scale
+    near = np.abs(np.abs(y) % 1 - 0.5) < 1e-6
+    for i in np.flatnonzero(near):
+        out[i] = round(x[i], ndigits)
+    return out
+
+def horizon_columns(values_list):
+    '''Returns Horizon records (as returned by fetch_data) as a dictionary of column arrays,
+    with NaN for NULL values'''
+    columns = {}
+    for field in derive_columns:
+        columns[field] = np.array([np.nan if v is None else v for v in map(operator.attrgetter(field), values_list)], dtype=float)
+    columns['desgnmaster'] = np.array([h.desgnmaster for h in values_list], dtype=object)
+    return columns
+
+def derive_horizons(columns):
+    '''Vectorized sort_values: derives the WEPP layer values and baseline cropland keff/ki/kr/tauc for
+    any number of horizons at once from column arrays (see horizon_columns).
+    Returns a structured array with one record per horizon, in input order'''
+    #NULLs are NaN here, so comparisons and divisions on them are expected to be invalid
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return _derive_horizons(columns)
+
+def _derive_horizons(c):
+    n = len(c['hzdepb_r'])
+    nz = lambda a: np.where(np.isnan(a), 0.0, a)
+    out = np.zeros(n, dtype=[(f, float) for f in derived_fields] + [('defaults', np.uint8), ('fails', bool)])
+
+    #corrected variables
+    rocks_soil = nz(c['fraggt10_r']) + nz(c['frag3to10_r'])
+    smr_pct_rocks = np.where(c['desgnmaster'] == 'O', 0.0, (100-rocks_soil)/100*(100-nz(c['sieveno10_r']))+rocks_soil)
+    #corrected field capacity and wilting point
+    fc_no_rocks = np.where(np.isnan(c['wthirdbar_r']), 0.0, c['wthirdbar_r']/(100-rocks_soil)*100)
+    wp_no_rocks = np.where(np.isnan(c['wfifteenbar_r']), 0.0, c['wfifteenbar_r']/(100-rocks_soil)*100)
+
+    out['depth'] = round_half_away(c['hzdepb_r']*10, 1)
+    for field, column, ndigits, default in (('smr_bd', 'dbthirdbar_r', 2, 0.0), ('sand', 'sandtotal_r', 1, 55.0),
+                                            ('clay', 'claytotal_r', 1, 10.0), ('om', 'om_r', 1, 5.0),
+                                            ('cec', 'ecec_r', 1, 15.0), ('ksat', 'ksat_r', 2, 0.0)):
+        missing = np.isnan(c[column])
+        value = c[column]*3.6 if field == 'ksat' else c[column]
+        out[field] = np.where(missing, default, round_half_away(value, ndigits))
+        out['defaults'] |= missing.astype(np.uint8) << default_fields.index(field)
+    out['rocks'] = round_half_away(smr_pct_rocks, 1)
+    out['anisotropy'] = np.where(c['hzdepb_r'] > 50, 1, 10)
+    out['fc'] = round_half_away(fc_no_rocks/100, 3)
+    out['wp'] = round_half_away(wp_no_rocks/100, 3)
+
+    #baseline cropland variables; a NULL claytotal_r/om_r compares like None does in sort_values
+    sand, clay, sandvf = c['sandtotal_r'], c['claytotal_r'], c['sandvf_r']
+    no_clay = np.isnan(clay)
+    clay_10 = np.where(no_clay, 10, np.maximum(10, clay))
+    sandvf_40 = np.minimum(40, sandvf)
+    coarse = sand > 30
+    keff = np.where(no_clay | (clay <= 40),
+                    -0.265+0.0086 * np.power(sand,1.8)+11.46*np.power(np.where(np.isnan(c['ecec_r']), 4, c['ecec_r']),(-0.75)),
+                    0.0066*np.exp(244/clay))
+    ki = np.where(coarse, round_half_away(2728000 + 192100 * sandvf_40, 0), round_half_away(6054000-55130*clay_10, 0))
+    kr = np.where(coarse, 0.00197 + 0.0003 * sandvf_40 + 0.3863 * np.exp(-1.84 * np.where(np.isnan(c['om_r']), 0.35, np.maximum(0.35, c['om_r']))),
+                  0.0069 + 0.134 * np.exp(-0.2 * clay_10))
+    tauc = np.where(coarse, 2.67 + 0.065 * np.minimum(40,clay) - 0.058 * sandvf_40, 3.5)
+    no_sand = np.isnan(sand)
+    for field, value in (('keff', keff), ('ki', ki), ('kr', kr), ('tauc', tauc)):
+        out[field] = np.where(no_sand, np.nan, value)
+
+    #rows sort_values raises on, whichever horizon of the soil they are: a NULL depth, a division by the
+    #rock free share at 100% rocks, and (with a sandtotal_r) a zero or negative base for the keff powers
+    #or a NULL sandvf_r/claytotal_r that min(40, None) turns into a TypeError
+    ecec = c['ecec_r']
+    out['fails'] = (np.isnan(c['hzdepb_r']) |
+                    ((rocks_soil == 100) & ~(np.isnan(c['wthirdbar_r']) & np.isnan(c['wfifteenbar_r']))) |
+                    (~no_sand & ((no_clay | (clay <= 40)) & ((ecec <= 0) | (sand < 0)))) |
+                    (coarse & (np.isnan(sandvf) | no_clay)))
+    return out
+
+def sort_values_batch(horizon_dic):
+    '''Vectorized sort_values for a dictionary of cokey -> horizon list (as returned by fetch_data_bulk).
+    Returns a dictionary of cokey -> (horizon_arr, compname, baseline_cropland), identical to what
+    sort_values returns for each horizon list. Cokeys sort_values raises on (no horizons, or a horizon
+    it cannot derive) are left out, so callers falling back to sort_values for them get its error'''
+    cokeys = [c for c in horizon_dic if horizon_dic[c]]
+    values_list = [h for c in cokeys for h in horizon_dic[c]]
+    if not values_list:
+        return {}
+    start = time.time() if profile is not None else None
+    derived = derive_horizons(horizon_columns(values_list))
+    if start is not None:
+        profile.count('horizons derived', len(values_list))
+        for bit, field in enumerate(default_fields[:5]):
+            profile.count('default ' + field, int(((derived['defaults'] >> bit) & 1).sum()))
+    bounds = np.cumsum([0] + [len(horizon_dic[c]) for c in cokeys])
+    group = np.repeat(np.arange(len(cokeys)), np.diff(bounds))
+    #stable sort by depth within each cokey, like sorted() in sort_values
+    order = np.lexsort((derived['depth'], group))
+    columns = dict([(f, derived[f].tolist()) for f in derived_fields])
+    ksat_null = ((derived['defaults'] >> default_fields.index('ksat')) & 1).tolist()
+    fails = np.logical_or.reduceat(derived['fails'], bounds[:-1]).tolist()
+    soils = {}
+    for i, cokey in enumerate(cokeys):
+        if fails[i]:
+            continue
+        horizon_arr = []
+        for r in order[bounds[i]:bounds[i + 1]]:
+            values = [columns[f][r] for f in layer_fields]
+            values[8] = int(values[8])
+            if ksat_null[r]:
+                values[7] = 0
+            horizon_arr.append(Layer(*values))
+        #the baseline cropland values and name come from the last horizon in database order
+        last = bounds[i + 1] - 1
+        baseline_cropland = dict([(f, '' if math.isnan(columns[f][last]) else columns[f][last]) for f in ('keff', 'ki', 'kr', 'tauc')])
+        compname = str(horizon_dic[cokey][-1].compname).replace (" ", "_")
+        soils[cokey] = (horizon_arr, compname, baseline_cropland)
+    if start is not None:
+        profile.add('sort_values', start)
+    return soils
+
+#burn severity variants written for each soil file layout. 'soil' multiplies the soil line values
+#(albedo, init_sat, ki, kr, tauc, keff), 'layer' multiplies the layer values (sand, clay, om, cec, rocks);
+#each variant is written to [soil_name][suffix].sol. load_severities adds or replaces entries from a .json file
+severity_table = {
+    '7778': [dict(name='unb', suffix='_unb', soil=(1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1)),
+             dict(name='low', suffix='_low', soil=(1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1)),
+             dict(name='mod', suffix='_mod', soil=(1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1)),
+             dict(name='high', suffix='_high', soil=(1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1)),
+             dict(name='norm', suffix='', soil=(1, 1, 2.5, 2.6, 1, .4), layer=(1, 1, 1, 1, 1))],
+    '95.7': [dict(name='unb', suffix='_unb', soil=(1.1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1)),
+             dict(name='low', suffix='_low', soil=(1, 0.9, 1.2, 1.2, 1, 0.9), layer=(1, 1, .9, 1, 1)),
+             dict(name='mod', suffix='_mod', soil=(1, .8, 1.5, 1.25, 1, 0.8), layer=(1, 1, .75, 1, 1)),
+             dict(name='high', suffix='_high', soil=(1, 0.5, 2.6, 2.5, 1, 0.4), layer=(1, 1, .5, .9, 1)),
+             dict(name='norm', suffix='', soil=(1, 1, 1, 1, 1, 1), layer=(1, 1, 1, 1, 1))],
+    }
+
+#soil line format per layout, after the soil name, texture and number of layers
+soil_formats = {'7778': "{}    {}    {:.2f}    {:.2f}    {:.2f}    {:.2f}\n",
+                '95.7': "{}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n"}
+
+def load_severities(path):
+    '''Updates severity_table from a .json file of {layout: [{"name", "suffix", "soil", "layer"}, ...]}.
+    Entries replace the built-in severity of the same name or are added after them'''
+    with open(path) as config:
+        merge_severities(json.load(config))
+
+def merge_severities(config, table=None):
+    '''Updates a severity table (severity_table by default) from a dictionary of {layout: [{"name",
+    "suffix", "soil", "layer"}, ...]} as read by load_severities'''
+    table = severity_table if table is None else table
+    for layout, entries in config.items():
+        severities = table.setdefault(str(layout), [])
+        for entry in entries:
+            entry = severity_entry(entry)
+            names = [sev['name'] for sev in severities]
+            if entry['name'] in names:
+                severities[names.index(entry['name'])] = entry
+            else:
+                severities.append(entry)
+
+#multiplied values of a severity entry, by name: 'soil' multiplies the soil line, 'layer' every layer
+severity_soil_fields = ('albedo', 'init_sat', 'ki', 'kr', 'tauc', 'keff')
+severity_layer_fields = ('sand', 'clay', 'om', 'cec', 'rocks')
+
+def severity_entry(entry):
+    '''Returns a severity table entry from a dictionary with a "name" and "soil"/"layer" multiplier lists, or
+    with the multipliers by name (albedo, init_sat, ki, kr, tauc, keff, sand, clay, om, cec, rocks; missing ones are 1)'''
+    soil = entry['soil'] if 'soil' in entry else [float(entry.get(f, 1)) for f in severity_soil_fields]
+    layer = entry['layer'] if 'layer' in entry else [float(entry.get(f, 1)) for f in severity_layer_fields]
+    entry = dict(name=str(entry['name']), suffix=str(entry.get('suffix', '_' + entry['name'])), soil=tuple(soil), layer=tuple(layer))
+    if len(entry['soil']) != 6 or len(entry['layer']) != 5:
+        raise ValueError('Severity %s needs 6 soil and 5 layer multipliers' % entry['name'])
+    return entry
+
+def load_ensemble(path):
+    '''Reads a list of multiplier sets (calibration variants) for --variants: a .csv with a name column and a column per
+    multiplied value (see severity_entry; a suffix column is optional), or a .json list of severity entries'''
+    with open(path, 'rb') as variants:
+        if os.path.splitext(path)[1].lower() == '.json':
+            entries = json.load(variants)
+            if not isinstance(entries, list):
+                raise ValueError('%s should hold a list of multiplier sets' % path)
+        else:
+            #blank cells keep the default multiplier (and suffix)
+            entries = [dict([(k.strip(), v.strip()) for k, v in row.items() if v and v.strip()]) for row in csv.DictReader(variants)]
+    return [severity_entry(entry) for entry in entries]
+
+def scale_severities(soil_values, columns, plain, prefixes, severities, layout):
+    '''The per-severity scaling of render_soil: each soil line value is formatted once per distinct multiplier
+    and the layer lines once per distinct set of layer multipliers, and shared by the severities that use
+    them (a --variants ensemble repeats the same few). Returns the soil line and layer lines of each severity'''
+    field_formats = soil_formats[layout].rstrip('\n').split('    ')
+    values = {}
+    blocks = {}
+    lines = []
+    for sev in severities:
+        #2 and 2.0 scale int values differently
+        fields = []
+        for j, m in enumerate(sev['soil']):
+            key = (j, type(m), m)
+            if key not in values:
+                values[key] = field_formats[j].format(soil_values[j] if m == 1 else soil_values[j]*m)
+            fields.append(values[key])
+        soil_line = '    '.join(fields) + '\n'
+        key = tuple([(type(m), m) for m in sev['layer']])
+        if key not in blocks:
+            scaled = [plain[i] if m == 1 else ["{}".format(v*m) for v in columns[i]] for i, m in enumerate(sev['layer'])]
+            blocks[key] = ''.join(["    ".join(fields) + "\n" for fields in zip(prefixes, *scaled)])
+        lines.append((soil_line, blocks[key]))
+    return lines
+
+def render_soil(cokey, derived, layout='7778', version=None, stem=None, severities=None, albedo=None, init_sat=None):
+    '''Renders every severity in severity_table[layout] (or the severities list given) for one soil (as
+    returned by sort_values) in a single pass: the header and the unscaled layer columns are formatted once
+    and only the columns a severity scales are reformatted. Files are named [stem][suffix].sol, stem
+    defaulting to the soil name. albedo and init_sat default to assumed_albedo and assumed_initalsat.
+    Returns the soil name and a list of (file name, file text)'''
+    start = time.time() if profile is not None else None
+    horizon, compname, bl_cl_dic = derived
     soil_name = compname.lower()
-    albedo = assumed_albedo
-    bl_cl_head = "%s    %s    %s %s" % (bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-    init_sat = assumed_initalsat
+    albedo = assumed_albedo if albedo is None else albedo
+    init_sat = assumed_initalsat if init_sat is None else init_sat
     
     rec_id = '<...>'
     
-    ksat_list = []
-    for layer in horizon:
-        ksat_list.append(layer['ksat'])
-        
+    ksat_list = [layer.ksat for layer in horizon]
     ksat_min = min(ksat_list)/100 if min(ksat_list) < 10 else min(ksat_list)
-    horizon = [layer for layer in horizon if layer['ksat'] >= 11]
-    #try:
-    sand, clay = int(horizon[0]['sand']),int(horizon[0]['clay'])    
-    silt = 100 - (sand + clay)
-    tex, col = get_texture(sand, silt, clay)
-    headder = '%s\n#  This WEPP soil input file was made using USDA STATSGO2 (2006) data\n#  base. Assumptions: soil albedo = %s, initial sat. = %s. If you have\n#  any question, please contact Erin Brooks, Ph: 208-885-6562\n#  Soil Name: %s    Component Key: %s    Rec. ID: %s    Tex.: %s\nsoil file\n%s 1\n' % (weppfile, albedo, init_sat, compname, str(cokey), rec_id, tex, '1')
-    layer_depth = horizon[-1]['depth']/10
-    if mukey != 99999:
-            
-            o2.write("{},{}\n".format(soil_name, mukey))
-    for sev in ('unb','low','mod','high','norm'):
-        
-        if sev == 'unb':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            o.write("'{}'    '{}'    {}    {}    {}    {0:.2f}    {0:.2f}    {0:.2f}    {0:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff']))
-            for r in range(len(horizon)):
-                o.write("{}    {}    {}    {}    {}    {}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],horizon[r]['smr_bd'],horizon[r]['ksat'],horizon[r]['anisotropy'],horizon[r]['fc'],horizon[r]['wp'],horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks']))
-
-
-        elif sev == 'low':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            o.write("'{}'    '{}'    {}    {}    {}    {0:.2f}    {0:.2f}    {0:.2f}    {0:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff']))
-            for r in range(len(horizon)):
-                o.write("{}    {}    {}    {}    {}    {}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],horizon[r]['smr_bd'],horizon[r]['ksat'],horizon[r]['anisotropy'],horizon[r]['fc'],horizon[r]['wp'],horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks']))
-  
-        elif sev == 'mod':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            o.write("'{}'    '{}'    {}    {}    {}    {0:.2f}    {0:.2f}    {0:.2f}    {0:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff']))
-            for r in range(len(horizon)):
-                o.write("{}    {}    {}    {}    {}    {}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],horizon[r]['smr_bd'],horizon[r]['ksat'],horizon[r]['anisotropy'],horizon[r]['fc'],horizon[r]['wp'],horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks']))
- 
-        elif sev == 'high':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            o.write("'{}'    '{}'    {}    {}    {}    {0:.2f}    {0:.2f}    {0:.2f}    {0:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff']))
-            for r in range(len(horizon)):
-                o.write("{}    {}    {}    {}    {}    {}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],horizon[r]['smr_bd'],horizon[r]['ksat'],horizon[r]['anisotropy'],horizon[r]['fc'],horizon[r]['wp'],horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks']))
-
-        elif sev == 'norm':
-            filename = '%s%s.sol' % (write_path, soil_name)
-            o = open(filename, 'w')
-            o.write(headder)
-            
-            
-            o.write("'{}'    '{}'    {}    {}    {}    {0:.2f}    {0:.2f}    {0:.2f}    {0:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki']*2.5,bl_cl_dic['kr']*2.6,bl_cl_dic['tauc'],bl_cl_dic['keff']*.4))
-            #o.write("'%s'    '%s'    %s    %s    %s    %s    %s    %s    %s\n" % (soil_name,tex,str(len(horizon)),str(albedo),str(init_sat),str(int(bl_cl_dic['ki'])*2.5),str(int(bl_cl_dic['kr'])*2.6),str(bl_cl_dic['tauc']),bl_cl_dic['keff']*.4))
-            for r in range(len(horizon)):
-                o.write("{}    {}    {}    {}    {}    {}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],horizon[r]['smr_bd'],horizon[r]['ksat'],horizon[r]['anisotropy'],horizon[r]['fc'],horizon[r]['wp'],horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks']))
-  
-        o.write("1 13 1000 %s" % ksat_min)
-        o.close()
-    return
-
-def create_957(cokey, mukey=99999, file_version='95.7'):
-    '''Populates 'horizon_data' with values from the database and creates a 
-    WEPP soil file version 95.7'''
-    try:
-        cokey = cokey[0]
-    except:
-        pass
-    
-    horizon, compname, bl_cl_dic = sort_values(fetch_data(str(cokey)))
+    horizon = [layer for layer in horizon if layer.ksat >= 11]
+    sand, clay = int(horizon[0].sand),int(horizon[0].clay)    
+    texture_start = time.time() if start is not None else None
+    tex, col = lookup_texture(sand, clay)
+    if start is not None:
+        profile.add('get_texture', texture_start)
+    headder = '%s\n#  This WEPP soil input file was made using USDA STATSGO2 (2006) data\n#  base. Assumptions: soil albedo = %s, initial sat. = %s. If you have\n#  any question, please contact Erin Brooks, Ph: 208-885-6562\n#  Soil Name: %s    Component Key: %s    Rec. ID: %s    Tex.: %s\nsoil file\n%s 1\n' % (version or layout, albedo, init_sat, compname, str(cokey), rec_id, tex, '1')
+    headder += "'{}'    '{}'    {}    ".format(soil_name, tex, len(horizon))
+    if layout == '7778':
+        tail = "1 13 1000 %s" % ksat_min
+        fixed = ('depth', 'smr_bd', 'ksat', 'anisotropy', 'fc', 'wp')
+    else:
+        tail = "{} {} {}".format(*col.split(','))
+        fixed = ('depth',)
+    soil_values = (albedo, init_sat, bl_cl_dic['ki'], bl_cl_dic['kr'], bl_cl_dic['tauc'], bl_cl_dic['keff'])
+    prefixes = ["    ".join(["{}".format(getattr(layer, f)) for f in fixed]) for layer in horizon]
+    columns = [[getattr(layer, f) for layer in horizon] for f in ('sand', 'clay', 'om', 'cec', 'rocks')]
+    plain = [["{}".format(v) for v in column] for column in columns]
     
+    files = []
+    severities = severity_table[layout] if severities is None else severities
+    for sev, (soil_line, layer_lines) in zip(severities, scale_severities(soil_values, columns, plain, prefixes, severities, layout)):
+        files.append(('%s%s.sol' % (stem or soil_name, sev['suffix']), headder + soil_line + layer_lines + tail))
+    if start is not None:
+        profile.add('render', start)
+    return soil_name, files
 
-    
-    soil_name = compname.lower()
-    albedo = assumed_albedo
-    bl_cl_head = "{}    {}    {} {}".format(bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-    init_sat = assumed_initalsat
-    
-    rec_id = '<...>'
-    
-    ksat_list = []
-    for layer in horizon:
-        ksat_list.append(layer['ksat'])
-        
-    ksat_min = min(ksat_list)/100 if min(ksat_list) < 10 else min(ksat_list)
-    horizon = [layer for layer in horizon if layer['ksat'] >= 11]
-    #try:
-    sand, clay = int(horizon[0]['sand']),int(horizon[0]['clay'])    
-    silt = 100 - (sand + clay)
-    tex, col = get_texture(sand, silt, clay)
-    col = col.split(',')
-    headder = '%s\n#  This WEPP soil input file was made using USDA STATSGO2 (2006) data\n#  base. Assumptions: soil albedo = %s, initial sat. = %s. If you have\n#  any question, please contact Erin Brooks, Ph: 208-885-6562\n#  Soil Name: %s    Component Key: %s    Rec. ID: %s    Tex.: %s\nsoil file\n%s 1\n' % (file_version, albedo, init_sat, compname, str(cokey), rec_id, tex, '1')
-    layer_depth = horizon[-1]['depth']/10
-    if mukey != 99999: 
+def soil_hash(derived, layout='7778', version=None):
+    '''Returns a hash of a soil's derived horizons, baseline cropland values and the settings that go
+    into its files, so soils that render identically (apart from the cokey comment) share a hash'''
+    horizon, compname, bl_cl_dic = derived
+    content = [layout, version or layout, assumed_albedo, assumed_initalsat, severity_table[layout],
+               compname, bl_cl_dic, [dict(layer) for layer in horizon]]
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+def write_files(files):
+    '''Writes rendered soil files to write_path, one buffered write per file'''
+    start = time.time() if profile is not None else None
+    for filename, text in files:
+        with open(write_path + filename, 'w') as o:
+            o.write(text)
+    if start is not None:
+        profile.add('write', start)
+        profile.count('files written', len(files))
+        profile.count('bytes written', sum([len(text) for filename, text in files]))
+
+def create_file(cokey, mukey=99999, file_version='7778', values_list=None, derived=None):
+    '''Populates 'horizon_data' with values from the database (or from values_list when the
+    horizons were already fetched with fetch_data_bulk, or derived when sort_values_batch already ran)
+    and creates the WEPP soil files (version 7778) for every severity. With a mukey its line goes
+    into the soil dictionary (soildic.txt). Returns the soil name'''
+    #a list of cokeys (as returned by find_dominant_soil) uses the first one
+    if isinstance(cokey, list):
+        cokey = cokey[0]
+    if derived is None:
+        if values_list is None:
+            values_list = fetch_data(str(cokey))
+        derived = sort_values(values_list)
+    soil_name, files = render_soil(cokey, derived, '7778', weppfile)
+    if mukey != 99999:
         o2.write("{},{}\n".format(soil_name, mukey))
-    for sev in ('unb','low','mod','high','norm'):
-        
-        if sev == 'unb':
-            filename = '{}{}_{}.sol'.format(write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            
-            tup = (albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-            
-            #6
-            mult_tup = (1.1,1,1,1,1,1)
-            tup =  tuple([float(a)*b for a,b in zip(tup,mult_tup)])
-            
-            
-            o.write("'{}'    '{}'    {}    {}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n".format(soil_name,tex,len(horizon),*tup))
-            for r in range(len(horizon)):
-                
-                tup = (horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks'])
-                print tup
-                #6
-                mult_tup = (1,1,1,1,1)
-                tup =  [float(a)*b for a,b in zip(tup,mult_tup)]
-                o.write("{}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],*tup))
-
-
-        elif sev == 'low':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            tup = (albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-            #6
-            
-            mult_tup = (1,0.9,1.2,1.2,1,0.9)
-            
-            tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-            o.write("'{}'    '{}'    {}    {}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n".format(soil_name,tex,len(horizon),*tup))
-            for r in range(len(horizon)):
-                tup = (horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks'])
-                #6
-                mult_tup = (1,1,.9,1,1)
-                tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-                o.write("{}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],*tup))
-                
-        elif sev == 'mod':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            tup = (albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-            #6
-            mult_tup = (1, .8, 1.5, 1.25, 1, 0.8)
-            tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-            o.write("'{}'    '{}'    {}    {}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n".format(soil_name, tex,len(horizon), *tup))
-            for r in range(len(horizon)):
-                
-                tup = (horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks'])
-                #6
-                mult_tup = (1,1,.75,1,1)
-                tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-                o.write("{}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],*tup))
-                
-        elif sev == 'high':
-            filename = '%s%s_%s.sol' % (write_path, soil_name, sev)
-            o = open(filename, 'w')
-            o.write(headder)
-            tup = (albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff'])
-            #6
-            mult_tup = (1, 0.5, 2.6, 2.5, 1, 0.4)
-            tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-            
-            o.write("'{}'    '{}'    {}    {}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n".format(soil_name,tex,len(horizon), *tup))
-            for r in range(len(horizon)):
-                
-                tup = (horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks'])
-                #6
-                mult_tup = (1,1,.5,.9,1)
-                tup =  tuple([a*b for a,b in zip(tup,mult_tup)])
-                o.write("{}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],*tup))
-                
-        elif sev == 'norm':
-            filename = '%s%s.sol' % (write_path, soil_name)
-            o = open(filename, 'w')
-            o.write(headder)
-            o.write("'{}'    '{}'    {}    {}    {}    {:.1f}    {:.2f}    {:.2f}    {:.2f}\n".format(soil_name,tex,len(horizon),albedo,init_sat,bl_cl_dic['ki'],bl_cl_dic['kr'],bl_cl_dic['tauc'],bl_cl_dic['keff']))
-            #o.write("'%s'    '%s'    %s    %s    %s    %s    %s    %s    %s\n" % (soil_name,tex,str(len(horizon)),str(albedo),str(init_sat),str(int(bl_cl_dic['ki'])*2.5),str(int(bl_cl_dic['kr'])*2.6),str(bl_cl_dic['tauc']),bl_cl_dic['keff']*.4))
-            for r in range(len(horizon)):
-                
-                tup = (horizon[r]['sand'],horizon[r]['clay'],horizon[r]['om'],horizon[r]['cec'],horizon[r]['rocks'])
-                o.write("{}    {}    {}    {}    {}    {}\n".format(horizon[r]['depth'],*tup))
-        o.write("{} {} {}".format(col[0],col[1],col[2]))
-        o.close()
-    return
+    write_files(files)
+    return soil_name
+
+def create_957(cokey, mukey=99999, file_version='95.7', values_list=None, derived=None):
+    '''Populates 'horizon_data' with values from the database (or from values_list/derived) and creates a 
+    WEPP soil file version 95.7 for every severity. With a mukey its line goes into the soil dictionary
+    (soildic.txt). Returns the soil name'''
+    if isinstance(cokey, list):
+        cokey = cokey[0]
+    if derived is None:
+        if values_list is None:
+            values_list = fetch_data(str(cokey))
+        derived = sort_values(values_list)
+    soil_name, files = render_soil(cokey, derived, '95.7', file_version)
+    if mukey != 99999:
+        o2.write("{},{}\n".format(soil_name, mukey))
+    write_files(files)
+    return soil_name
+
+#a soil rendered in memory by SoilGenerator: its files as (file name, text) pairs in severity order,
+#and severities mapping each severity name to its file text
+GeneratedSoil = namedtuple('GeneratedSoil', ('cokey', 'name', 'layout', 'files', 'severities'))
+
+class SoilGenerator(object):
+    '''Reentrant in-memory soil generation for use as a library (e.g. from a web service). It holds its own
+    data source and settings instead of reading the module globals, returns the soil file text instead of
+    writing sol/ and soildic.txt, and prints nothing. Use one generator per thread, as with the database
+    connection it holds:
+
+        with SoilGenerator('soils.sqlite') as generator:
+            text = generator.mukey_soil('600000', '95.7').severities['high']
+    '''
+    def __init__(self, database=None, source=None, tables=('component', 'chorizon'), weppfile='7778',
+                 albedo=0.23, init_sat=0.753, severities=None):
+        '''database is opened with open_source unless an open source is given (which is left open on close).
+        severities is a dictionary of {layout: [severity, ...]} added to (or replacing) a copy of the built-in
+        ones, as in a --severities file'''
+        self.own_source = source is None
+        self.source = open_source(database, tables) if source is None else source
+        self.weppfile = weppfile
+        self.albedo = albedo
+        self.init_sat = init_sat
+        self.severities = dict([(layout, [dict(sev) for sev in entries]) for layout, entries in severity_table.items()])
+        if severities:
+            merge_severities(severities, self.severities)
+
+    def dominant_soils(self, mukeys):
+        '''Returns a dictionary of mukey -> list of dominant cokeys'''
+        return find_dominant_soils(mukeys, self.source)
+
+    def components(self, mukeys, min_pct=None, top=None):
+        '''Returns a dictionary of mukey -> [(cokey, comppct_r), ...], as select_components'''
+        return select_components(mukeys, self.source, min_pct, top)
+
+    def horizons(self, cokeys):
+        '''Returns a dictionary of cokey -> Horizon list, as fetch_data_bulk'''
+        return fetch_data_bulk(cokeys, self.source)
+
+    def render(self, cokey, derived, layout='7778'):
+        '''Renders every severity of a layout ('7778' or '95.7') for one derived soil; returns a GeneratedSoil'''
+        if layout not in self.severities:
+            raise ValueError('Unknown soil file layout: %s' % layout)
+        version = self.weppfile if layout == '7778' else layout
+        soil_name, files = render_soil(cokey, derived, layout, version, severities=self.severities[layout],
+                                       albedo=self.albedo, init_sat=self.init_sat)
+        severities = dict([(sev['name'], text) for sev, (filename, text) in zip(self.severities[layout], files)])
+        return GeneratedSoil(str(cokey), soil_name, layout, files, severities)
+
+    def soil(self, cokey, layout='7778'):
+        '''Returns the GeneratedSoil of one cokey; KeyError when it has no horizons'''
+        values_list = self.horizons([cokey])[str(cokey)]
+        if not values_list:
+            raise KeyError('No horizons for cokey %s' % cokey)
+        return self.render(cokey, sort_values(values_list, verbose=False), layout)
+
+    def soils(self, cokeys, layout='7778'):
+        '''Returns a dictionary of cokey -> GeneratedSoil for a list of cokeys, fetched together.
+        Cokeys that cannot be generated (no horizons, NULLs without a default, no layer with ksat >= 11)
+        are left out, as the command line reports them as errors'''
+        if layout not in self.severities:
+            raise ValueError('Unknown soil file layout: %s' % layout)
+        soils = {}
+        for cokey, values_list in self.horizons(cokeys).items():
+            try:
+                soils[cokey] = self.render(cokey, sort_values(values_list, verbose=False), layout)
+            except Exception:
+                continue
+        return soils
+
+    def mukey_soil(self, mukey, layout='7778'):
+        '''Returns the GeneratedSoil of the dominant component of a mukey (the first one on a tie, as the
+        interactive 95.7 path does); KeyError when the mukey has no components'''
+        cokeys = self.dominant_soils([mukey])[str(mukey)]
+        if not cokeys:
+            raise KeyError('No components for mukey %s' % mukey)
+        return self.soil(cokeys[0], layout)
 
+    def close(self):
+        if self.own_source:
+            self.source.close()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
+
+#name soil files by a hash of their content and render identical soils once (--dedup)
+dedup = False
+
+#content hashes of the soils this process already rendered with dedup on
+rendered_hashes = set()
+
+#components generated per mukey by the --bulk/--workers pipeline: with neither set only the dominant one(s),
+#otherwise those with comppct_r >= min_pct and/or the top_components largest (see select_components)
+min_pct = None
+top_components = None
+
+#number of keys fetched, derived and rendered together by the --bulk/--workers pipeline
+batch_size = 250
+
+#seconds between pipeline progress readouts
+progress_interval = 10
+
+#module settings handed to each --workers process (spawned workers re-import this module with the defaults)
+worker_settings = ('weppfile', 'assumed_albedo', 'assumed_initalsat', 'write_path', 'database_dir',
+                   'chorizon_table', 'component_table', 'engine', 'bulk_chunk', 'severity_table', 'dedup',
+                   'min_pct', 'top_components')
+
+#data source held by each --workers process
+worker_source = None
+
+def read_keys(path):
+    '''Yields the keys in the first column of a .csv key list, one row at a time'''
+    with open(path, 'rb') as key_file:
+        for row in csv.reader(key_file):
+            if row:
+                yield row[0]
+
+def batches(keys, size):
+    '''Groups a stream of keys into lists of at most size keys without reading ahead'''
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+#what generate_batch returns for one batch: the number of keys, soildic lines, failed keys, rendered (file name,
+#text) pairs, manifest entries of the keys generated and (key_type, key, cokey, soil_name) of every soil
+BatchResult = namedtuple('BatchResult', ('count', 'lines', 'errors', 'files', 'entries', 'soils'))
+
+def settings_fingerprint(layout='7778'):
+    '''Returns a hash of the settings that go into the files of a layout, for the manifest'''
+    content = [weppfile, assumed_albedo, assumed_initalsat, layout, severity_table[layout], dedup]
+    if min_pct is not None or top_components is not None:
+        content.append([min_pct, top_components])
+    if engine != 'scalar':
+        content.append(engine)
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+def source_fingerprint(cokeys, horizon_dic):
+    '''Returns a hash of the cokeys of a key and their chorizon rows (as returned by fetch_data_bulk)'''
+    content = [[c, [dict(h) for h in horizon_dic[c]]] for c in cokeys]
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+def load_manifest(path):
+    '''Reads a generation manifest written by run_pipeline (one json entry per line, later entries
+    win) into a dictionary of (key_type, key) -> entry'''
+    manifest = {}
+    if os.path.exists(path):
+        with open(path) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #a run killed in the middle of a write leaves a partial last line
+                    continue
+                manifest[(entry['key_type'], entry['key'])] = entry
+    return manifest
+
+def fetch_batch(key_type, keys, source):
+    '''Database half of generate_batch: returns the cokeys selected for the keys (key -> cokey list, see
+    select_components and min_pct/top_components; a cokey maps to itself), their comppct_r (cokey -> percent,
+    for mukeys) and the horizons of those cokeys (as returned by fetch_data_bulk)'''
+    if key_type == 'mukey':
+        components = select_components(keys, source, min_pct, top_components)
+        dominant_dic = dict([(key, [c for c, pct in components[key]]) for key in components])
+        percents = dict([component for key in components for component in components[key]])
+    else:
+        dominant_dic = dict([(c, [c]) for c in keys])
+        percents = {}
+    return dominant_dic, percents, fetch_data_bulk([c for key in keys for c in dominant_dic[key]], source)
+
+def generate_batch(key_type, keys, source, layout='7778', previous=None, fetched=None):
+    '''Pipeline step for one batch of mukeys or cokeys: fetch (or take the fetch_batch result given as fetched),
+    derive and render each selected component on its own, skipping keys whose previous manifest entry still
+    matches. Returns a BatchResult in input order; a key fails when all its components do, a failed component
+    of a key that kept others is reported as mukey:cokey'''
+    dominant_dic, percents, horizon_dic = fetched or fetch_batch(key_type, keys, source)
+    version = weppfile if layout == '7778' else layout
+    settings = settings_fingerprint(layout) if previous is not None else None
+    fingerprints = {}
+    unchanged = {}
+    if previous is not None:
+        for key in keys:
+            fingerprints[key] = source_fingerprint(dominant_dic[key], horizon_dic)
+            entry = previous.get(key)
+            if entry and entry['source'] == fingerprints[key] and entry['settings'] == settings:
+                unchanged[key] = entry
+    if engine == 'numpy':
+        derived_dic = sort_values_batch(dict([(c, horizon_dic[c]) for key in keys if key not in unchanged for c in dominant_dic[key]]))
+    else:
+        derived_dic = {}
+    lines = []
+    errors = []
+    files = []
+    entries = []
+    soils = []
+    for key in keys:
+        if key in unchanged:
+            lines.extend(unchanged[key]['soildic'])
+            errors.extend([str(e) for e in unchanged[key]['errors']])
+            continue
+        key_lines = []
+        key_files = []
+        failed = []
+        for c in dominant_dic[key]:
+            try:
+                derived = derived_dic[c] if c in derived_dic else sort_values(horizon_dic[c])
+                if dedup:
+                    #content addressed name; soils this process already rendered are not rendered again
+                    digest = soil_hash(derived, layout, version)
+                    soil_name = '%s_%s' % (derived[1].lower(), digest[:8])
+                    if digest not in rendered_hashes:
+                        files.extend(render_soil(c, derived, layout, version, soil_name)[1])
+                        rendered_hashes.add(digest)
+                else:
+                    soil_name, soil_files = render_soil(c, derived, layout, version)
+                    files.extend(soil_files)
+                key_files.extend(['%s%s.sol' % (soil_name, sev['suffix']) for sev in severity_table[layout]])
+                soils.append((key_type, key, c, soil_name))
+                if key_type == 'mukey' and (min_pct is not None or top_components is not None):
+                    #more than the dominant component per mukey: each line carries its comppct_r
+                    key_lines.append("{},{},{}\n".format(soil_name, key, percents[c]))
+                elif key_type == 'mukey' or dedup:
+                    key_lines.append("{},{}\n".format(soil_name, key))
+            except Exception:
+                failed.append(c)
+        key_errors = []
+        if failed and len(failed) == len(dominant_dic[key]):
+            key_errors.append(key)
+            if key_type == 'mukey':
+                key_lines.append("{}, {}\n".format('none', key))
+        else:
+            #the other components of the mukey were generated; only the failed ones are errors
+            key_errors.extend(['%s:%s' % (key, c) for c in failed])
+        errors.extend(key_errors)
+        lines.extend(key_lines)
+        if previous is not None:
+            entries.append(dict(key_type=key_type, key=key, source=fingerprints[key], settings=settings,
+                                files=key_files, soildic=key_lines, errors=key_errors))
+    return BatchResult(len(keys), lines, errors, files, entries, soils)
+
+def init_worker(settings, profiling=False):
+    '''Pool initializer: applies the parent's settings and opens this worker's own data source'''
+    global worker_source, profile
+    globals().update(settings)
+    profile = Profile() if profiling else None
+    worker_source = open_source()
+
+def worker_batch(task):
+    '''Pool task: generate_batch over the worker's data source. Returns the BatchResult and, when
+    profiling, the worker's timers and counters since its last batch'''
+    key_type, keys, layout, previous, fetched = task
+    result = generate_batch(key_type, keys, worker_source, layout, previous, fetched)
+    return result, profile.take() if profile is not None else None
+
+class QueueThread(threading.Thread):
+    '''Background pipeline stage: calls func on every item put into its bounded queue, in order, so a
+    full queue holds back whoever is putting. close() waits for the queue to drain and raises what func
+    raised (items put after a failure are dropped)'''
+    def __init__(self, func, size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.queue = Queue.Queue(size)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.func(item)
+                except Exception:
+                    self.error = sys.exc_info()
+
+    def put(self, item):
+        if self.error is not None:
+            #stop feeding a stage that already failed; close() raises the error
+            self.close()
+        self.queue.put(item)
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+def prefetch_batches(tasks, depth):
+    '''Yields (task, fetch_batch result) for each generate_batch task (the one it carries, if any), read by a
+    background thread over its own data source (database connections stay in the thread that opened them) while the caller derives and
+    renders; at most depth batches are read ahead'''
+    done = object()
+    queue = Queue.Queue(depth)
+    def produce():
+        try:
+            source = open_source()
+            try:
+                for task in tasks:
+                    queue.put((task, task[4] or fetch_batch(task[0], task[1], source)))
+            finally:
+                source.close()
+        except Exception:
+            queue.put((done, sys.exc_info()))
+        else:
+            queue.put((done, None))
+    producer = threading.Thread(target=produce)
+    #a consumer that stops early leaves the producer blocked on a full queue
+    producer.daemon = True
+    producer.start()
+    while True:
+        task, fetched = queue.get()
+        if task is done:
+            if fetched is not None:
+                raise fetched[0], fetched[1], fetched[2]
+            return
+        yield task, fetched
+
+def map_batches(tasks, workers=1, prefetch=0):
+    '''Yields the generate_batch result of each (key_type, keys, layout, previous, fetched) task in input order. With
+    more than one worker the batches run on a process pool, at most 2 * workers in flight at a time.
+    Otherwise, with prefetch, a background thread reads up to prefetch batches ahead of the one being derived'''
+    if workers < 2 and prefetch:
+        for (key_type, keys, layout, previous, carried), fetched in prefetch_batches(tasks, prefetch):
+            yield generate_batch(key_type, keys, None, layout, previous, fetched)
+        return
+    if workers < 2:
+        source = open_source()
+        try:
+            for key_type, keys, layout, previous, fetched in tasks:
+                yield generate_batch(key_type, keys, source, layout, previous, fetched)
+        finally:
+            source.close()
+        return
+    settings = dict([(name, globals()[name]) for name in worker_settings])
+    pool = multiprocessing.Pool(workers, init_worker, (settings, profile is not None))
+    pending = deque()
+    def result(async_result):
+        result, taken = async_result.get()
+        if taken is not None:
+            profile.merge(taken)
+        return result
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(worker_batch, (task,)))
+            if len(pending) >= 2 * workers:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class Progress(object):
+    '''Keys and files done, printed with their throughput at most every progress_interval seconds'''
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.keys = 0
+        self.files = 0
+
+    def update(self, keys, files):
+        self.keys += keys
+        self.files += files
+        if time.time() - self.last >= progress_interval:
+            self.report()
+
+    def report(self):
+        self.last = time.time()
+        elapsed = max(self.last - self.start, 1e-6)
+        print 'Progress: {} keys ({:.1f} keys/s), {} files ({:.1f} files/s)'.format(self.keys, self.keys/elapsed, self.files, self.files/elapsed)
+
+class ArchiveWriter(object):
+    '''Packs rendered soil files into one append-only blob file instead of one file each in write_path.
+    A json index (path + '.idx') holds each file's offset and length and the soils of each mukey/cokey,
+    and is rewritten on close. Files are named by content (dedup), so a name never stands for two soils.
+    Opening an existing archive appends to it, newer files and key soils replacing older ones'''
+    def __init__(self, path, layout='7778'):
+        self.path = path
+        if os.path.exists(path) and os.path.exists(path + '.idx'):
+            with open(path + '.idx') as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = dict(files={}, keys=dict(mukey={}, cokey={}))
+        self.index['severities'] = dict([(sev['name'], sev['suffix']) for sev in severity_table[layout]])
+        self.blob = open(path, 'ab')
+        self.blob.seek(0, os.SEEK_END)
+        self.mapped = set()
+
+    def has(self, filename):
+        return filename in self.index['files']
+
+    def add(self, files):
+        '''Appends (file name, text) pairs to the blob'''
+        start = time.time() if profile is not None else None
+        offset = first = self.blob.tell()
+        for filename, text in files:
+            self.index['files'][filename] = (offset, len(text))
+            offset += len(text)
+        self.blob.write(''.join([text for filename, text in files]))
+        if start is not None:
+            profile.add('write', start)
+            profile.count('files written', len(files))
+            profile.count('bytes written', offset - first)
+
+    def map(self, key_type, key, soil_name):
+        '''Records soil_name as one of the soils of a mukey or cokey; the first one of this run replaces
+        the soils an earlier run recorded for the key'''
+        if (key_type, key) not in self.mapped:
+            self.mapped.add((key_type, key))
+            self.index['keys'][key_type][key] = []
+        names = self.index['keys'][key_type][key]
+        if soil_name not in names:
+            names.append(soil_name)
+
+    def close(self):
+        self.blob.close()
+        with open(self.path + '.idx.tmp', 'w') as index_file:
+            json.dump(self.index, index_file)
+        if os.path.exists(self.path + '.idx'):
+            os.remove(self.path + '.idx')
+        os.rename(self.path + '.idx.tmp', self.path + '.idx')
+
+class SoilArchive(object):
+    '''Reader for an archive written with --archive: returns one soil file by mukey, cokey or file name
+    with a dictionary lookup and a single seek, without unpacking anything else'''
+    def __init__(self, path):
+        with open(path + '.idx') as index_file:
+            self.index = json.load(index_file)
+        self.blob = open(path, 'rb')
+
+    def names(self, mukey=None, cokey=None):
+        '''Returns the soil names of a mukey (its dominant soils) or of a cokey'''
+        if mukey is not None:
+            return self.index['keys']['mukey'].get(str(mukey), [])
+        return self.index['keys']['cokey'].get(str(cokey), [])
+
+    def read(self, filename):
+        '''Returns the text of one packed soil file, e.g. gila_high.sol'''
+        offset, length = self.index['files'][filename]
+        self.blob.seek(offset)
+        return self.blob.read(length)
+
+    def get(self, mukey=None, cokey=None, severity='norm'):
+        '''Returns the soil file of a severity for a mukey (its first dominant soil) or a cokey'''
+        names = self.names(mukey, cokey)
+        if not names:
+            raise KeyError('No soil for mukey {} cokey {}'.format(mukey, cokey))
+        return self.read('%s%s.sol' % (names[0], self.index['severities'][severity]))
+
+    def close(self):
+        self.blob.close()
+
+def run_pipeline(key_type, keys, soildic, workers=1, layout='7778', manifest_path=None, archive_path=None, prefetch=0, validation=None):
+    '''Streams a mukey or cokey list (any iterable, e.g. read_keys) through
+    batch -> fetch -> derive -> render -> write, so memory stays flat however long the list is.
+    soildic lines and failures come out in input order; returns the keys (or mukey:cokey components) that failed.
+    With a manifest_path, every key generated is recorded there with a fingerprint of its source rows,
+    the settings and its files as each batch is written, and keys already recorded unchanged are skipped,
+    so a run that died can be started again where it stopped.
+    With an archive_path the files are packed into one archive (see ArchiveWriter) instead of write_path;
+    an archive needs dedup file names.
+    With prefetch, database reads (see map_batches) and writing (files, soildic and manifest) each run on a
+    background thread, overlapping with deriving and rendering; prefetch batches are queued between stages.
+    With a validation report (see validated_batches) the keys that would fail are left out of each batch
+    as it is read, and the batch is generated from the rows read to check it'''
+    if archive_path and not dedup:
+        raise ValueError('An archive names soil files by content: set dedup (--dedup) to write one')
+    errors = []
+    written = set()
+    #files rendered by an earlier run in this process are not in this run's output
+    rendered_hashes.clear()
+    skipped = 0
+    progress = Progress()
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    manifest_file = open(manifest_path, 'a') if manifest_path else None
+    archive = ArchiveWriter(archive_path, layout) if archive_path else None
+    exists = archive.has if archive else lambda filename: os.path.exists(write_path + filename)
+    def previous(batch):
+        #manifest entries of the batch whose files are all still there
+        if manifest is None:
+            return None
+        entries = [manifest.get((key_type, key)) for key in batch]
+        return dict([(e['key'], e) for e in entries if e and all([exists(f) for f in e['files']])])
+    if validation is not None:
+        read = validated_batches(key_type, keys, batch_size, validation)
+    else:
+        read = ((batch, None) for batch in batches(keys, batch_size))
+    tasks = ((key_type, batch, layout, previous(batch), fetched) for batch, fetched in read)
+    def write(result):
+        files = result.files
+        if dedup:
+            #another worker may have rendered the same soil; the first one in input order is kept
+            files = [f for f in files if f[0] not in written]
+            written.update([f[0] for f in files])
+        if archive:
+            archive.add(files)
+            for soil_key_type, key, cokey, soil_name in result.soils:
+                archive.map(soil_key_type, key, soil_name)
+                archive.map('cokey', cokey, soil_name)
+        else:
+            write_files(files)
+        soildic.writelines(result.lines)
+        progress.update(result.count, len(files))
+        if manifest_file:
+            #entries only go in once their files are written
+            manifest_file.writelines([json.dumps(entry) + '\n' for entry in result.entries])
+            manifest_file.flush()
+    writer = QueueThread(write, prefetch) if prefetch else None
+    try:
+        try:
+            for result in map_batches(tasks, workers, prefetch):
+                errors.extend(result.errors)
+                skipped += result.count - len(result.entries)
+                if writer:
+                    writer.put(result)
+                else:
+                    write(result)
+        finally:
+            if writer:
+                writer.close()
+    finally:
+        if manifest_file:
+            manifest_file.close()
+        if archive:
+            archive.close()
+    progress.report()
+    if dedup:
+        print 'Wrote {} files for {} keys (--dedup)'.format(len(written), progress.keys)
+    if manifest_path:
+        print 'Skipped {} unchanged keys recorded in {}'.format(skipped, manifest_path)
+    return errors
+
+#grid cells read (and counted) at a time by grid_counts
+grid_chunk = 1 << 20
+
+def grid_cells(path, chunk=grid_chunk):
+    '''Yields the cells of a mukey grid as flat arrays of at most about chunk cells, and the grid's NODATA
+    value first: an ESRI ASCII grid (.asc, NODATA_value from its header) or a numpy array file (.npy,
+    memory-mapped, no NODATA value)'''
+    if os.path.splitext(path)[1].lower() == '.npy':
+        cells = np.load(path, mmap_mode='r').reshape(-1)
+        yield None
+        for i in range(0, len(cells), chunk):
+            yield np.asarray(cells[i:i + chunk])
+        return
+    with open(path) as grid:
+        header = {}
+        line = grid.readline()
+        while line and line.split() and line.split()[0][0].isalpha():
+            key, value = line.split()[:2]
+            header[key.lower()] = value
+            line = grid.readline()
+        yield float(header['nodata_value']) if 'nodata_value' in header else None
+        width = int(header.get('ncols', 1))
+        lines = []
+        cells = 0
+        while line:
+            lines.append(line)
+            cells += width
+            if cells >= chunk:
+                yield np.fromstring(' '.join(lines), sep=' ')
+                lines = []
+                cells = 0
+            line = grid.readline()
+        if lines:
+            yield np.fromstring(' '.join(lines), sep=' ')
+
+def grid_counts(path, nodata=None, chunk=grid_chunk):
+    '''Returns the pixel count of each mukey in a mukey grid (see grid_cells), reading it chunk cells at a time,
+    and the number of NODATA (or NaN) pixels. nodata overrides the grid's own NODATA value'''
+    if np is None:
+        raise ImportError('numpy is required to read a mukey grid')
+    cells = grid_cells(path, chunk)
+    grid_nodata = next(cells)
+    nodata = grid_nodata if nodata is None else nodata
+    counts = defaultdict(int)
+    missing = 0
+    for values in cells:
+        keep = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+        if nodata is not None:
+            keep &= values != nodata
+        missing += len(values) - int(keep.sum())
+        keys, pixels = np.unique(values[keep], return_counts=True)
+        for key, n in zip(keys.tolist(), pixels.tolist()):
+            counts[int(key) if key == int(key) else key] += n
+    return dict([(str(key), n) for key, n in counts.items()]), missing
+
+def write_grid_map(path, counts, nodata_pixels, soildic_lines):
+    '''Writes the mukey -> soil mapping of a grid run as .csv (mukey, pixels, percent of the data pixels, soil
+    name and, with --min-pct/--top, comppct_r; soil none for mukeys that failed) and its coverage statistics
+    next to it as .json, from the soildic lines of the run. Returns the statistics'''
+    soils = defaultdict(list)
+    for line in soildic_lines:
+        fields = [f.strip() for f in line.split(',')]
+        if fields[0] != 'none':
+            soils[fields[1]].append((fields[0], fields[2] if len(fields) > 2 else ''))
+    total = sum(counts.values())
+    with open(path, 'wb') as grid_map:
+        writer = csv.writer(grid_map)
+        writer.writerow(('mukey', 'pixels', 'percent', 'soil', 'comppct_r'))
+        for mukey in sorted(counts, key=counts.get, reverse=True):
+            for soil_name, pct in soils[mukey] or [('none', '')]:
+                writer.writerow((mukey, counts[mukey], '%.4f' % (100.0 * counts[mukey] / total), soil_name, pct))
+    mapped = sum([counts[mukey] for mukey in counts if soils[mukey]])
+    stats = dict(pixels=total + nodata_pixels, nodata_pixels=nodata_pixels, data_pixels=total, mukeys=len(counts),
+                 mapped_mukeys=len([mukey for mukey in counts if soils[mukey]]), mapped_pixels=mapped,
+                 coverage=100.0 * mapped / total if total else None, soils=len(set([s for mukey in soils for s, pct in soils[mukey]])),
+                 unmapped=dict([(mukey, counts[mukey]) for mukey in counts if not soils[mukey]]))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as stats_file:
+        json.dump(stats, stats_file, indent=1, sort_keys=True)
+    print 'Grid: {} data pixels ({} NODATA), {} mukeys, {} soils; {:.2f}% of the pixels mapped to a soil'.format(
+        total, nodata_pixels, len(counts), stats['soils'], stats['coverage'] or 0)
+    return stats
+
+#problems validate_keys finds, in report order, and how generating the key would fail
+validation_problems = (('no_component', 'the mukey has no component: nothing is generated for it'),
+                       ('no_horizons', 'the component has no chorizon rows: sort_values has nothing to derive'),
+                       ('null_depth', 'a horizon has a NULL hzdepb_r: sort_values cannot compute its depth'),
+                       ('all_rock', 'a horizon is 100% rock fragments with a water content: fc/wp divide by zero'),
+                       ('null_sandvf', 'a horizon with sand over 30 has a NULL sandvf_r: its baseline ki, kr and tauc fail'),
+                       ('null_clay', 'a horizon with sand over 30 has a NULL claytotal_r: its baseline tauc fails'),
+                       ('zero_cec', 'a horizon with clay up to 40 has an ecec_r of 0 or less: its baseline keff fails'),
+                       ('negative_sand', 'a horizon with clay up to 40 has a negative sandtotal_r: its baseline keff fails'),
+                       ('null_baseline', 'sandtotal_r of the last horizon is NULL: no baseline ki, kr, tauc and keff for the soil line'),
+                       ('low_ksat', 'no horizon has ksat >= 11 mm/h: no layer is left to write'))
+
+def horizon_problems(values_list):
+    '''Returns the validation_problems that make sort_values or render_soil fail on the horizons of
+    one cokey (as returned by fetch_data_bulk), without deriving anything. sort_values derives the
+    baseline values of every horizon with a sandtotal_r, so those are checked on every horizon'''
+    if not values_list:
+        return ['no_horizons']
+    found = set()
+    for h in values_list:
+        if h.hzdepb_r is None:
+            found.add('null_depth')
+        if (h.fraggt10_r or 0.0) + (h.frag3to10_r or 0.0) == 100 and (h.wthirdbar_r is not None or h.wfifteenbar_r is not None):
+            found.add('all_rock')
+        if h.sandtotal_r is None:
+            continue
+        if h.sandtotal_r > 30 and h.sandvf_r is None:
+            found.add('null_sandvf')
+        if h.sandtotal_r > 30 and h.claytotal_r is None:
+            found.add('null_clay')
+        if h.claytotal_r is None or h.claytotal_r <= 40:
+            if h.ecec_r is not None and h.ecec_r <= 0:
+                found.add('zero_cec')
+            if h.sandtotal_r < 0:
+                found.add('negative_sand')
+    #the baseline cropland values of the soil line come from the last horizon in database order
+    if values_list[-1].sandtotal_r is None:
+        found.add('null_baseline')
+    if not [h for h in values_list if h.ksat_r is not None and round(h.ksat_r*3.6, 2) >= 11]:
+        found.add('low_ksat')
+    return [problem for problem, why in validation_problems if problem in found]
+
+def validate_keys(key_type, keys, source=None):
+    '''Checks a list of mukeys or cokeys before generation: selects their components as the run will
+    (fetch_batch, one query and one horizon fetch) and scans all their horizons for the
+    validation_problems. Returns what validate_fetched returns'''
+    own_source = source is None
+    if own_source:
+        source = open_source()
+    problems, rejected = validate_fetched(key_type, keys, fetch_batch(key_type, keys, source))
+    if own_source:
+        source.close()
+    return problems, rejected
+
+def validate_fetched(key_type, keys, fetched):
+    '''validate_keys over what fetch_batch returned for keys. Returns {key: [(cokey, problem), ...]} for the
+    keys with a problem and the keys generate_batch would report as errors, in input order: those whose
+    every component fails. The other keys with a problem only lose their failing components (mukey:cokey
+    errors), or have no component and generate nothing'''
+    start = time.time() if profile is not None else None
+    dominant_dic, percents, horizon_dic = fetched
+    problems = {}
+    rejected = []
+    for key in keys:
+        if not dominant_dic.get(key):
+            problems[key] = [('', 'no_component')]
+            continue
+        found = [(c, horizon_problems(horizon_dic[c])) for c in dominant_dic[key]]
+        if [c for c, component_problems in found if component_problems]:
+            problems[key] = [(c, problem) for c, component_problems in found for problem in component_problems]
+            if all([component_problems for c, component_problems in found]):
+                rejected.append(key)
+    if start is not None:
+        profile.add('validate', start)
+        profile.count('keys rejected', len(rejected))
+    return problems, rejected
+
+def validated_batches(key_type, keys, size, report):
+    '''Yields each batch of size keys of a key stream without the keys validate_keys rejects, with what
+    fetch_batch returned for the batch, so generate_batch checks and generates from one read of the rows
+    and memory stays flat. Adds the keys checked, their problems and the rejected keys to report (checked,
+    problems, rejected) for write_validation. The data source is opened by whichever thread reads the
+    batches (--prefetch reads them in the background)'''
+    source = None
+    try:
+        for batch in batches(keys, size):
+            if source is None:
+                source = open_source()
+            fetched = fetch_batch(key_type, batch, source)
+            problems, rejected = validate_fetched(key_type, batch, fetched)
+            report['checked'] += len(batch)
+            report['problems'].update(problems)
+            report['rejected'].extend(rejected)
+            rejected = set(rejected)
+            kept = [key for key in batch if key not in rejected]
+            if kept:
+                yield kept, fetched
+    finally:
+        if source is not None:
+            source.close()
+
+def write_validation(path, key_type, report):
+    '''Writes the problems validated_batches found as .csv (key, cokey, problem, whether the key was left
+    out; one row per problem) and a summary next to it as .json (keys checked, left out and with a
+    problem, keys per problem, what each problem means)'''
+    problems, rejected = report['problems'], set(report['rejected'])
+    with open(path, 'wb') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow((key_type, 'cokey', 'problem', 'left_out'))
+        for key in sorted(problems, key=lambda key: (len(key), key)):
+            for cokey, problem in problems[key]:
+                writer.writerow((key, cokey, problem, 'yes' if key in rejected else 'no'))
+    counts = dict([(problem, len([key for key in problems if problem in [p for c, p in problems[key]]])) for problem, why in validation_problems])
+    summary = dict(key_type=key_type, checked=report['checked'], rejected=len(rejected), with_problems=len(problems),
+                   problems=dict([(p, n) for p, n in counts.items() if n]), descriptions=dict(validation_problems))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=1, sort_keys=True)
+    print 'Validated {} {}s: {} would fail and are left out, {} have a problem ({}); see {}'.format(
+        report['checked'], key_type, len(rejected), len(problems),
+        ', '.join(['%s %d' % (p, counts[p]) for p, why in validation_problems if counts[p]]) or 'none', path)
+    return summary
+
+def parse_shard(spec):
+    '''Returns (i, N) of a --shard i/N (1 <= i <= N)'''
+    try:
+        shard, shards = [int(v) for v in spec.split('/')]
+    except ValueError:
+        raise ValueError('--shard takes i/N, e.g. 2/8')
+    if not 1 <= shard <= shards:
+        raise ValueError('--shard %s: i must be between 1 and N' % spec)
+    return shard, shards
+
+def shard_of(key, shards):
+    '''Returns the shard (1 to shards) of a key: a stable hash, so every node, run and Python process
+    puts a key in the same shard whatever else is in its key list'''
+    return int(hashlib.md5(str(key).strip()).hexdigest()[:8], 16) % shards + 1
+
+def shard_keys(keys, shard, shards, counts):
+    '''Yields the keys of a key stream that fall in shard, counting them in counts['keys']'''
+    for key in keys:
+        if shard_of(key, shards) == shard:
+            counts['keys'] += 1
+            yield key
+
+def write_shard(out_dir, shard, shards, key_type, counts, errors, archive_path=None, layout='7778'):
+    '''Writes what merge_shards needs next to a shard's sol/ and soildic.txt: errors.txt (the keys that
+    failed) and shard.json (shard, database, settings, key and error counts, severity suffixes, and the
+    archive inside out_dir, relative to it, so the directory can be merged on another node)'''
+    with open(os.path.join(out_dir, 'errors.txt'), 'w') as error_file:
+        error_file.writelines(['%s\n' % key for key in errors])
+    info = dict(shard=shard, shards=shards, database=database_dir, key_type=key_type, keys=counts['keys'], errors=len(errors),
+                layout=layout, settings=settings_fingerprint(layout), dedup=dedup,
+                suffixes=[sev['suffix'] for sev in severity_table[layout]],
+                archive=os.path.relpath(archive_path, out_dir) if archive_path else None)
+    with open(os.path.join(out_dir, 'shard.json'), 'w') as info_file:
+        json.dump(info, info_file, indent=1, sort_keys=True)
+    print 'Shard {}/{}: {} of the keys, {} failed; written to {}'.format(shard, shards, counts['keys'], len(errors), out_dir)
+
+def shard_soils(names, suffixes):
+    '''Groups soil file names into soils: a soil is a name that has a file for every severity suffix.
+    Returns {soil: [file names]}; files of no complete soil are soils of their own'''
+    names = set(names)
+    soils = {}
+    for name in sorted(names):
+        for suffix in suffixes:
+            if suffix and name.endswith(suffix + '.sol'):
+                base = name[:-len(suffix + '.sol')]
+            elif not suffix:
+                base = name[:-len('.sol')]
+            else:
+                continue
+            files = ['%s%s.sol' % (base, s) for s in suffixes]
+            if all([f in names for f in files]):
+                soils[base] = files
+    grouped = set([f for files in soils.values() for f in files])
+    for name in names - grouped:
+        soils[name[:-len('.sol')]] = [name]
+    return soils
+
+def merge_shards(shard_dirs, out_dir='merged'):
+    '''Combines the output of --shard runs into out_dir: one sol/ (soil files), soildic.txt (shards in order,
+    a key kept from the first shard that has it), errors.txt (key,shard,database) and merge.json (shards
+    found and missing, keys, errors, soils and renamed soils). A soil name that shards generated with
+    different content (the header comment aside) is renamed [soil_name]_[content hash] in every shard
+    that has it, so no soil overwrites another; identical soils are written once. Shards have to come from
+    the same N and settings. Returns the report'''
+    shards = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'shard.json')) as info_file:
+            shards.append((json.load(info_file), shard_dir))
+    shards.sort(key=lambda shard: shard[0]['shard'])
+    first = shards[0][0]
+    for info, shard_dir in shards:
+        for field in ('shards', 'settings', 'suffixes', 'key_type'):
+            if info[field] != first[field]:
+                raise ValueError('%s was run with a different %s than %s' % (shard_dir, field, shards[0][1]))
+    numbers = [info['shard'] for info, shard_dir in shards]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError('Shards given twice: %s' % sorted(set([n for n in numbers if numbers.count(n) > 1])))
+    #every version of every soil name: (content hash, shard number, reader, files)
+    versions = defaultdict(list)
+    archives = []
+    for info, shard_dir in shards:
+        if info['archive']:
+            archives.append(SoilArchive(os.path.join(shard_dir, info['archive'])))
+            read, names = archives[-1].read, archives[-1].index['files'].keys()
+        else:
+            sol_dir = os.path.join(shard_dir, 'sol')
+            def read(name, sol_dir=sol_dir):
+                with open(os.path.join(sol_dir, name), 'rb') as sol_file:
+                    return sol_file.read()
+            names = [f for f in os.listdir(sol_dir) if f.endswith('.sol')]
+        for soil, files in sorted(shard_soils(names, info['suffixes']).items()):
+            content = hashlib.sha1()
+            for name in files:
+                content.update(name)
+                content.update(''.join([line for line in read(name).splitlines(True) if 'Component Key:' not in line]))
+            versions[soil].append((content.hexdigest(), info['shard'], read, files))
+    renamed = {}
+    names = {}
+    for soil, soil_versions in versions.items():
+        digests = set([digest for digest, shard, read, files in soil_versions])
+        for digest, shard, read, files in soil_versions:
+            names[(shard, soil)] = soil if len(digests) == 1 else '%s_%s' % (soil, digest[:8])
+        if len(digests) > 1:
+            renamed[soil] = sorted(set([names[(shard, soil)] for digest, shard, read, files in soil_versions]))
+    sol_dir = os.path.join(out_dir, 'sol')
+    if not os.path.isdir(sol_dir):
+        os.makedirs(sol_dir)
+    written = set()
+    for soil, soil_versions in sorted(versions.items()):
+        for digest, shard, read, files in soil_versions:
+            name = names[(shard, soil)]
+            if name in written:
+                continue
+            written.add(name)
+            for f in files:
+                with open(os.path.join(sol_dir, name + f[len(soil):]), 'wb') as sol_file:
+                    sol_file.write(read(f))
+    for archive in archives:
+        archive.close()
+    keys = {}
+    duplicate_keys = []
+    error_count = 0
+    with open(os.path.join(out_dir, 'soildic.txt'), 'w') as soildic, open(os.path.join(out_dir, 'errors.txt'), 'w') as error_file:
+        for info, shard_dir in shards:
+            lines = defaultdict(list)
+            order = []
+            with open(os.path.join(shard_dir, 'soildic.txt')) as shard_dic:
+                for line in shard_dic:
+                    fields = [f.strip() for f in line.split(',')]
+                    if len(fields) < 2:
+                        continue
+                    if fields[1] not in lines:
+                        order.append(fields[1])
+                    if fields[0] != 'none':
+                        line = ','.join([names.get((info['shard'], fields[0]), fields[0])] + fields[1:]) + '\n'
+                    lines[fields[1]].append(line)
+            for key in order:
+                if key in keys:
+                    duplicate_keys.append(key)
+                    continue
+                keys[key] = info['shard']
+                soildic.writelines(lines[key])
+            with open(os.path.join(shard_dir, 'errors.txt')) as shard_errors:
+                for key in shard_errors.read().split():
+                    error_count += 1
+                    error_file.write('%s,%s,%s\n' % (key, info['shard'], info['database']))
+    report = dict(shards=first['shards'], merged=numbers, missing=sorted(set(range(1, first['shards'] + 1)) - set(numbers)),
+                  databases=dict([(info['shard'], info['database']) for info, shard_dir in shards]),
+                  keys=sum([info['keys'] for info, shard_dir in shards]), errors=error_count, soils=len(written),
+                  renamed=renamed, duplicate_keys=sorted(duplicate_keys))
+    with open(os.path.join(out_dir, 'merge.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=1, sort_keys=True)
+    print 'Merged shards {} of {} into {}: {} keys, {} errors, {} soils, {} soil names renamed'.format(
+        ','.join([str(n) for n in numbers]), first['shards'], out_dir, report['keys'], error_count, len(written), len(renamed))
+    if report['missing']:
+        print 'Missing shards: {}'.format(','.join([str(n) for n in report['missing']]))
+    if duplicate_keys:
+        print '{} keys were in more than one shard; the first shard\'s soils were kept'.format(len(duplicate_keys))
+    return report
 
 def get_texture(sand, silt, clay):
     ''' Calcuations taken from http://www.nrcs.usda.gov/wps/portal/nrcs/detail/soils/survey/?cid=nrcs142p2_054167 
@@ -454,6 +1927,55 @@ def get_texture(sand, silt, clay):
 
     return texture, wepp_color
 
+#the (texture, wepp color) pairs get_texture can return, in the order of its branches; a texture class
+#code is an index into this tuple. The last entry is get_texture's default
+texture_classes = (('Sand', '246,232,195'), ('Loamy Sand', '223,194,125'), ('Sandy Loam', '191,129,45'),
+                   ('Loam', '84,48,5'), ('Silt Loam', '140,81,10'), ('Silt', '245,245,245'),
+                   ('Sandy Clay Loam', '199,234,229'), ('Clay Loam', '128,205,193'), ('Silty Clay Loam', '53,151,143'),
+                   ('Sandy Clay', '223,194,125'), ('Silty Clay', '1,102,94'), ('Clay', '0,60,48'), ('Sandy Loam', '84,48,5'))
+
+def texture_code(sand, clay):
+    '''Classifies integer sand and clay percents with get_texture and returns the class code'''
+    return texture_classes.index(get_texture(sand, 100 - (sand + clay), clay))
+
+#texture class codes of every integer sand (rows) and clay (columns) percent from 0 to 100, so classifying
+#a soil is a table lookup instead of the get_texture chain. Combinations over 100% are filled in too,
+#the same way get_texture classifies them
+texture_table = [[texture_code(sand, clay) for clay in range(101)] for sand in range(101)]
+
+def lookup_texture(sand, clay):
+    '''get_texture for integer sand and clay percents through texture_table; returns texture, wepp color'''
+    if 0 <= sand <= 100 and 0 <= clay <= 100:
+        return texture_classes[texture_table[sand][clay]]
+    return get_texture(sand, 100 - (sand + clay), clay)
+
+#texture_table as a numpy array for classify_textures, made on first use
+texture_lookup = None
+
+def texture_array():
+    '''texture_table as a numpy array, made on first use'''
+    global texture_lookup
+    if texture_lookup is None:
+        texture_lookup = np.array(texture_table, dtype=np.uint8)
+    return texture_lookup
+
+def classify_textures(sand_array, clay_array):
+    '''Returns the texture class codes (indexes into texture_classes) of whole arrays of sand and clay
+    percents at once. Values are truncated to integers like the first horizon of a soil file; NaN (NULL)
+    gets get_texture's default class and values outside 0-100 go through get_texture itself'''
+    sand = np.asarray(sand_array, dtype=float)
+    clay = np.asarray(clay_array, dtype=float)
+    sand, clay = np.broadcast_arrays(sand, clay)
+    codes = np.empty(sand.shape, dtype=np.uint8)
+    codes.fill(len(texture_classes) - 1)
+    with np.errstate(invalid='ignore'):
+        valid = (sand >= 0) & (sand < 101) & (clay >= 0) & (clay < 101)
+        outside = ~valid & ~np.isnan(sand) & ~np.isnan(clay)
+    codes[valid] = texture_array()[sand[valid].astype(int), clay[valid].astype(int)]
+    for i in zip(*np.nonzero(outside)):
+        codes[i] = texture_code(int(sand[i]), int(clay[i]))
+    return codes
+
 if __name__ == "__main__":
     
     cokey_set = ''
@@ -467,14 +1989,60 @@ if __name__ == "__main__":
     coparse.add_argument('-l', '--colist', help='A comma delimited list of cokey values (.csv)')
     coparse.add_argument('-m', '--mukey', help='A single mukey value')
     coparse.add_argument('-k', '--mulist', help='A comma delimited list of mukey values')
-    parser.add_argument('-d', '--database', help='The name (and location) of the database (.mdb)')
+    coparse.add_argument('-g', '--grid', help='A mukey grid (ESRI ASCII .asc or numpy .npy): every distinct mukey is generated once and mapped in --grid-map')
+    coparse.add_argument('-j', '--import-columns', help='Copy the horizons into a memory-mapped column store directory (.cols, needs numpy) and exit')
+    coparse.add_argument('-M', '--merge', nargs='+', help='Combine the output directories of --shard runs into --output-dir (default merged) and exit')
+    coparse.add_argument('-i', '--import-sqlite', help='Copy the component and chorizon tables from the database into an indexed SQLite file (.sqlite) and exit')
+    parser.add_argument('-d', '--database', help='The name (and location) of the database (.mdb, .sqlite made with --import-sqlite or .cols made with --import-columns)')
     parser.add_argument('-o', '--cotable', help='The name of the component table')
     parser.add_argument('-t', '--chtable', help='The name of the chorizon table')
+    parser.add_argument('-b', '--bulk', action='store_true', help='Stream a colist/mulist through the batched pipeline over one connection')
+    parser.add_argument('-n', '--batch-size', type=int, help='Keys per pipeline batch for --bulk/--workers runs (default {})'.format(batch_size))
+    parser.add_argument('-e', '--engine', choices=('scalar', 'numpy'), help='Horizon derivation engine for --bulk/--workers runs (default scalar)')
+    parser.add_argument('-s', '--severities', help='A .json file of burn severity multipliers added to (or replacing) the built-in ones')
+    parser.add_argument('-v', '--variants', help='A .csv or .json ensemble of multiplier sets written for every soil instead of the burn severities (calibration runs; see load_ensemble)')
+    parser.add_argument('-u', '--dedup', action='store_true', help='Name soil files by a hash of their content and write identical soils once (colist/mulist/grid runs; implies --bulk)')
+    parser.add_argument('-a', '--archive', help='Pack the soil files of a colist/mulist/grid run (implies --bulk) into one archive file (with an .idx index) instead of ' + write_path + '; files are named by content as with --dedup')
+    parser.add_argument('-f', '--manifest', help='Generation manifest (.jsonl) of a colist/mulist/grid run (implies --bulk); keys recorded there with unchanged source rows and settings are skipped')
+    parser.add_argument('-G', '--grid-map', default='gridmap.csv', help='mukey -> soil mapping of a --grid run (.csv, with coverage statistics in a .json beside it; default gridmap.csv)')
+    parser.add_argument('-z', '--nodata', type=float, help='NODATA value of a --grid (overrides the grid header)')
+    parser.add_argument('-x', '--min-pct', type=float, help='Generate every component of a mukey with comppct_r at least this, not just the dominant one (--bulk/--workers runs)')
+    parser.add_argument('-y', '--top', type=int, help='Generate the N largest components of a mukey by comppct_r (--bulk/--workers runs)')
+    parser.add_argument('-r', '--prefetch', type=int, nargs='?', const=2, default=0, help='Read the database ahead and write files on background threads, queueing up to N batches between stages (default 2; colist/mulist/grid runs, implies --bulk)')
+    parser.add_argument('-p', '--profile', nargs='?', const='profile.json', help='Time each stage and count connections, rows, horizons, defaults and files; prints a summary and writes it to a .json file (default profile.json)')
+    parser.add_argument('-V', '--validate', nargs='?', const='validation.csv', help='Check each batch of a colist/mulist/grid as it is read (implies --bulk) and leave out the keys that would fail; writes the keys with a problem to a .csv (and a summary .json; default validation.csv)')
+    parser.add_argument('-S', '--shard', help='Generate only shard i of N (i/N) of a colist/mulist, split by a stable hash of the keys, into --output-dir')
+    parser.add_argument('-O', '--output-dir', help='Output directory of a --shard run (default shard_i_of_N, holding sol/, soildic.txt, errors.txt and shard.json) or of --merge (default merged)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes for a colist/mulist (default 1)')
     
     args = parser.parse_args()
+    if args.profile:
+        profile = Profile()
+    out_dir = ''
+    shard = None
+    validation = dict(checked=0, problems={}, rejected=[]) if args.validate else None
+    if args.shard:
+        if not (args.colist or args.mulist):
+            sys.exit('--shard splits a colist (-l) or mulist (-k)')
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            sys.exit(str(e))
+        shard_counts = dict(keys=0)
+        out_dir = args.output_dir or 'shard_{}_of_{}'.format(*shard)
+        write_path = os.path.join(out_dir, 'sol') + os.sep
+        if not os.path.isdir(write_path):
+            os.makedirs(write_path)
+        if args.archive:
+            #each shard packs its own archive, inside its directory
+            args.archive = os.path.join(out_dir, os.path.basename(args.archive))
     
     
-    o2 = open('soildic.txt','w+')
+    #imports and --merge write no soils: leave the soildic.txt of an earlier run alone
+    if args.import_sqlite or args.import_columns or args.merge:
+        o2 = None
+    else:
+        o2 = open(os.path.join(out_dir, 'soildic.txt'),'w+')
     #handel arguments
            
     
@@ -484,6 +2052,43 @@ if __name__ == "__main__":
         database_dir = args.database
     else:
         print 'Using default database: ' + database_dir
+    if args.batch_size:
+        batch_size = args.batch_size
+    if args.dedup or args.archive:
+        #soil names are only unique within an archive when named by content
+        dedup = True
+    if args.severities:
+        load_severities(args.severities)
+    if args.variants:
+        ensemble = load_ensemble(args.variants)
+        if not ensemble:
+            sys.exit('No multiplier sets in ' + args.variants)
+        if not args.batch_size:
+            #about as many files per batch as the burn severities make
+            batch_size = max(1, batch_size * len(severity_table[weppfile]) // len(ensemble))
+        for layout in severity_table:
+            severity_table[layout] = ensemble
+        print 'Writing {} variants of each soil{}'.format(len(ensemble), '' if args.archive else '; consider --archive for large ensembles')
+    #the batched pipeline is what packs, dedups, records and prefetches: list runs with these go through it
+    pipeline_options = [flag for flag, given in (('--archive', args.archive), ('--dedup', args.dedup), ('--manifest', args.manifest),
+                                                 ('--prefetch', args.prefetch), ('--validate', args.validate)) if given]
+    if pipeline_options and (args.cokey or args.mukey):
+        sys.exit('The batched pipeline options ({}) apply to colist, mulist and grid runs'.format(', '.join(pipeline_options)))
+    if pipeline_options and (args.colist or args.mulist) and not args.bulk and args.workers < 2:
+        print 'Using the --bulk pipeline for {}'.format(', '.join(pipeline_options))
+        args.bulk = True
+    if args.engine:
+        engine = args.engine
+    if engine == 'numpy' and np is None:
+        sys.exit('numpy is required for --engine numpy')
+    if engine == 'numpy' and not args.bulk and args.workers < 2 and not args.grid:
+        print 'The numpy engine derives whole key lists at once; add --bulk to use it'
+    if args.min_pct is not None:
+        min_pct = args.min_pct
+    if args.top is not None:
+        top_components = args.top
+    if (min_pct is not None or top_components is not None) and not args.bulk and args.workers < 2 and not args.grid:
+        print 'Component selection (--min-pct/--top) applies to mukey lists run with --bulk or --workers'
     if args.cotable:
         component_table = args.cotable
     else:
@@ -495,26 +2100,52 @@ if __name__ == "__main__":
         
         
     #args for cokey, colist, mukey, mulist as cmd line arguments
-    if args.cokey:
+    if args.import_sqlite:
+        print 'Importing {} into {}'.format(database_dir, args.import_sqlite)
+        try:
+            import_sqlite(args.import_sqlite)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif args.import_columns:
+        print 'Importing {} into {}'.format(database_dir, args.import_columns)
+        import_columns(args.import_columns)
+    elif args.merge:
+        try:
+            merge_shards(args.merge, args.output_dir or 'merged')
+        except (IOError, ValueError) as e:
+            sys.exit(str(e))
+    elif args.cokey:
         print 'Using cokey'
         create_file(args.cokey)
     elif args.colist:
         print 'Using cokey list'
-        with open(args.colist, 'rb') as cokey_file:
-            cokey_arr = csv.reader(cokey_file)
-            for row in cokey_arr:
-                create_file(row[0])
+        keys = read_keys(args.colist) if shard is None else shard_keys(read_keys(args.colist), shard[0], shard[1], shard_counts)
+        if args.bulk or args.workers > 1:
+            error_list = run_pipeline('cokey', keys, o2, args.workers, manifest_path=args.manifest, archive_path=args.archive, prefetch=args.prefetch, validation=validation)
+        else:
+            for c in keys:
+                create_file(c)
     elif args.mukey:
         print 'Using mukey'
         for c in find_dominant_soil(args.mukey):
             create_file(str(c))
     elif args.mulist:
         print 'Using mukey list'
-        with open(args.mulist, 'rb') as mukey_file:
-            mukey_arr = csv.reader(mukey_file)
-            for mu in mukey_arr:
-                for c in find_dominant_soil(mu[0]):
-                    create_file(c,mu[0])
+        keys = read_keys(args.mulist) if shard is None else shard_keys(read_keys(args.mulist), shard[0], shard[1], shard_counts)
+        if args.bulk or args.workers > 1:
+            error_list = run_pipeline('mukey', keys, o2, args.workers, manifest_path=args.manifest, archive_path=args.archive, prefetch=args.prefetch, validation=validation)
+        else:
+            for mu in keys:
+                for c in find_dominant_soil(mu):
+                    create_file(c, mu)
+    elif args.grid:
+        print 'Using mukey grid'
+        counts, nodata_pixels = grid_counts(args.grid, args.nodata)
+        lines = StringIO.StringIO()
+        keys = iter(sorted(counts))
+        error_list = run_pipeline('mukey', keys, lines, args.workers, manifest_path=args.manifest, archive_path=args.archive, prefetch=args.prefetch, validation=validation)
+        o2.write(lines.getvalue())
+        write_grid_map(args.grid_map, counts, nodata_pixels, lines.getvalue().splitlines())
                 
         
         
@@ -548,8 +2179,17 @@ if __name__ == "__main__":
                 else:
                     
                     create_file(find_dominant_soil(muinput))
+    if args.validate and (args.colist or args.mulist or args.grid):
+        write_validation(os.path.join(out_dir, args.validate), 'cokey' if args.colist else 'mukey', validation)
+        #keys --validate left out failed too
+        error_list = validation['rejected'] + error_list
     print error_list
-    o2.close()
+    if o2 is not None:
+        o2.close()
+    if shard is not None:
+        write_shard(out_dir, shard[0], shard[1], 'cokey' if args.colist else 'mukey', shard_counts, error_list, args.archive)
+    if profile is not None:
+        profile.report(args.profile)
     
     
     
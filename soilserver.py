@@ -0,0 +1,250 @@
+import argparse, json, sys, threading, time, urlparse, Queue
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import soilgenFire as sg
+'''
+soilserver
+Long-lived local soil service: keeps the soils database open and answers soil file requests over HTTP from
+LRU caches of dominant components, derived horizons and rendered soils, so a front end no longer starts
+soilgenFire.py (and connects and derives again) for every soil.
+
+---------------------------------------------------------------------------
+
+input:
+    comand line:
+        >soilserver.py --database soils.sqlite --port 8077
+        -d/--database [soils.mdb or soils.sqlite] the soils database (a .sqlite made with soilgenFire.py --import-sqlite,
+            or soilbench.py --database for a synthetic stand-in)
+        -o/--cotable, -t/--chtable component and chorizon table names (default component, chorizon)
+        -H/--host [127.0.0.1] and -P/--port [8077] address to listen on
+        -n/--cache-size [N] soils (and as many derived horizons and mukeys) each cache holds (default 10000)
+        -s/--severities [severities.json] burn severities added to (or replacing) the built-in ones, as in soilgenFire.py
+        -q/--quiet no request log
+
+requests:
+    GET /soil?mukey=[mukey]&format=[7778|95.7]&severity=[unb|low|mod|high|norm]
+    GET /soil?cokey=[cokey]&format=...&severity=...
+        the soil file text of the dominant component of a mukey (or of a cokey); format defaults to 7778 and
+        severity to norm. X-Soil-Name, X-Cokey and X-Cache (hit or miss) headers describe the answer
+    GET /stats
+        json with the hits, misses and size of each cache and the requests served
+
+output: WEPP soil file text (text/plain) or json
+'''
+
+'''Global Vars'''
+#soils (and derived horizons and mukeys) held by each cache
+cache_size = 10000
+
+#severity served when a request names none
+default_severity = 'norm'
+
+class LRUCache(object):
+    '''Least recently used cache of at most size entries, counting hits and misses. Safe to share
+    between the request threads'''
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the cached value of key, or None'''
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, size=len(self.entries), capacity=self.size,
+                        hit_rate=float(self.hits) / requests if requests else None)
+
+class SoilService(object):
+    '''Soil lookups through the caches. Cache misses go to one SoilGenerator that lives on its own
+    thread (database connections stay in the thread that opened them), so requests that hit the
+    caches never wait on the database'''
+    def __init__(self, database, tables=('component', 'chorizon'), severities=None, size=cache_size):
+        self.components = LRUCache(size)
+        self.derived = LRUCache(size)
+        self.soils = LRUCache(size)
+        self.started = time.time()
+        #served and failed are counted by the request threads
+        self.lock = threading.Lock()
+        self.served = 0
+        self.failed = 0
+        self.backend = sg.QueueThread(self.run_call, 64)
+        self.generator = None
+        try:
+            self.call(self.open, database, tables, severities)
+        except Exception:
+            self.backend.close()
+            raise
+
+    def open(self, database, tables, severities):
+        self.generator = sg.SoilGenerator(database, tables=tables, severities=severities)
+
+    def run_call(self, item):
+        func, args, reply = item
+        try:
+            reply.put((func(*args), None))
+        except Exception:
+            reply.put((None, sys.exc_info()))
+
+    def call(self, func, *args):
+        '''Runs func(*args) on the database thread and returns (or raises) what it did'''
+        reply = Queue.Queue(1)
+        self.backend.put((func, args, reply))
+        result, error = reply.get()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return result
+
+    def dominant_cokey(self, mukey):
+        '''Returns the dominant cokey of a mukey (the first one on a tie, as the 95.7 command line does)'''
+        cokey = self.components.get(mukey)
+        if cokey is None:
+            cokeys = self.call(self.generator.dominant_soils, [mukey])[mukey]
+            if not cokeys:
+                raise KeyError('No components for mukey %s' % mukey)
+            cokey = cokeys[0]
+            self.components.put(mukey, cokey)
+        return cokey
+
+    def derive(self, cokey):
+        '''Returns the derived horizons of a cokey, as sort_values'''
+        derived = self.derived.get(cokey)
+        if derived is None:
+            values_list = self.call(self.generator.horizons, [cokey])[cokey]
+            if not values_list:
+                raise KeyError('No horizons for cokey %s' % cokey)
+            derived = sg.sort_values(values_list, verbose=False)
+            self.derived.put(cokey, derived)
+        return derived
+
+    def soil(self, cokey, layout):
+        '''Returns the GeneratedSoil of a cokey and layout, and whether it came from the cache'''
+        soil = self.soils.get((cokey, layout))
+        if soil is not None:
+            return soil, True
+        soil = self.generator.render(cokey, self.derive(cokey), layout)
+        self.soils.put((cokey, layout), soil)
+        return soil, False
+
+    def count(self, served):
+        '''Counts a request answered with a soil (served) or an error'''
+        with self.lock:
+            if served:
+                self.served += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            served, failed = self.served, self.failed
+        return dict(uptime=time.time() - self.started, served=served, failed=failed,
+                    caches=dict(components=self.components.stats(), derived=self.derived.stats(), soils=self.soils.stats()))
+
+    def close(self):
+        if self.generator is not None:
+            self.call(self.generator.close)
+        self.backend.close()
+
+class SoilHandler(BaseHTTPRequestHandler):
+    '''GET /soil and GET /stats; the SoilService is the server's service attribute'''
+    quiet = False
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict([(k, v[-1]) for k, v in urlparse.parse_qs(url.query).items()])
+        service = self.server.service
+        if url.path == '/stats':
+            return self.reply(200, json.dumps(service.stats(), indent=1, sort_keys=True), 'application/json')
+        if url.path != '/soil':
+            return self.reply(404, 'Unknown path %s; use /soil or /stats\n' % url.path)
+        layout = query.get('format', '7778')
+        severity = query.get('severity', default_severity)
+        if layout not in service.generator.severities:
+            return self.reply(400, 'Unknown format %s\n' % layout)
+        if severity not in [sev['name'] for sev in service.generator.severities[layout]]:
+            return self.reply(400, 'Unknown severity %s for format %s\n' % (severity, layout))
+        if 'cokey' not in query and 'mukey' not in query:
+            return self.reply(400, 'Give a mukey or cokey\n')
+        try:
+            cokey = query['cokey'] if 'cokey' in query else service.dominant_cokey(query['mukey'])
+            soil, hit = service.soil(cokey, layout)
+        except KeyError as e:
+            service.count(False)
+            return self.reply(404, '%s\n' % e.args[0])
+        except Exception as e:
+            #NULLs sort_values has no default for, no layer with ksat >= 11 and the like
+            service.count(False)
+            return self.reply(500, 'Could not generate the soil of %s: %r\n' % (query.get('cokey') or query.get('mukey'), e))
+        service.count(True)
+        self.reply(200, soil.severities[severity], headers=(('X-Soil-Name', soil.name), ('X-Cokey', soil.cokey),
+                                                             ('X-Cache', 'hit' if hit else 'miss')))
+
+    def reply(self, status, body, content_type='text/plain', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class SoilServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server answering each request on its own thread'''
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, SoilHandler)
+        self.service = service
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--database', default=sg.database_dir, help='The soils database (.mdb, or .sqlite made with soilgenFire.py --import-sqlite)')
+    parser.add_argument('-o', '--cotable', default=sg.component_table, help='The name of the component table')
+    parser.add_argument('-t', '--chtable', default=sg.chorizon_table, help='The name of the chorizon table')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+    parser.add_argument('-P', '--port', type=int, default=8077, help='Port to listen on (default 8077)')
+    parser.add_argument('-n', '--cache-size', type=int, default=cache_size, help='Entries held by each cache (default {})'.format(cache_size))
+    parser.add_argument('-s', '--severities', help='A .json file of burn severity multipliers added to (or replacing) the built-in ones')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not log requests')
+
+    args = parser.parse_args()
+    severities = None
+    if args.severities:
+        with open(args.severities) as config:
+            severities = json.load(config)
+    SoilHandler.quiet = args.quiet
+
+    service = SoilService(args.database, (args.cotable, args.chtable), severities, args.cache_size)
+    server = SoilServer((args.host, args.port), service)
+    print 'Serving soils from {} on http://{}:{}/soil'.format(args.database, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,315 @@
+import argparse, json, multiprocessing, os, sys, time
+import soilgenFire as sg
+np = sg.np
+'''
+solreader
+Reads the WEPP soil files soilgenFire.py writes (the 7778 and 95.7 layouts of create_file, create_957 and
+render_soil) into columns, many files at a time, and diffs two sets of them field by field with tolerances,
+so a new version of the generator can be checked against a reference set of tens of thousands of files.
+
+---------------------------------------------------------------------------
+
+input:
+    comand line:
+        >solreader.py --load sol/ --output columns.npz
+        >solreader.py --diff reference/sol/ sol/ --atol 0.001 --tolerance ksat=0.01
+        -l/--load [sol/ or soils.pack] parses every .sol file of a directory (or of an --archive of soilgenFire.py)
+            and prints a summary; -o/--output [columns.npz] saves the soil and layer columns (needs numpy)
+        -D/--diff [reference] [new] compares the files with the same name in two directories or archives: missing
+            and extra files, names, textures and layer counts, and per numeric field how many values differ by
+            more than the tolerance and by how much at most (needs numpy)
+        -a/--atol [X] and -r/--rtol [X] tolerance of every numeric field: values differ when
+            |new - reference| > atol + rtol * |reference| (default 0: any numeric difference)
+        -t/--tolerance [field=atol] absolute tolerance of one field (repeatable), e.g. -t ki=1 -t ksat=0.01
+        -j/--json [report.json] writes the diff report as json
+        -w/--workers [N] processes parsing the files (default the number of CPUs)
+
+library:
+    parse_sol(text) returns the parts of one soil file (SolFile); load_columns('sol/') the columns of a set
+
+output: a summary, columns (.npz) or a diff report; --diff exits with 1 when the sets differ
+'''
+
+'''Global Vars'''
+#values of the soil line after the name, texture and number of layers
+soil_fields = ('albedo', 'init_sat', 'ki', 'kr', 'tauc', 'keff')
+
+#layer line values of each layout, in file order
+layout_layer_fields = {'7778': ('depth', 'smr_bd', 'ksat', 'anisotropy', 'fc', 'wp', 'sand', 'clay', 'om', 'cec', 'rocks'),
+                       '95.7': ('depth', 'sand', 'clay', 'om', 'cec', 'rocks')}
+
+#values of the last line: 7778 files end with "1 13 1000 [ksat_min]", 95.7 files with the texture color
+layout_tail_fields = {'7778': ('tail_1', 'tail_13', 'tail_1000', 'ksat_min'),
+                      '95.7': ('red', 'green', 'blue')}
+
+#numeric columns of a loaded set: one value per file, and one per layer (NaN where a layout has no such value)
+file_fields = soil_fields + ('tail_1', 'tail_13', 'tail_1000', 'ksat_min', 'red', 'green', 'blue')
+layer_fields = sg.layer_fields
+
+#text columns, compared exactly by --diff
+text_fields = ('layout', 'version', 'name', 'texture', 'cokey', 'nlayers')
+
+#files parsed per task handed to a worker process
+parse_chunk = 200
+
+#differing files listed per field in a diff report
+max_examples = 10
+
+class SolFile(sg.Record):
+    '''The parts of one soil file: layout (7778 or 95.7, from the number of layer values), the version
+    line, the soil and texture names, cokey (from the header comment), the soil line values, the layers
+    (a tuple of values per layer, in layout_layer_fields order) and the values of the last line'''
+    __slots__ = ('layout', 'version', 'name', 'texture', 'cokey', 'soil', 'layers', 'tail')
+
+def parse_sol(text):
+    '''Parses the text of one soil file as written by soilgenFire.py and returns a SolFile.
+    Raises ValueError if the text does not have that layout'''
+    lines = text.splitlines()
+    version = lines[0].strip() if lines else ''
+    cokey = ''
+    for i, line in enumerate(lines):
+        if line.startswith("'"):
+            break
+        if 'Component Key:' in line:
+            cokey = line.split('Component Key:')[1].split()[0]
+    else:
+        raise ValueError('No soil line')
+    #'name'    'texture'    layers    albedo    init_sat    ki    kr    tauc    keff
+    parts = line.split("'")
+    if len(parts) != 5:
+        raise ValueError('Bad soil line: %s' % line)
+    values = parts[4].split()
+    nlayers = int(values[0])
+    soil = tuple([float(v) for v in values[1:]])
+    if len(soil) != len(soil_fields):
+        raise ValueError('Bad soil line: %s' % line)
+    layers = tuple([tuple([float(v) for v in layer.split()]) for layer in lines[i + 1:i + 1 + nlayers]])
+    width = len(layers[0]) if layers else 0
+    layout = '7778' if width == len(layout_layer_fields['7778']) else '95.7' if width == len(layout_layer_fields['95.7']) else None
+    if layout is None or len(layers) != nlayers or [layer for layer in layers if len(layer) != width]:
+        raise ValueError('Bad layer lines for %d layers' % nlayers)
+    rest = [line for line in lines[i + 1 + nlayers:] if line.strip()]
+    tail = tuple([float(v) for v in rest[0].split()]) if len(rest) == 1 else ()
+    if len(tail) != len(layout_tail_fields[layout]):
+        raise ValueError('Bad last line: %s' % ' | '.join(rest))
+    return SolFile(layout, version, parts[1], parts[3], cokey, soil, layers, tail)
+
+def sol_names(source):
+    '''Returns the soil file names of a directory or archive, sorted'''
+    if os.path.isdir(source):
+        return sorted([f for f in os.listdir(source) if f.endswith('.sol')])
+    archive = sg.SoilArchive(source)
+    archive.close()
+    return sorted(archive.index['files'])
+
+#the source parse_files reads from, opened once per process by open_reader
+reader = None
+
+def open_reader(source):
+    '''Sets the reader of parse_files to a function returning the text of one file of a directory or archive'''
+    global reader
+    if os.path.isdir(source):
+        def reader(name):
+            with open(os.path.join(source, name), 'rb') as sol:
+                return sol.read()
+    else:
+        reader = sg.SoilArchive(source).read
+
+def parse_files(names):
+    '''Parses the files of a chunk of names; returns (name, SolFile or None, error) each'''
+    parsed = []
+    for name in names:
+        try:
+            parsed.append((name, parse_sol(reader(name)), None))
+        except Exception as e:
+            parsed.append((name, None, '%s: %s' % (e.__class__.__name__, e)))
+    return parsed
+
+def load_sols(source, workers=None):
+    '''Parses every soil file of a directory or archive, in name order, over workers processes (default one
+    per CPU). Returns a list of (name, SolFile) and a list of (name, error) for the files that did not parse'''
+    names = sol_names(source)
+    chunks = [names[i:i + parse_chunk] for i in range(0, len(names), parse_chunk)]
+    workers = workers or multiprocessing.cpu_count()
+    if workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(chunks)), open_reader, (source,))
+        try:
+            results = pool.map(parse_files, chunks)
+        finally:
+            pool.terminate()
+    else:
+        open_reader(source)
+        results = [parse_files(chunk) for chunk in chunks]
+    sols, errors = [], []
+    for name, sol, error in [item for result in results for item in result]:
+        if error is None:
+            sols.append((name, sol))
+        else:
+            errors.append((name, error))
+    return sols, errors
+
+def columns(sols):
+    '''Returns the columns of a list of (name, SolFile): file columns (file, the text_fields and a numpy
+    array per file_fields field, plus first_layer, the index of each file's first layer) and layer columns
+    (file, the index of the file of each layer, and an array per layer_fields field). Values a layout does
+    not have are NaN'''
+    if np is None:
+        sys.exit('numpy is required for soil file columns')
+    files = dict(file=np.array([name for name, sol in sols], dtype=object))
+    for field in text_fields:
+        files[field] = np.array([len(sol.layers) if field == 'nlayers' else sol[field] for name, sol in sols], dtype=int if field == 'nlayers' else object)
+    nan = float('nan')
+    for layout in layout_tail_fields:
+        tail_fields = layout_tail_fields[layout]
+        for j, field in enumerate(tail_fields):
+            files[field] = [sol.tail[j] if sol.layout == layout else nan for name, sol in sols]
+    for j, field in enumerate(soil_fields):
+        files[field] = [sol.soil[j] for name, sol in sols]
+    for field in file_fields:
+        files[field] = np.array(files[field], dtype=float)
+    files['first_layer'] = np.concatenate([[0], np.cumsum(files['nlayers'])[:-1]]).astype(int) if sols else np.zeros(0, int)
+    layers = dict(file=np.repeat(np.arange(len(sols)), files['nlayers']))
+    rows = dict([(layout, np.array([layer for name, sol in sols if sol.layout == layout for layer in sol.layers], dtype=float).reshape(-1, len(fields)))
+                 for layout, fields in layout_layer_fields.items()])
+    is_layout = dict([(layout, np.repeat(files['layout'] == layout, files['nlayers'])) for layout in layout_layer_fields])
+    for field in layer_fields:
+        layers[field] = np.full(len(layers['file']), np.nan)
+        for layout, fields in layout_layer_fields.items():
+            if field in fields:
+                layers[field][is_layout[layout]] = rows[layout][:, fields.index(field)]
+    return files, layers
+
+def load_columns(source, workers=None):
+    '''Parses every soil file of a directory or archive into columns (see columns). Returns the file
+    columns, the layer columns and the (name, error) of files that did not parse'''
+    sols, errors = load_sols(source, workers)
+    files, layers = columns(sols)
+    return files, layers, errors
+
+def compare_field(report, field, ref, new, names, tolerance):
+    '''Adds the differences of one numeric field to a diff report: values differ when
+    |new - ref| > atol + rtol * |ref|; NaN only equals NaN'''
+    atol, rtol = tolerance
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.abs(new - ref)
+        differ = (delta > atol + rtol * np.abs(ref)) | (np.isnan(ref) != np.isnan(new))
+        relative = delta / np.abs(ref)
+    compared = int((~np.isnan(ref) | ~np.isnan(new)).sum())
+    if not compared:
+        return
+    entry = dict(compared=compared, differ=int(differ.sum()), atol=atol, rtol=rtol)
+    if entry['differ']:
+        #a NaN on one side only sorts first
+        worst = np.where(differ, np.where(np.isnan(delta), np.inf, delta), -1)
+        order = np.argsort(-worst, kind='mergesort')[:max_examples]
+        finite = differ & np.isfinite(delta)
+        entry['max_abs'] = float(delta[finite].max()) if finite.any() else None
+        finite &= np.isfinite(relative)
+        entry['max_rel'] = float(relative[finite].max()) if finite.any() else None
+        entry['examples'] = [dict(file=names[k], reference=float(ref[k]), new=float(new[k])) for k in order if differ[k]]
+    report['fields'][field] = entry
+
+def diff_sols(reference, new, atol=0.0, rtol=0.0, tolerances=None, workers=None):
+    '''Compares the soil files of two directories or archives by file name. tolerances maps field names to
+    their own absolute tolerance. Returns a report: file counts, missing (in new) and extra files, files
+    that did not parse, text fields that differ and, per numeric field, the values compared, how many differ
+    and by how much at most, with examples. Layers are compared for files with the same number of layers'''
+    tolerances = tolerances or {}
+    unknown = [f for f in tolerances if f not in file_fields + layer_fields]
+    if unknown:
+        raise ValueError('Unknown fields %s; use one of %s' % (', '.join(unknown), ', '.join(file_fields + layer_fields)))
+    ref_files, ref_layers, ref_errors = load_columns(reference, workers)
+    new_files, new_layers, new_errors = load_columns(new, workers)
+    ref_index = dict([(name, i) for i, name in enumerate(ref_files['file'])])
+    new_index = dict([(name, i) for i, name in enumerate(new_files['file'])])
+    common = sorted(set(ref_index) & set(new_index))
+    report = dict(reference=reference, new=new, files=dict(reference=len(ref_index), new=len(new_index), common=len(common)),
+                  missing=sorted(set(ref_index) - set(new_index)), extra=sorted(set(new_index) - set(ref_index)),
+                  errors=dict(reference=ref_errors, new=new_errors), text={}, fields={})
+    r = np.array([ref_index[name] for name in common], dtype=int)
+    n = np.array([new_index[name] for name in common], dtype=int)
+    for field in text_fields:
+        differ = np.flatnonzero(ref_files[field][r] != new_files[field][n])
+        if len(differ):
+            report['text'][field] = dict(differ=len(differ), examples=[dict(file=common[k], reference=str(ref_files[field][r[k]]),
+                                                                          new=str(new_files[field][n[k]])) for k in differ[:max_examples]])
+    for field in file_fields:
+        compare_field(report, field, ref_files[field][r], new_files[field][n], common, (tolerances.get(field, atol), rtol))
+    #layers of the files whose layer counts agree, in the same order on both sides
+    same = ref_files['nlayers'][r] == new_files['nlayers'][n]
+    counts = ref_files['nlayers'][r][same]
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    within = np.arange(counts.sum()) - offsets
+    ref_rows = np.repeat(ref_files['first_layer'][r][same], counts) + within
+    new_rows = np.repeat(new_files['first_layer'][n][same], counts) + within
+    layer_names = np.repeat(np.array(common, dtype=object)[same], counts) if len(common) else np.zeros(0, object)
+    layer_names = np.array(['%s layer %d' % (name, k + 1) for name, k in zip(layer_names, within)], dtype=object)
+    for field in layer_fields:
+        compare_field(report, field, ref_layers[field][ref_rows], new_layers[field][new_rows], layer_names, (tolerances.get(field, atol), rtol))
+    report['same'] = not (report['missing'] or report['extra'] or ref_errors or new_errors or report['text'] or
+                          [entry for entry in report['fields'].values() if entry['differ']])
+    return report
+
+def print_report(report):
+    files = report['files']
+    print 'Reference {}: {} files; new {}: {} files; {} in both'.format(report['reference'], files['reference'], report['new'], files['new'], files['common'])
+    for label, names in (('Missing from new', report['missing']), ('Only in new', report['extra'])):
+        if names:
+            print '{} ({}): {}{}'.format(label, len(names), ', '.join(names[:max_examples]), ' ...' if len(names) > max_examples else '')
+    for side, errors in sorted(report['errors'].items()):
+        for name, error in errors[:max_examples]:
+            print 'Could not parse {} {}: {}'.format(side, name, error)
+    for field, entry in sorted(report['text'].items()):
+        print '{:<12} {:>8} differ, e.g. {file}: {reference!r} -> {new!r}'.format(field, entry['differ'], **entry['examples'][0])
+    print '{:<12} {:>9} {:>8} {:>12} {:>12}'.format('field', 'compared', 'differ', 'max abs', 'max rel')
+    for field in file_fields + layer_fields:
+        entry = report['fields'].get(field)
+        if entry:
+            print '{:<12} {:>9} {:>8} {:>12} {:>12}'.format(field, entry['compared'], entry['differ'], '%.6g' % entry['max_abs'] if entry.get('max_abs') is not None else '',
+                                                         '%.6g' % entry['max_rel'] if entry.get('max_rel') is not None else '')
+    for field in file_fields + layer_fields:
+        for example in report['fields'].get(field, {}).get('examples', [])[:3]:
+            print '  {:<10} {file}: {reference!r} -> {new!r}'.format(field, **example)
+    print 'Same' if report['same'] else 'Different'
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('-l', '--load', help='A directory of .sol files or a soilgenFire.py --archive to parse and summarize')
+    action.add_argument('-D', '--diff', nargs=2, metavar=('REFERENCE', 'NEW'), help='Two directories or archives of soil files to compare')
+    parser.add_argument('-o', '--output', help='Save the columns of --load to a .npz file')
+    parser.add_argument('-a', '--atol', type=float, default=0.0, help='Absolute tolerance of every numeric field (default 0)')
+    parser.add_argument('-r', '--rtol', type=float, default=0.0, help='Relative tolerance of every numeric field (default 0)')
+    parser.add_argument('-t', '--tolerance', action='append', default=[], help='Absolute tolerance of one field, as field=value (repeatable)')
+    parser.add_argument('-j', '--json', help='Write the diff report to a .json file')
+    parser.add_argument('-w', '--workers', type=int, help='Processes parsing files (default the number of CPUs)')
+
+    args = parser.parse_args()
+    start = time.time()
+    if args.load:
+        files, layers, errors = load_columns(args.load, args.workers)
+        print 'Parsed {} files ({} layers) in {:.2f} s'.format(len(files['file']), len(layers['file']), time.time() - start)
+        for layout in sorted(layout_layer_fields):
+            print '  {}: {} files'.format(layout, int((files['layout'] == layout).sum()))
+        for name, error in errors:
+            print 'Could not parse {}: {}'.format(name, error)
+        if args.output:
+            arrays = dict([('file_' + f, v) for f, v in files.items()] + [('layer_' + f, v) for f, v in layers.items()])
+            np.savez(args.output, **arrays)
+            print 'Columns saved to ' + args.output
+        sys.exit(1 if errors else 0)
+    try:
+        tolerances = dict([(field.strip(), float(value)) for field, value in [t.split('=', 1) for t in args.tolerance]])
+    except ValueError:
+        sys.exit('Tolerances are given as field=value')
+    try:
+        report = diff_sols(args.diff[0], args.diff[1], args.atol, args.rtol, tolerances, args.workers)
+    except ValueError as e:
+        sys.exit(str(e))
+    print_report(report)
+    print 'Compared in {:.2f} s'.format(time.time() - start)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
+    sys.exit(0 if report['same'] else 1)
@@ -0,0 +1,930 @@
+import StringIO, csv, json, os, random, shutil, sqlite3, sys, tempfile, unittest
+import soilgenFire as sg
+import soilbench
+'''
+test_soilgen
+Tests of soilgenFire.py on a synthetic SQLite soils database (soilbench.make_database).
+
+    >python -m unittest test_soilgen
+'''
+
+'''Global Vars'''
+#mukeys in the synthetic database
+test_mukeys = 300
+
+#directory of the synthetic database, made once for the module
+test_dir = None
+
+def setUpModule():
+    global test_dir
+    test_dir = tempfile.mkdtemp(prefix='soilgen_test')
+    soilbench.make_database(os.path.join(test_dir, 'synthetic.sqlite'), test_mukeys)
+
+def tearDownModule():
+    shutil.rmtree(test_dir)
+
+def database_path():
+    return os.path.join(test_dir, 'synthetic.sqlite')
+
+def all_horizons(source):
+    '''Returns the mukeys of the test database and the horizons of every one of its cokeys'''
+    mukeys = [str(r[0]) for r in source.query("SELECT DISTINCT mukey FROM %s" % sg.component_table)]
+    cokeys = [str(r[0]) for r in source.query("SELECT cokey FROM %s" % sg.component_table)]
+    return mukeys, sg.fetch_data_bulk(cokeys, source)
+
+def scalar(values_list):
+    '''Returns what sort_values returns, or the exception class it raises'''
+    try:
+        return sg.sort_values(values_list, verbose=False)
+    except Exception as e:
+        return e.__class__
+
+def renders(cokey, values_list):
+    '''Returns whether sort_values and render_soil make a soil of the horizons'''
+    try:
+        sg.render_soil(cokey, sg.sort_values(values_list, verbose=False))
+        return True
+    except Exception:
+        return False
+
+#chorizon values sort_values defaults, skips or fails on
+null_cases = (('hzdepb_r', (None, 12.25, 1.005, 50)), ('claytotal_r', (None, 40, 40.0, 55.0, 9.0)),
+              ('sandtotal_r', (None, 30, 30.5, 80.0)), ('sandvf_r', (None, 0, 12.5)), ('ecec_r', (None, 0, 0.0, 2.675)),
+              ('fraggt10_r', (None, 100, 60)), ('frag3to10_r', (None, 0, 40)), ('om_r', (None, 0.125, 3)),
+              ('dbthirdbar_r', (None, 1.25)), ('ksat_r', (None, 0.5)), ('wthirdbar_r', (None, 12.0)),
+              ('wfifteenbar_r', (None, 5.0)), ('sieveno10_r', (None, 80.0)))
+
+def add_nulls(horizon_dic, seed=3):
+    '''Puts null_cases into random horizons'''
+    rnd = random.Random(seed)
+    for cokey in sorted(horizon_dic)[::2]:
+        for h in horizon_dic[cokey]:
+            field, values = rnd.choice(null_cases)
+            setattr(h, field, rnd.choice(values))
+
+def null_database(seed=3):
+    '''Returns the path of a copy of the test database with null_cases in a third of its horizons'''
+    path = os.path.join(test_dir, 'nulls.sqlite')
+    if not os.path.exists(path):
+        shutil.copy(database_path(), path)
+        rnd = random.Random(seed)
+        con = sqlite3.connect(path)
+        for (rowid,) in con.execute("SELECT rowid FROM %s" % sg.chorizon_table).fetchall()[::3]:
+            field, values = rnd.choice(null_cases)
+            con.execute("UPDATE %s SET %s = ? WHERE rowid = ?" % (sg.chorizon_table, field), (rnd.choice(values), rowid))
+        con.commit()
+        con.close()
+    return path
+
+def run(key_type, keys, **options):
+    '''run_pipeline over the test database without its progress output; returns its errors and soildic lines'''
+    soildic = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        errors = sg.run_pipeline(key_type, iter(keys), soildic, **options)
+    finally:
+        sys.stdout = stdout
+    return errors, soildic.getvalue().splitlines(True)
+
+def generate(key_type, keys, source):
+    '''generate_batch without its progress output'''
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        return sg.generate_batch(key_type, keys, source)
+    finally:
+        sys.stdout = stdout
+
+class EngineTest(unittest.TestCase):
+    '''sort_values_batch (--engine numpy) against sort_values'''
+
+    def setUp(self):
+        if sg.np is None:
+            self.skipTest('numpy is not installed')
+        self.source = sg.open_source(database_path())
+
+    def tearDown(self):
+        self.source.close()
+
+    def check_equivalent(self, horizon_dic):
+        batch = sg.sort_values_batch(horizon_dic)
+        failed = 0
+        for cokey in horizon_dic:
+            expected = scalar(horizon_dic[cokey])
+            if isinstance(expected, type):
+                failed += 1
+                self.assertNotIn(cokey, batch, 'sort_values raises %s on %s' % (expected.__name__, cokey))
+            else:
+                self.assertEqual(repr(batch[cokey]), repr(expected), cokey)
+        return failed
+
+    def test_synthetic(self):
+        mukeys, horizon_dic = all_horizons(self.source)
+        self.assertTrue(self.check_equivalent(horizon_dic))
+
+    def test_nulls(self):
+        mukeys, horizon_dic = all_horizons(self.source)
+        add_nulls(horizon_dic)
+        self.assertTrue(self.check_equivalent(horizon_dic))
+
+    def test_generate_batch(self):
+        '''Both engines write the same soildic lines, errors and files'''
+        mukeys, horizon_dic = all_horizons(self.source)
+        results = {}
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            for engine in ('scalar', 'numpy'):
+                sg.engine = engine
+                sg.rendered_hashes.clear()
+                results[engine] = sg.generate_batch('mukey', mukeys, self.source)
+        finally:
+            sys.stdout = stdout
+            sg.engine = 'scalar'
+        self.assertTrue(results['scalar'].errors)
+        for field in ('lines', 'errors', 'files'):
+            self.assertEqual(getattr(results['numpy'], field), getattr(results['scalar'], field), field)
+
+    def test_fingerprint(self):
+        '''Manifests do not reuse files of the other engine'''
+        try:
+            scalar_settings = sg.settings_fingerprint()
+            sg.engine = 'numpy'
+            self.assertNotEqual(sg.settings_fingerprint(), scalar_settings)
+        finally:
+            sg.engine = 'scalar'
+
+class SelectionTest(unittest.TestCase):
+    '''Mukeys generating more than one component (--top)'''
+
+    def setUp(self):
+        self.source = sg.open_source(database_path())
+        sg.top_components = 2
+
+    def tearDown(self):
+        sg.top_components = None
+        self.source.close()
+
+    def test_failed_components(self):
+        '''A component that fails leaves the other components of its mukey alone'''
+        mukeys, horizon_dic = all_horizons(self.source)
+        components = sg.select_components(mukeys, self.source, None, 2)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            result = sg.generate_batch('mukey', mukeys, self.source)
+        finally:
+            sys.stdout = stdout
+        lines = [line.split(',') for line in result.lines]
+        for mukey in mukeys:
+            cokeys = [c for c, pct in components[mukey]]
+            failed = [c for c in cokeys if not renders(c, horizon_dic[c])]
+            soils = [fields for fields in lines if fields[1].strip() == mukey]
+            if failed and len(failed) == len(cokeys):
+                self.assertIn(mukey, result.errors)
+                self.assertEqual(soils, [['none', ' ' + mukey + '\n']])
+            else:
+                self.assertEqual(len(soils), len(cokeys) - len(failed), mukey)
+                self.assertNotIn(mukey, result.errors)
+                for c in failed:
+                    self.assertIn('%s:%s' % (mukey, c), result.errors)
+        self.assertTrue([e for e in result.errors if ':' in e])
+
+class ValidationTest(unittest.TestCase):
+    '''validate_keys (--validate) against generate_batch'''
+
+    def tearDown(self):
+        sg.top_components = None
+
+    def check_validation(self, path, key_type='mukey'):
+        source = sg.open_source(path)
+        try:
+            mukeys, horizon_dic = all_horizons(source)
+            keys = mukeys if key_type == 'mukey' else sorted(horizon_dic)
+            problems, rejected = sg.validate_keys(key_type, keys, source)
+            result = generate(key_type, keys, source)
+        finally:
+            source.close()
+        self.assertTrue(rejected)
+        self.assertEqual(rejected, [e for e in result.errors if ':' not in e])
+        components = set(['%s:%s' % (key, c) for key in problems if key not in rejected for c, problem in problems[key]])
+        self.assertEqual(components, set([e for e in result.errors if ':' in e]))
+        return problems
+
+    def test_synthetic(self):
+        self.check_validation(database_path())
+        self.check_validation(database_path(), 'cokey')
+
+    def test_nulls(self):
+        problems = self.check_validation(null_database())
+        found = set([problem for key in problems for c, problem in problems[key]])
+        for problem in ('null_depth', 'null_sandvf', 'null_clay', 'zero_cec', 'null_baseline'):
+            self.assertIn(problem, found)
+        self.check_validation(null_database(), 'cokey')
+
+    def test_components(self):
+        '''Keys that only lose some components (--top) are generated, not left out'''
+        sg.top_components = 2
+        self.check_validation(null_database())
+
+class StoreTest(unittest.TestCase):
+    '''ColumnStore (--import-columns) against the database it was imported from'''
+
+    def setUp(self):
+        if sg.np is None:
+            self.skipTest('numpy is not installed')
+        self.path = os.path.join(test_dir, 'synthetic.cols')
+        if not os.path.exists(self.path):
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                sg.import_columns(self.path, sg.open_source(database_path()))
+            finally:
+                sys.stdout = stdout
+
+    def check_store(self, path):
+        source = sg.open_source(database_path())
+        store = sg.open_source(path)
+        try:
+            mukeys, horizon_dic = all_horizons(source)
+            cokeys = sorted(horizon_dic) + ['0', '99999999']
+            stored = sg.fetch_data_bulk(cokeys, store)
+            for cokey in cokeys:
+                self.assertEqual([dict(h) for h in stored[cokey]], [dict(h) for h in horizon_dic[cokey]], cokey)
+            self.assertEqual(store.select_components(mukeys, None, 2), sg.select_components(mukeys, source, None, 2))
+        finally:
+            store.close()
+            source.close()
+
+    def test_horizons(self):
+        self.check_store(self.path)
+
+    def test_no_sqlite(self):
+        '''A column store has no tables to copy into SQLite'''
+        store = sg.open_source(self.path)
+        try:
+            self.assertRaises(ValueError, sg.import_sqlite, os.path.join(test_dir, 'store.sqlite'), store)
+        finally:
+            store.close()
+        self.assertFalse(os.path.exists(os.path.join(test_dir, 'store.sqlite')))
+
+class SqliteTest(unittest.TestCase):
+    '''import_sqlite (--import-sqlite) copying a SqliteSource'''
+
+    def test_round_trip(self):
+        path = os.path.join(test_dir, 'copy.sqlite')
+        source = sg.open_source(database_path())
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            sg.import_sqlite(path, source)
+        finally:
+            sys.stdout = stdout
+        copy = sg.open_source(path)
+        try:
+            self.assertTrue(isinstance(copy, sg.SqliteSource))
+            for table, columns in ((sg.component_table, sg.component_columns), (sg.chorizon_table, sg.chorizon_columns)):
+                select = "SELECT %s FROM %s" % (', '.join([c[0] for c in columns]), table)
+                self.assertEqual(sorted(copy.query(select)), sorted(source.query(select)), table)
+            indexes = [str(r[0]) for r in copy.query("SELECT name FROM sqlite_master WHERE type = 'index'")]
+            self.assertEqual(sorted(indexes), sorted(['%s_mukey' % sg.component_table, '%s_cokey' % sg.component_table,
+                                                      '%s_cokey' % sg.chorizon_table]))
+            mukeys, horizon_dic = all_horizons(source)
+            copied = sg.fetch_data_bulk(sorted(horizon_dic), copy)
+            for cokey in horizon_dic:
+                self.assertEqual([dict(h) for h in copied[cokey]], [dict(h) for h in horizon_dic[cokey]], cokey)
+            self.assertEqual(sg.select_components(mukeys, copy), sg.select_components(mukeys, source))
+        finally:
+            copy.close()
+            source.close()
+
+class TextureTest(unittest.TestCase):
+    '''texture_table and classify_textures against get_texture'''
+
+    def test_table(self):
+        for sand in range(101):
+            for clay in range(101):
+                expected = sg.get_texture(sand, 100 - (sand + clay), clay)
+                self.assertEqual(sg.texture_classes[sg.texture_table[sand][clay]], expected, (sand, clay))
+                self.assertEqual(sg.lookup_texture(sand, clay), expected, (sand, clay))
+
+    def test_classify(self):
+        if sg.np is None:
+            self.skipTest('numpy is not installed')
+        sand, clay = sg.np.meshgrid(range(101), range(101), indexing='ij')
+        codes = sg.classify_textures(sand, clay)
+        for s in range(101):
+            for c in range(101):
+                self.assertEqual(sg.texture_classes[codes[s, c]], sg.get_texture(s, 100 - (s + c), c), (s, c))
+
+    def test_classify_edges(self):
+        '''Fractions truncate, NULL gets the default class and values outside 0-100 go to get_texture'''
+        if sg.np is None:
+            self.skipTest('numpy is not installed')
+        sand = [30.7, 99.99, float('nan'), 20.0, -5, 120]
+        clay = [12.2, 0.5, 10.0, float('nan'), 30, 3]
+        expected = [sg.texture_table[30][12], sg.texture_table[99][0], len(sg.texture_classes) - 1, len(sg.texture_classes) - 1,
+                    sg.texture_code(-5, 30), sg.texture_code(120, 3)]
+        self.assertEqual(sg.classify_textures(sand, clay).tolist(), expected)
+
+def severity_lines(soil_values, columns, plain, prefixes, sev, layout):
+    '''The soil line and layer lines of one severity, scaled and formatted value by value'''
+    soil_line = sg.soil_formats[layout].format(*[v if m == 1 else v*m for v, m in zip(soil_values, sev['soil'])])
+    scaled = [plain[i] if m == 1 else ["{}".format(v*m) for v in columns[i]] for i, m in enumerate(sev['layer'])]
+    return soil_line, ''.join(["    ".join(fields) + "\n" for fields in zip(prefixes, *scaled)])
+
+class RenderTest(unittest.TestCase):
+    '''render_soil and its severities (--severities, --variants)'''
+
+    def setUp(self):
+        source = sg.open_source(database_path())
+        mukeys, horizon_dic = all_horizons(source)
+        source.close()
+        self.soils = []
+        for cokey in sorted(horizon_dic):
+            if renders(cokey, horizon_dic[cokey]):
+                self.soils.append((cokey, sg.sort_values(horizon_dic[cokey], verbose=False)))
+        #int and float multipliers format differently
+        self.severities = (sg.severity_table['95.7'] + soilbench.ensemble() +
+                           [sg.severity_entry(dict(name='int', soil=(1, 1, 2, 2, 1, 3), layer=(2, 1, 2, 1, 1)))])
+
+    def test_scale_severities(self):
+        '''scale_severities makes the lines of every severity as scaling each one on its own does'''
+        for layout, fixed in (('7778', ('depth', 'smr_bd', 'ksat', 'anisotropy', 'fc', 'wp')), ('95.7', ('depth',))):
+            for cokey, (horizon, compname, bl_cl_dic) in self.soils:
+                horizon = [layer for layer in horizon if layer.ksat >= 11]
+                soil_values = (0.23, 0.753, bl_cl_dic['ki'], bl_cl_dic['kr'], bl_cl_dic['tauc'], bl_cl_dic['keff'])
+                prefixes = ["    ".join(["{}".format(getattr(layer, f)) for f in fixed]) for layer in horizon]
+                columns = [[getattr(layer, f) for layer in horizon] for f in ('sand', 'clay', 'om', 'cec', 'rocks')]
+                plain = [["{}".format(v) for v in column] for column in columns]
+                expected = [severity_lines(soil_values, columns, plain, prefixes, sev, layout) for sev in self.severities]
+                self.assertEqual(sg.scale_severities(soil_values, columns, plain, prefixes, self.severities, layout), expected, cokey)
+
+    def test_ensemble(self):
+        '''Rendering a severity along with others gives the file it gets rendered alone'''
+        for cokey, derived in self.soils[:40]:
+            for layout in ('7778', '95.7'):
+                files = sg.render_soil(cokey, derived, layout, severities=self.severities)[1]
+                self.assertEqual(len(files), len(self.severities))
+                for sev, soil_file in zip(self.severities, files):
+                    self.assertEqual(soil_file, sg.render_soil(cokey, derived, layout, severities=[sev])[1][0], (cokey, sev['name']))
+
+    def test_load_ensemble(self):
+        path = os.path.join(test_dir, 'ensemble.csv')
+        with open(path, 'w') as ensemble_file:
+            ensemble_file.write('name,suffix,ki,om,keff\nv1,,2,0.5,\nv2,_x, 0 ,,3\n')
+        self.assertEqual(sg.load_ensemble(path), [dict(name='v1', suffix='_v1', soil=(1, 1, 2, 1, 1, 1), layer=(1, 1, .5, 1, 1)),
+                                                  dict(name='v2', suffix='_x', soil=(1, 1, 0, 1, 1, 3), layer=(1, 1, 1, 1, 1))])
+        path = os.path.join(test_dir, 'ensemble.json')
+        with open(path, 'w') as ensemble_file:
+            json.dump([dict(name='high', soil=[1, 0.5, 2.6, 2.5, 1, 0.4], layer=[1, 1, .5, .9, 1])], ensemble_file)
+        self.assertEqual(sg.load_ensemble(path), [dict(name='high', suffix='_high', soil=(1, 0.5, 2.6, 2.5, 1, 0.4), layer=(1, 1, .5, .9, 1))])
+        with open(path, 'w') as ensemble_file:
+            json.dump(dict(name='high'), ensemble_file)
+        self.assertRaises(ValueError, sg.load_ensemble, path)
+
+class PipelineTest(unittest.TestCase):
+    '''Base of the run_pipeline tests: the module settings a run reads, pointed at the test database and a
+    fresh output directory, and put back afterwards'''
+    settings = ('database_dir', 'write_path', 'dedup', 'batch_size', 'top_components', 'assumed_albedo')
+
+    def setUp(self):
+        self.saved = dict([(name, getattr(sg, name)) for name in self.settings])
+        sg.database_dir = database_path()
+        self.out_dir = tempfile.mkdtemp(prefix='run', dir=test_dir)
+        sg.write_path = self.sol_dir('sol')
+        sg.batch_size = 40
+        source = sg.open_source()
+        self.mukeys = all_horizons(source)[0]
+        source.close()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(sg, name, value)
+        shutil.rmtree(self.out_dir)
+
+    def sol_dir(self, name):
+        '''Makes a directory for soil files in the output directory; returns it as a write_path'''
+        os.mkdir(os.path.join(self.out_dir, name))
+        return os.path.join(self.out_dir, name) + os.sep
+
+    def files(self, path):
+        '''Returns the soil files written to a directory, name -> text'''
+        return dict([(name, open(os.path.join(path, name)).read()) for name in os.listdir(path)])
+
+class ValidatedRunTest(PipelineTest):
+    '''run_pipeline with a --validate report'''
+
+    def setUp(self):
+        PipelineTest.setUp(self)
+        sg.database_dir = null_database()
+        self.report = dict(checked=0, problems={}, rejected=[])
+
+    def test_batches(self):
+        '''validated_batches checks each batch as it is read and hands on the rows it read'''
+        read = []
+        def keys():
+            for mukey in self.mukeys:
+                read.append(mukey)
+                yield mukey
+        source = sg.open_source()
+        problems, rejected = sg.validate_keys('mukey', self.mukeys, source)
+        source.close()
+        stream = sg.validated_batches('mukey', keys(), 7, self.report)
+        first = stream.next()
+        self.assertTrue(len(read) % 7 == 0 and len(read) < len(self.mukeys))
+        passed = []
+        for batch, (dominant_dic, percents, horizon_dic) in [first] + list(stream):
+            self.assertTrue(batch)
+            passed.extend(batch)
+            for key in batch:
+                self.assertTrue(set([c for c in dominant_dic[key]]) <= set(horizon_dic) or not dominant_dic[key], key)
+        self.assertEqual(passed, [mukey for mukey in self.mukeys if mukey not in rejected])
+        self.assertEqual(self.report['rejected'], rejected)
+        self.assertEqual(self.report['problems'], problems)
+        self.assertEqual(self.report['checked'], len(self.mukeys))
+
+    def check_run(self, **options):
+        '''A validated run reads the rows once and generates what a plain run does, less the rejected keys'''
+        sg.profile = sg.Profile()
+        try:
+            errors, lines = run('mukey', self.mukeys, **options)
+            plain = sg.profile.take()[2]
+            sg.write_path = self.sol_dir('validated_%d' % len(os.listdir(self.out_dir)))
+            validated_errors, validated_lines = run('mukey', self.mukeys, validation=self.report, **options)
+            validated = sg.profile.take()[2]
+        finally:
+            sg.profile = None
+        rejected = set(self.report['rejected'])
+        self.assertTrue(rejected)
+        self.assertEqual(validated_errors, [e for e in errors if e not in rejected])
+        self.assertEqual(validated_lines, [line for line in lines if line.split(',')[1].strip() not in rejected])
+        self.assertEqual(self.report['checked'], len(self.mukeys))
+        if 'workers' not in options:
+            self.assertEqual((validated['queries'], validated['rows fetched']), (plain['queries'], plain['rows fetched']))
+
+    def test_run(self):
+        self.check_run()
+
+    def test_prefetch(self):
+        self.check_run(prefetch=2)
+
+    def test_workers(self):
+        self.check_run(workers=2)
+
+def without_cokey(text):
+    '''Soil file text without the header line naming the cokey, which merged and deduplicated soils may not share'''
+    return ''.join([line for line in text.splitlines(True) if 'Component Key:' not in line])
+
+def copied_database(copies=20):
+    '''Returns the path of a copy of the test database where the components of the first copies mukeys are
+    also under mukey d[mukey] as cokey d[cokey], with the same horizons'''
+    path = os.path.join(test_dir, 'copied.sqlite')
+    if not os.path.exists(path):
+        shutil.copy(database_path(), path)
+        con = sqlite3.connect(path)
+        mukeys = [r[0] for r in con.execute("SELECT DISTINCT mukey FROM %s" % sg.component_table)][:copies]
+        for mukey in mukeys:
+            con.execute("INSERT INTO %s SELECT 'd' || mukey, 'd' || cokey, compname, comppct_r FROM %s WHERE mukey = ?"
+                        % (sg.component_table, sg.component_table), (mukey,))
+        fields = [r[1] for r in con.execute("PRAGMA table_info(%s)" % sg.chorizon_table) if r[1] != 'cokey']
+        con.execute("INSERT INTO %s (cokey, %s) SELECT 'd' || cokey, %s FROM %s WHERE 'd' || cokey IN (SELECT cokey FROM %s)"
+                    % (sg.chorizon_table, ', '.join(fields), ', '.join(fields), sg.chorizon_table, sg.component_table))
+        con.commit()
+        con.close()
+    return path
+
+class DedupTest(PipelineTest):
+    '''--dedup runs: soil files named by a hash of their content'''
+
+    def setUp(self):
+        PipelineTest.setUp(self)
+        sg.database_dir = copied_database()
+        sg.dedup = True
+        self.copies = ['d' + mukey for mukey in self.mukeys[:20]]
+
+    def test_names(self):
+        '''Soils that render the same share a name and are written once; every run names them the same'''
+        keys = self.mukeys + self.copies
+        errors, lines = run('mukey', keys)
+        names = {}
+        for line in lines:
+            name, mukey = [field.strip() for field in line.split(',')]
+            names.setdefault(mukey, []).append(name)
+        for mukey in self.mukeys[:20]:
+            self.assertEqual(names['d' + mukey], names[mukey])
+        written = self.files(sg.write_path)
+        soils = set([name for mukey in names for name in names[mukey] if name != 'none'])
+        self.assertTrue(len(soils) < len(keys))
+        self.assertEqual(sorted(written), sorted(['%s%s.sol' % (name, sev['suffix']) for name in soils for sev in sg.severity_table['7778']]))
+        generator = sg.SoilGenerator(database_path())
+        try:
+            for mukey in self.mukeys:
+                try:
+                    soil = generator.mukey_soil(mukey)
+                except Exception:
+                    continue
+                derived = sg.sort_values(generator.horizons([soil.cokey])[soil.cokey], verbose=False)
+                name = '%s_%s' % (soil.name, sg.soil_hash(derived)[:8])
+                self.assertTrue(name in names[mukey], mukey)
+                self.assertEqual(without_cokey(written['%s_high.sol' % name]), without_cokey(soil.severities['high']), mukey)
+        finally:
+            generator.close()
+        sg.write_path = self.sol_dir('again')
+        again_errors, again_lines = run('mukey', list(reversed(keys)))
+        self.assertEqual((sorted(again_errors), sorted(again_lines)), (sorted(errors), sorted(lines)))
+        #the first of the keys sharing a soil names its cokey in the header
+        self.assertEqual(dict([(name, without_cokey(text)) for name, text in self.files(sg.write_path).items()]),
+                         dict([(name, without_cokey(text)) for name, text in written.items()]))
+
+    def test_soil_hash(self):
+        '''A soil's hash leaves out its cokey and takes in the settings that go into its files'''
+        source = sg.open_source()
+        horizon_dic = sg.fetch_data_bulk(['d' + c for c in sg.find_dominant_soil(self.mukeys[0], source)] +
+                                         sg.find_dominant_soil(self.mukeys[0], source), source)
+        source.close()
+        hashes = [sg.soil_hash(sg.sort_values(horizon_dic[c], verbose=False)) for c in sorted(horizon_dic)]
+        self.assertEqual(len(hashes), 2)
+        self.assertEqual(hashes[0], hashes[1])
+        derived = sg.sort_values(horizon_dic.values()[0], verbose=False)
+        self.assertNotEqual(sg.soil_hash(derived, '95.7'), hashes[0])
+        sg.assumed_albedo = 0.3
+        self.assertNotEqual(sg.soil_hash(derived), hashes[0])
+
+class ManifestTest(PipelineTest):
+    '''--manifest runs: keys recorded unchanged are skipped, the others generated again'''
+
+    def setUp(self):
+        PipelineTest.setUp(self)
+        self.manifest = os.path.join(self.out_dir, 'manifest.jsonl')
+
+    def rerun(self):
+        '''Runs the mukeys again; returns the errors, the soildic lines and the keys generated again'''
+        before = len(open(self.manifest).readlines())
+        errors, lines = run('mukey', self.mukeys, manifest_path=self.manifest)
+        return errors, lines, [json.loads(line)['key'] for line in open(self.manifest).readlines()[before:]]
+
+    def test_rerun(self):
+        #content named files, so a key's files are its own unless another key has the same soil
+        sg.dedup = True
+        errors, lines = run('mukey', self.mukeys, manifest_path=self.manifest)
+        manifest = sg.load_manifest(self.manifest)
+        self.assertEqual(sorted(manifest), sorted([('mukey', mukey) for mukey in self.mukeys]))
+        self.assertEqual(self.rerun(), (errors, lines, []))
+        #a key whose files are gone
+        owners = {}
+        for mukey in self.mukeys:
+            for name in manifest[('mukey', mukey)]['files']:
+                owners.setdefault(name, []).append(mukey)
+        lost = [mukey for mukey in self.mukeys if [name for name in manifest[('mukey', mukey)]['files'] if owners[name] == [mukey]]][2]
+        gone = manifest[('mukey', lost)]['files']
+        self.assertEqual(set([owner for name in gone for owner in owners[name]]), set([lost]))
+        for name in gone:
+            os.remove(sg.write_path + name)
+        self.assertEqual(self.rerun(), (errors, lines, [lost]))
+        self.assertTrue(set(gone) <= set(os.listdir(sg.write_path)))
+        #other settings
+        sg.assumed_albedo = 0.3
+        self.assertEqual(self.rerun()[2], self.mukeys)
+        self.assertEqual(self.rerun()[2], [])
+
+    def test_source(self):
+        '''A key whose chorizon rows changed is generated again'''
+        errors, lines = run('mukey', self.mukeys, manifest_path=self.manifest)
+        source = sg.open_source()
+        changed = [mukey for mukey in self.mukeys if mukey not in errors][3]
+        cokeys = sg.find_dominant_soil(changed, source)
+        source.close()
+        sg.database_dir = os.path.join(self.out_dir, 'changed.sqlite')
+        shutil.copy(database_path(), sg.database_dir)
+        con = sqlite3.connect(sg.database_dir)
+        con.execute("UPDATE %s SET om_r = om_r + 1 WHERE cokey = ?" % sg.chorizon_table, (cokeys[0],))
+        con.commit()
+        con.close()
+        changed_errors, changed_lines, generated = self.rerun()
+        self.assertEqual(generated, [changed])
+        self.assertEqual(changed_errors, errors)
+        self.assertEqual(self.rerun()[2], [])
+
+    def test_load_manifest(self):
+        '''Later entries of a key win and a partly written last line is left out'''
+        entries = [dict(key_type='mukey', key='1', source='a'), dict(key_type='cokey', key='1', source='b'),
+                   dict(key_type='mukey', key='1', source='c')]
+        with open(self.manifest, 'w') as manifest_file:
+            manifest_file.writelines([json.dumps(entry) + '\n' for entry in entries])
+            manifest_file.write(json.dumps(dict(key_type='mukey', key='2'))[:20])
+        self.assertEqual(sg.load_manifest(self.manifest), {('mukey', '1'): entries[2], ('cokey', '1'): entries[1]})
+        self.assertEqual(sg.load_manifest(os.path.join(self.out_dir, 'none.jsonl')), {})
+
+class WorkersTest(PipelineTest):
+    '''run_pipeline and map_batches over a --workers process pool against one process'''
+
+    def check_run(self, key_type, keys, **options):
+        '''A run writes the soildic lines, errors and files a serial run does'''
+        errors, lines = run(key_type, keys)
+        serial = self.files(sg.write_path)
+        sg.write_path = self.sol_dir('workers_%d' % len(os.listdir(self.out_dir)))
+        self.assertEqual(run(key_type, keys, **options), (errors, lines))
+        self.assertEqual(self.files(sg.write_path), serial)
+        self.assertTrue(errors and serial)
+
+    def test_mukeys(self):
+        self.check_run('mukey', self.mukeys, workers=2)
+
+    def test_cokeys(self):
+        source = sg.open_source()
+        cokeys = [str(r[0]) for r in source.query("SELECT cokey FROM %s" % sg.component_table)]
+        source.close()
+        self.check_run('cokey', cokeys, workers=3)
+
+    def test_map_batches(self):
+        '''Results come back in input order, however many batches are in flight'''
+        tasks = [('mukey', batch, '7778', None, None) for batch in sg.batches(iter(self.mukeys), 7)]
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            serial = list(sg.map_batches(iter(tasks)))
+            pooled = list(sg.map_batches(iter(tasks), workers=2))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([result.count for result in pooled], [len(task[1]) for task in tasks])
+        self.assertEqual(pooled, serial)
+
+class PrefetchTest(PipelineTest):
+    '''--prefetch runs: reads and writes on background threads'''
+
+    def test_run(self):
+        '''A run writes the soildic lines, errors, files and manifest a serial run does'''
+        sg.dedup = True
+        manifest = os.path.join(self.out_dir, 'serial.jsonl')
+        errors, lines = run('mukey', self.mukeys, manifest_path=manifest)
+        serial = self.files(sg.write_path)
+        sg.write_path = self.sol_dir('prefetch')
+        prefetch_manifest = os.path.join(self.out_dir, 'prefetch.jsonl')
+        self.assertEqual(run('mukey', self.mukeys, manifest_path=prefetch_manifest, prefetch=2), (errors, lines))
+        self.assertEqual(self.files(sg.write_path), serial)
+        self.assertEqual(open(prefetch_manifest).read(), open(manifest).read())
+
+    def test_prefetch_batches(self):
+        '''Each task comes back in order with its rows, read by the thread or carried by the task'''
+        source = sg.open_source()
+        tasks = [('mukey', batch, '7778', None, None) for batch in sg.batches(iter(self.mukeys), 30)]
+        carried = sg.fetch_batch('mukey', tasks[1][1], source)
+        tasks[1] = tasks[1][:4] + (carried,)
+        expected = [(task, task[4] or sg.fetch_batch('mukey', task[1], source)) for task in tasks]
+        source.close()
+        read = list(sg.prefetch_batches(iter(tasks), 2))
+        self.assertEqual(read, expected)
+        self.assertTrue(read[1][1] is carried)
+
+    def test_failure(self):
+        '''What the reading thread raises comes out of the consumer, after the batches read before it'''
+        def tasks():
+            yield ('mukey', self.mukeys[:10], '7778', None, None)
+            raise IOError('lost the database')
+        read = sg.prefetch_batches(tasks(), 2)
+        self.assertEqual(read.next()[0][1], self.mukeys[:10])
+        self.assertRaises(IOError, read.next)
+
+class GridTest(PipelineTest):
+    '''Mukey grids (--grid): counting their pixels and mapping them to soils'''
+
+    def setUp(self):
+        if sg.np is None:
+            self.skipTest('numpy is not installed')
+        PipelineTest.setUp(self)
+        rnd = random.Random(5)
+        #mukeys of the database, one that is not in it (1) and NODATA
+        values = [int(mukey) for mukey in self.mukeys[:12]] + [1, -9999]
+        self.cells = [[rnd.choice(values) for col in range(9)] for row in range(13)]
+        self.counts = {}
+        for value in sum(self.cells, []):
+            if value != -9999:
+                self.counts[str(value)] = self.counts.get(str(value), 0) + 1
+        self.nodata = sum(self.cells, []).count(-9999)
+
+    def write_asc(self):
+        path = os.path.join(self.out_dir, 'mukeys.asc')
+        with open(path, 'w') as grid:
+            grid.write('ncols 9\nnrows 13\nxllcorner 0\nyllcorner 0\ncellsize 30\nNODATA_value -9999\n')
+            grid.writelines([' '.join([str(v) for v in row]) + '\n' for row in self.cells])
+        return path
+
+    def test_counts(self):
+        path = self.write_asc()
+        for chunk in (5, 9, 1000):
+            self.assertEqual(sg.grid_counts(path, chunk=chunk), (self.counts, self.nodata))
+        #a nodata value given overrides the grid's
+        counts = dict(self.counts)
+        counts['-9999'] = self.nodata
+        del counts['1']
+        self.assertEqual(sg.grid_counts(path, nodata=1), (counts, self.counts['1']))
+
+    def test_npy(self):
+        '''A numpy grid has no NODATA value of its own; NaN cells are NODATA'''
+        path = os.path.join(self.out_dir, 'mukeys.npy')
+        sg.np.save(path, sg.np.array(self.cells, dtype=float))
+        self.assertEqual(sg.grid_counts(path, nodata=-9999, chunk=10), (self.counts, self.nodata))
+        cells = sg.np.array(self.cells, dtype=float)
+        cells[cells == -9999] = sg.np.nan
+        sg.np.save(path, cells)
+        self.assertEqual(sg.grid_counts(path), (self.counts, self.nodata))
+
+    def test_grid_map(self):
+        '''Every mukey of the grid gets a row with its pixels and soils; unmapped ones are soil none'''
+        errors, lines = run('mukey', sorted(self.counts))
+        path = os.path.join(self.out_dir, 'grid_map.csv')
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            stats = sg.write_grid_map(path, self.counts, self.nodata, lines)
+        finally:
+            sys.stdout = stdout
+        soils = {}
+        for line in lines:
+            fields = [f.strip() for f in line.split(',')]
+            soils.setdefault(fields[1], []).extend([fields[0]] if fields[0] != 'none' else [])
+        rows = list(csv.reader(open(path, 'rb')))
+        self.assertEqual(rows[0], ['mukey', 'pixels', 'percent', 'soil', 'comppct_r'])
+        data = sum(self.counts.values())
+        expected = [[mukey, str(self.counts[mukey]), '%.4f' % (100.0 * self.counts[mukey] / data), soil, '']
+                    for mukey in self.counts for soil in soils.get(mukey) or ['none']]
+        self.assertEqual(sorted(rows[1:]), sorted(expected))
+        self.assertEqual([int(row[1]) for row in rows[1:]], sorted([int(row[1]) for row in rows[1:]], reverse=True))
+        unmapped = dict([(mukey, self.counts[mukey]) for mukey in self.counts if not soils.get(mukey)])
+        self.assertTrue('1' in unmapped)
+        self.assertEqual((stats['pixels'], stats['data_pixels'], stats['mukeys'], stats['unmapped']),
+                         (13 * 9, data, len(self.counts), unmapped))
+        self.assertEqual(stats['mapped_pixels'], data - sum(unmapped.values()))
+        self.assertEqual(json.load(open(os.path.join(self.out_dir, 'grid_map.json'))), json.loads(json.dumps(stats)))
+
+class CreateTest(PipelineTest):
+    '''create_file and create_957, the per-key path'''
+
+    def test_mukey(self):
+        '''The second argument is still the mukey for the soil dictionary'''
+        generator = sg.SoilGenerator(database_path())
+        soil = generator.mukey_soil(self.mukeys[0], '95.7')
+        generator.close()
+        sg.o2 = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            name = sg.create_957([soil.cokey], self.mukeys[0])
+            files = self.files(sg.write_path)
+            self.assertEqual(files['%s_high.sol' % name], soil.severities['high'])
+            self.assertEqual(files['%s_high.sol' % name].splitlines()[0], '95.7')
+            #without a mukey nothing goes into the soil dictionary
+            self.assertEqual(sg.create_file(soil.cokey), name)
+        finally:
+            sys.stdout = stdout
+            soildic, sg.o2 = sg.o2.getvalue(), None
+        self.assertEqual(soildic, '%s,%s\n' % (name, self.mukeys[0]))
+        self.assertEqual(self.files(sg.write_path)['%s_high.sol' % name].splitlines()[0], sg.weppfile)
+
+class ArchiveTest(PipelineTest):
+    '''--archive runs read back through SoilArchive'''
+
+    def test_get(self):
+        '''get returns the soil SoilGenerator makes for the mukey or cokey'''
+        path = os.path.join(self.out_dir, 'soils.pack')
+        sg.dedup = True
+        run('mukey', self.mukeys, archive_path=path)
+        archive = sg.SoilArchive(path)
+        generator = sg.SoilGenerator(database_path())
+        found = 0
+        try:
+            for mukey in self.mukeys:
+                try:
+                    soil = generator.mukey_soil(mukey)
+                except Exception:
+                    continue
+                self.assertEqual(archive.get(mukey=mukey), soil.severities['norm'], mukey)
+                self.assertEqual(archive.get(cokey=soil.cokey, severity='high'), soil.severities['high'], mukey)
+                found += 1
+        finally:
+            generator.close()
+            archive.close()
+        self.assertTrue(found > len(self.mukeys) / 2)
+
+    def test_rerun(self):
+        '''A run appending to an archive replaces the soils recorded for its keys'''
+        path = os.path.join(self.out_dir, 'soils.pack')
+        sg.dedup = True
+        run('mukey', self.mukeys[:50], archive_path=path)
+        archive = sg.SoilArchive(path)
+        before = dict([(mukey, archive.names(mukey)) for mukey in self.mukeys[:50]])
+        archive.close()
+        sg.assumed_albedo = 0.3
+        run('mukey', self.mukeys[:50], archive_path=path)
+        archive = sg.SoilArchive(path)
+        try:
+            for mukey in self.mukeys[:50]:
+                self.assertEqual(len(archive.names(mukey)), len(before[mukey]), mukey)
+                self.assertFalse(set(archive.names(mukey)) & set(before[mukey]), mukey)
+                if before[mukey]:
+                    self.assertTrue('albedo = 0.3' in archive.get(mukey=mukey), mukey)
+        finally:
+            archive.close()
+
+    def test_needs_dedup(self):
+        self.assertRaises(ValueError, run, 'mukey', self.mukeys, archive_path=os.path.join(self.out_dir, 'soils.pack'))
+
+class ShardTest(PipelineTest):
+    '''--shard runs put back together with merge_shards'''
+    shards = 3
+
+    def run_shard(self, shard, keys, archive=False):
+        '''Runs one shard of keys into its own directory, as --shard i/N does; returns the directory'''
+        out_dir = os.path.join(self.out_dir, 'shard_%d' % shard)
+        os.mkdir(out_dir)
+        sg.write_path = os.path.join(out_dir, 'sol') + os.sep
+        os.mkdir(sg.write_path)
+        counts = dict(keys=0)
+        archive_path = os.path.join(out_dir, 'soils.pack') if archive else None
+        errors, lines = run('mukey', sg.shard_keys(iter(keys), shard, self.shards, counts), archive_path=archive_path)
+        with open(os.path.join(out_dir, 'soildic.txt'), 'w') as soildic:
+            soildic.writelines(lines)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            sg.write_shard(out_dir, shard, self.shards, 'mukey', counts, errors, archive_path)
+        finally:
+            sys.stdout = stdout
+        return out_dir
+
+    def merge(self, shard_dirs):
+        out_dir = os.path.join(self.out_dir, 'merged')
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            report = sg.merge_shards(shard_dirs, out_dir)
+        finally:
+            sys.stdout = stdout
+        soildic = [[f.strip() for f in line.split(',')] for line in open(os.path.join(out_dir, 'soildic.txt'))]
+        errors = [line.split(',')[0] for line in open(os.path.join(out_dir, 'errors.txt'))]
+        return report, soildic, errors, os.path.join(out_dir, 'sol')
+
+    def check_soils(self, soildic, sol_dir):
+        '''Every merged soildic line names the soil SoilGenerator makes for its mukey'''
+        generator = sg.SoilGenerator(database_path())
+        try:
+            dominant = generator.dominant_soils([mukey for soil, mukey in soildic])
+            for soil, mukey in soildic:
+                if soil == 'none':
+                    continue
+                expected = []
+                for cokey in dominant[mukey]:
+                    try:
+                        expected.append(generator.soil(cokey).severities)
+                    except Exception:
+                        continue
+                for sev in sg.severity_table['7778']:
+                    with open(os.path.join(sol_dir, '%s%s.sol' % (soil, sev['suffix']))) as sol_file:
+                        self.assertIn(without_cokey(sol_file.read()), [without_cokey(e[sev['name']]) for e in expected], mukey)
+        finally:
+            generator.close()
+
+    def test_round_trip(self):
+        '''Soil names that shards generated differently are renamed, so each mukey keeps its own soil'''
+        #no soil name twice within a shard, so a shard's own files do not overwrite each other, but shards
+        #share soil names
+        generator = sg.SoilGenerator(database_path())
+        dominant = generator.dominant_soils(self.mukeys)
+        keys = []
+        seen = set()
+        for mukey in self.mukeys:
+            names = []
+            for cokey in dominant[mukey]:
+                try:
+                    names.append((sg.shard_of(mukey, self.shards), generator.soil(cokey).name))
+                except Exception:
+                    continue
+            if not set(names) & seen and len(set(names)) == len(names):
+                seen.update(names)
+                keys.append(mukey)
+        generator.close()
+        shard_dirs = [self.run_shard(shard, keys) for shard in range(1, self.shards + 1)]
+        report, soildic, errors, sol_dir = self.merge(shard_dirs[::-1])
+        self.assertEqual((report['merged'], report['missing'], report['keys']), ([1, 2, 3], [], len(keys)))
+        self.assertTrue(report['renamed'])
+        for soil, names in report['renamed'].items():
+            self.assertEqual(len(names), len(set(names)))
+            self.assertFalse(os.path.exists(os.path.join(sol_dir, soil + '.sol')), soil)
+        self.assertEqual(set([mukey for soil, mukey in soildic]), set(keys))
+        self.assertTrue(errors)
+        self.assertFalse(set([e.split(':')[0] for e in errors]) - set(keys))
+        self.check_soils(soildic, sol_dir)
+
+    def test_missing_shard(self):
+        shard_dirs = [self.run_shard(shard, self.mukeys) for shard in (1, 3)]
+        report = self.merge(shard_dirs)[0]
+        self.assertEqual((report['merged'], report['missing']), ([1, 3], [2]))
+
+    def test_archive(self):
+        '''A shard directory with its archive merges after being moved to another place'''
+        sg.dedup = True
+        shard_dirs = []
+        for shard in range(1, self.shards + 1):
+            shard_dir = self.run_shard(shard, self.mukeys, archive=True)
+            self.assertEqual(os.listdir(os.path.join(shard_dir, 'sol')), [])
+            moved = os.path.join(self.out_dir, 'node_%d' % shard)
+            shutil.move(shard_dir, moved)
+            shard_dirs.append(moved)
+        report, soildic, errors, sol_dir = self.merge(shard_dirs)
+        self.assertEqual(report['keys'], len(self.mukeys))
+        self.assertEqual(report['renamed'], {})
+        self.check_soils([(soil, mukey) for soil, mukey in soildic if mukey in set(self.mukeys)], sol_dir)
+
+if __name__ == "__main__":
+    unittest.main()
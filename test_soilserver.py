@@ -0,0 +1,159 @@
+import httplib, json, os, shutil, tempfile, threading, unittest
+import soilgenFire as sg
+import soilserver
+import soilbench
+'''
+test_soilserver
+Tests of soilserver.py answering requests over HTTP from a synthetic SQLite soils database
+(soilbench.make_database).
+
+    >python -m unittest test_soilserver
+'''
+
+'''Global Vars'''
+#mukeys in the synthetic database
+test_mukeys = 50
+
+#directory of the synthetic database, made once for the module
+test_dir = None
+
+def setUpModule():
+    global test_dir
+    test_dir = tempfile.mkdtemp(prefix='soilserver_test')
+    soilbench.make_database(os.path.join(test_dir, 'synthetic.sqlite'), test_mukeys)
+
+def tearDownModule():
+    shutil.rmtree(test_dir)
+
+def database_path():
+    return os.path.join(test_dir, 'synthetic.sqlite')
+
+class ServiceTest(unittest.TestCase):
+    '''GET /soil and /stats of a server on a free local port'''
+
+    def setUp(self):
+        soilserver.SoilHandler.quiet = True
+        self.service = soilserver.SoilService(database_path(), size=8)
+        self.server = soilserver.SoilServer(('127.0.0.1', 0), self.service)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.generator = sg.SoilGenerator(database_path())
+        mukeys = [str(r[0]) for r in self.generator.source.query("SELECT DISTINCT mukey FROM %s" % sg.component_table)]
+        self.soils = {}
+        for mukey, cokeys in sorted(self.generator.dominant_soils(mukeys).items()):
+            try:
+                self.soils[mukey] = self.generator.soil(cokeys[0])
+            except Exception:
+                continue
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+        self.generator.close()
+
+    def get(self, path):
+        '''Returns the status, body and headers of a GET'''
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            return response.status, response.read(), dict(response.getheaders())
+        finally:
+            connection.close()
+
+    def test_mukey(self):
+        '''A miss generates the dominant soil of the mukey, the same request again hits the cache'''
+        mukey = sorted(self.soils)[0]
+        soil = self.soils[mukey]
+        status, body, headers = self.get('/soil?mukey=%s' % mukey)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, soil.severities['norm'])
+        self.assertEqual((headers['x-cache'], headers['x-cokey'], headers['x-soil-name']), ('miss', soil.cokey, soil.name))
+        status, body, headers = self.get('/soil?mukey=%s&severity=high' % mukey)
+        self.assertEqual((status, headers['x-cache']), (200, 'hit'))
+        self.assertEqual(body, soil.severities['high'])
+
+    def test_cokey(self):
+        mukey = sorted(self.soils)[1]
+        cokey = self.soils[mukey].cokey
+        status, body, headers = self.get('/soil?cokey=%s&format=95.7&severity=low' % cokey)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.generator.soil(cokey, '95.7').severities['low'])
+        self.assertEqual(self.get('/soil?cokey=%s&format=95.7&severity=low' % cokey)[2]['x-cache'], 'hit')
+        #the other layout is another soil
+        self.assertEqual(self.get('/soil?cokey=%s' % cokey)[2]['x-cache'], 'miss')
+
+    def test_stats(self):
+        mukey = sorted(self.soils)[0]
+        for i in range(3):
+            self.get('/soil?mukey=%s' % mukey)
+        self.get('/soil?mukey=1')
+        status, body, headers = self.get('/stats')
+        self.assertEqual((status, headers['content-type']), (200, 'application/json'))
+        stats = json.loads(body)
+        self.assertEqual((stats['served'], stats['failed']), (3, 1))
+        self.assertEqual((stats['caches']['soils']['hits'], stats['caches']['soils']['misses']), (2, 1))
+        self.assertEqual((stats['caches']['components']['hits'], stats['caches']['components']['misses']), (2, 2))
+
+    def test_concurrent(self):
+        '''Requests from many threads at once are all counted'''
+        mukeys = sorted(self.soils)[:4]
+        statuses = []
+        def client(i):
+            for mukey in mukeys * 5 + ['1']:
+                statuses.append(self.get('/soil?mukey=%s&severity=%s' % (mukey, ('low', 'high')[i % 2]))[0])
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        self.assertEqual(sorted(statuses), [200] * 8 * 20 + [404] * 8)
+        stats = json.loads(self.get('/stats')[1])
+        self.assertEqual((stats['served'], stats['failed']), (8 * 20, 8))
+        soils = stats['caches']['soils']
+        self.assertEqual(soils['hits'] + soils['misses'], 8 * 20)
+
+    def test_not_found(self):
+        no_horizons = [str(r[0]) for r in self.generator.source.query(
+            "SELECT cokey FROM %s WHERE cokey NOT IN (SELECT cokey FROM %s)" % (sg.component_table, sg.chorizon_table))]
+        self.assertTrue(no_horizons)
+        for path in ('/soils?mukey=%s' % sorted(self.soils)[0], '/soil?mukey=1', '/soil?cokey=%s' % no_horizons[0]):
+            self.assertEqual(self.get(path)[0], 404, path)
+
+    def test_bad_request(self):
+        mukey = sorted(self.soils)[0]
+        for path in ('/soil?mukey=%s&format=7777' % mukey, '/soil?mukey=%s&severity=worst' % mukey, '/soil', '/soil?chkey=1'):
+            self.assertEqual(self.get(path)[0], 400, path)
+        self.assertEqual(json.loads(self.get('/stats')[1])['served'], 0)
+
+    def test_failed(self):
+        '''Soils sort_values or render_soil fail on are server errors'''
+        cokeys = [str(r[0]) for r in self.generator.source.query("SELECT cokey FROM %s" % sg.component_table)]
+        horizon_dic = self.generator.horizons(cokeys)
+        failing = []
+        for cokey in cokeys:
+            if not horizon_dic[cokey]:
+                continue
+            try:
+                self.generator.render(cokey, sg.sort_values(horizon_dic[cokey], verbose=False))
+            except Exception:
+                failing.append(cokey)
+        self.assertTrue(failing)
+        self.assertEqual(self.get('/soil?cokey=%s' % failing[0])[0], 500)
+
+class CacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = soilserver.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        #b was used least recently
+        self.assertEqual((cache.get('b'), cache.get('a'), cache.get('c')), (None, 1, 3))
+        self.assertEqual(cache.stats(), dict(hits=3, misses=1, size=2, capacity=2, hit_rate=0.75))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import os, shutil, sys, tempfile, unittest
+import soilgenFire as sg
+import solreader
+import soilbench
+'''
+test_solreader
+Tests of solreader.py reading back the soil files render_soil makes from a synthetic SQLite soils database
+(soilbench.make_database).
+
+    >python -m unittest test_solreader
+'''
+
+'''Global Vars'''
+#mukeys in the synthetic database
+test_mukeys = 60
+
+#directory of the synthetic database, made once for the module
+test_dir = None
+
+def setUpModule():
+    global test_dir
+    test_dir = tempfile.mkdtemp(prefix='solreader_test')
+    soilbench.make_database(os.path.join(test_dir, 'synthetic.sqlite'), test_mukeys)
+
+def tearDownModule():
+    shutil.rmtree(test_dir)
+
+def database_path():
+    return os.path.join(test_dir, 'synthetic.sqlite')
+
+def rendered_soils():
+    '''Returns (cokey, derived) of every soil of the test database render_soil makes'''
+    source = sg.open_source(database_path())
+    cokeys = [str(r[0]) for r in source.query("SELECT cokey FROM %s" % sg.component_table)]
+    horizon_dic = sg.fetch_data_bulk(cokeys, source)
+    source.close()
+    soils = []
+    for cokey in sorted(horizon_dic):
+        try:
+            derived = sg.sort_values(horizon_dic[cokey], verbose=False)
+            sg.render_soil(cokey, derived)
+        except Exception:
+            continue
+        soils.append((cokey, derived))
+    return soils
+
+class ParseTest(unittest.TestCase):
+    '''parse_sol of the files render_soil makes'''
+
+    def test_round_trip(self):
+        '''The values of every line come back as render_soil wrote them'''
+        soils = rendered_soils()
+        self.assertTrue(len(soils) > test_mukeys)
+        for cokey, (horizon, compname, bl_cl_dic) in soils:
+            layers = [layer for layer in horizon if layer.ksat >= 11]
+            for layout, version in (('7778', sg.weppfile), ('95.7', '95.7')):
+                fields = solreader.layout_layer_fields[layout]
+                for sev, (name, text) in zip(sg.severity_table[layout], sg.render_soil(cokey, (horizon, compname, bl_cl_dic), layout, version)[1]):
+                    sol = solreader.parse_sol(text)
+                    self.assertEqual((sol.layout, sol.version, sol.name, sol.cokey), (layout, version, compname.lower(), cokey))
+                    self.assertEqual(sol.texture, sg.lookup_texture(int(layers[0].sand), int(layers[0].clay))[0])
+                    values = (sg.assumed_albedo, sg.assumed_initalsat, bl_cl_dic['ki'], bl_cl_dic['kr'], bl_cl_dic['tauc'], bl_cl_dic['keff'])
+                    formats = sg.soil_formats[layout].split()
+                    self.assertEqual(sol.soil, tuple([float(f.format(v * m)) for f, v, m in zip(formats, values, sev['soil'])]), name)
+                    scaled = dict(zip(('sand', 'clay', 'om', 'cec', 'rocks'), sev['layer']))
+                    self.assertEqual(sol.layers, tuple([tuple([float("{}".format(getattr(layer, f) * scaled.get(f, 1))) for f in fields])
+                                                        for layer in layers]), name)
+                    self.assertEqual(len(sol.tail), len(solreader.layout_tail_fields[layout]))
+
+    def test_bad_files(self):
+        cokey, derived = rendered_soils()[0]
+        text = sg.render_soil(cokey, derived)[1][0][1]
+        lines = text.splitlines(True)
+        soil_line = [i for i, line in enumerate(lines) if line.startswith("'")][0]
+        for bad in ('', ''.join(lines[:soil_line]), ''.join(lines[:-2]), ''.join(lines[:-1]) + '1 13\n', text.replace("'", '', 1)):
+            self.assertRaises(ValueError, solreader.parse_sol, bad)
+
+class DiffTest(unittest.TestCase):
+    '''load_columns and diff_sols of directories and archives of soil files'''
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp(prefix='diff', dir=test_dir)
+        self.soils = rendered_soils()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write(self, name, **changed):
+        '''Writes the 7778 and 95.7 files of the test soils to a directory, named by cokey; changed
+        maps cokeys to render_soil options of their own. Returns the directory'''
+        path = os.path.join(self.out_dir, name)
+        os.mkdir(path)
+        for cokey, derived in self.soils:
+            options = changed.get(cokey, {})
+            for layout in ('7778', '95.7'):
+                for filename, text in sg.render_soil(cokey, derived, layout, stem='%s_%s' % (cokey, layout), **options)[1]:
+                    with open(os.path.join(path, filename), 'w') as sol:
+                        sol.write(text)
+        return path
+
+    def test_columns(self):
+        reference = self.write('reference')
+        files, layers, errors = solreader.load_columns(reference, workers=1)
+        count = len(self.soils) * 2 * len(sg.severity_table['7778'])
+        self.assertEqual((len(files['file']), errors), (count, []))
+        self.assertEqual(sorted(files['file']), sorted(os.listdir(reference)))
+        self.assertEqual(int(files['nlayers'].sum()), len(layers['file']))
+        self.assertTrue(sg.np.isnan(layers['smr_bd'][sg.np.repeat(files['layout'] == '95.7', files['nlayers'])]).all())
+        #parsing over processes gives the same columns
+        pooled = solreader.load_columns(reference, workers=2)
+        for field in files:
+            self.assertTrue(sg.np.array_equal(files[field], pooled[0][field]) or
+                            sg.np.allclose(files[field], pooled[0][field], equal_nan=True), field)
+
+    def test_same(self):
+        report = solreader.diff_sols(self.write('reference'), self.write('new'), workers=1)
+        self.assertTrue(report['same'])
+        self.assertEqual(report['files']['common'], report['files']['reference'])
+        self.assertTrue(report['fields']['ki']['compared'] and not report['fields']['ki']['differ'])
+
+    def test_differences(self):
+        '''Missing and extra files, and values over the tolerances'''
+        changed = self.soils[3][0]
+        reference = self.write('reference')
+        new = self.write('new', **{changed: dict(albedo=0.3)})
+        os.remove(os.path.join(new, '%s_7778_high.sol' % self.soils[0][0]))
+        os.rename(os.path.join(new, '%s_7778_low.sol' % self.soils[1][0]), os.path.join(new, 'renamed.sol'))
+        report = solreader.diff_sols(reference, new, workers=1)
+        self.assertFalse(report['same'])
+        self.assertEqual(report['missing'], sorted(['%s_7778_high.sol' % self.soils[0][0], '%s_7778_low.sol' % self.soils[1][0]]))
+        self.assertEqual(report['extra'], ['renamed.sol'])
+        albedo = report['fields']['albedo']
+        self.assertEqual(albedo['differ'], 2 * len(sg.severity_table['7778']))
+        self.assertEqual(sorted([example['file'] for example in albedo['examples']]),
+                         sorted(['%s_%s%s.sol' % (changed, layout, sev['suffix']) for layout in ('7778', '95.7') for sev in sg.severity_table[layout]]))
+        self.assertAlmostEqual(albedo['max_abs'], max([(0.3 - sg.assumed_albedo) * sev['soil'][0] for sev in sg.severity_table['95.7']]))
+        self.assertEqual([field for field in report['fields'] if report['fields'][field]['differ']], ['albedo'])
+        self.assertEqual(solreader.diff_sols(reference, new, tolerances=dict(albedo=0.1), workers=1)['fields']['albedo']['differ'], 0)
+        self.assertEqual(solreader.diff_sols(reference, new, rtol=0.5, workers=1)['fields']['albedo']['differ'], 0)
+        self.assertRaises(ValueError, solreader.diff_sols, reference, new, tolerances=dict(albedos=0.1))
+
+    def test_archive(self):
+        '''An --archive reads back as the directory of the same run'''
+        saved = dict([(name, getattr(sg, name)) for name in ('database_dir', 'write_path', 'dedup')])
+        try:
+            sg.database_dir = database_path()
+            sg.dedup = True
+            sg.write_path = os.path.join(self.out_dir, 'sol') + os.sep
+            os.mkdir(sg.write_path)
+            source = sg.open_source()
+            mukeys = [str(r[0]) for r in source.query("SELECT DISTINCT mukey FROM %s" % sg.component_table)]
+            source.close()
+            archive = os.path.join(self.out_dir, 'soils.pack')
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                sg.run_pipeline('mukey', iter(mukeys), open(os.devnull, 'w'))
+                sg.run_pipeline('mukey', iter(mukeys), open(os.devnull, 'w'), archive_path=archive)
+            finally:
+                sys.stdout = stdout
+        finally:
+            for name, value in saved.items():
+                setattr(sg, name, value)
+        self.assertEqual(solreader.sol_names(archive), sorted(os.listdir(os.path.join(self.out_dir, 'sol'))))
+        report = solreader.diff_sols(os.path.join(self.out_dir, 'sol'), archive, workers=1)
+        self.assertTrue(report['same'])
+        self.assertTrue(report['files']['common'])
+
+if __name__ == "__main__":
+    unittest.main()